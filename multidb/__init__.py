@@ -1,52 +1,217 @@
-import itertools
-import random
+from django.db import connections
 
 from multidb.conf import settings
-
-from .pinning import this_thread_is_pinned, db_write  # noqa
+from multidb.utils import setting_changed, slave_aliases
+
+from . import (failover, groups, health, lag, limits, positions, querycache,
+               shards, stats, topology, wrappers, zones)
+from .groups import DEFAULT_GROUP, group_for_model
+from .pinning import (this_thread_is_pinned, db_write,  # noqa
+                      this_thread_is_sticky, this_thread_slave,
+                      set_this_thread_slave, this_thread_write_position,
+                      this_thread_position_slave,
+                      set_this_thread_position_slave,
+                      this_thread_pinned_tables,
+                      add_this_thread_written_table, pin_this_thread,
+                      pin_this_thread_on_write, this_thread_pins_on_write,
+                      this_thread_pinned_shards,
+                      add_this_thread_written_shard)
 
 
 DEFAULT_DB_ALIAS = 'default'
 
 
-if getattr(settings, 'SLAVE_DATABASES'):
-    # Shuffle the list so the first slave db isn't slammed during startup.
-    dbs = list(settings.SLAVE_DATABASES)
-    random.shuffle(dbs)
-    slaves = itertools.cycle(dbs)
-    # Set the slaves as test mirrors of the master.
-    for db in dbs:
-        settings.DATABASES[db]['TEST_MIRROR'] = DEFAULT_DB_ALIAS
-else:
-    slaves = itertools.repeat(DEFAULT_DB_ALIAS)
-
-
-def get_slave():
-    """Returns the alias of a slave database."""
-    return slaves.next()
+groups.build()
+
+# Set the slaves as test mirrors of their masters.
+for db in slave_aliases():
+    shard = shards.shard_of_alias(db)
+    settings.DATABASES[db]['TEST_MIRROR'] = (
+        DEFAULT_DB_ALIAS if shard is None else shard.master)
+
+# First, so that the reads it serves from the cache aren't timed or counted.
+if settings.MULTIDB_QUERY_CACHE:
+    wrappers.register(querycache.cache_reads)
+if settings.MULTIDB_STATS:
+    wrappers.register(stats.time_queries)
+if settings.MULTIDB_FAILOVER:
+    wrappers.register(failover.failover)
+if settings.MULTIDB_PIN_ONLY_ON_WRITES:
+    wrappers.register(wrappers.note_writes)
+if settings.MULTIDB_ZONE_MAX_IN_FLIGHT is not None \
+        or settings.MULTIDB_MAX_IN_FLIGHT:
+    wrappers.register(wrappers.count_in_flight)
+
+
+def _read_checks():
+    # Whether any of MULTIDB_MAX_REPLICATION_LAG, MULTIDB_MAX_IN_FLIGHT and
+    # MULTIDB_ZONE is set, read once rather than for every slave chosen.
+    global _checks
+    _checks = (settings.MULTIDB_MAX_REPLICATION_LAG is not None
+               or bool(settings.MULTIDB_MAX_IN_FLIGHT)
+               or settings.MULTIDB_ZONE is not None)
+
+_read_checks()
+
+
+def _is_usable(alias):
+    return (health.is_healthy(alias) and not lag.is_lagging(alias)
+            and failover.is_closed(alias) and not topology.is_retired(alias))
+
+
+def _choose_slave(name):
+    slaves = groups.get_group(name)
+    if slaves.aliases and not (_checks or health._ejected
+                               or failover._open_until
+                               or topology._retired):
+        # No slave can be unusable, full or in another zone.
+        return slaves.balancer.choose(slaves.aliases)
+    full = False
+    for group in slaves.chain:
+        aliases = [alias for alias in group.aliases if _is_usable(alias)]
+        free = limits.not_full(aliases, name)
+        if free:
+            return group.balancer.choose(zones.prefer_local(free))
+        full = full or bool(aliases)
+    if full:
+        return limits.overflow(name, slaves.master)
+    return slaves.master
+
+
+def get_slave(group=DEFAULT_GROUP):
+    """Returns the alias of a slave database of ``group`` (by default, one of
+    ``SLAVE_DATABASES``), as chosen by the group's balancer.
+
+    Slaves ejected by the health checker, further behind than
+    ``MULTIDB_MAX_REPLICATION_LAG`` or with an open circuit breaker (see
+    ``multidb.failover``) are skipped; if no slave is left, the
+    group's fallback group is tried, and then the master's alias is
+    returned. Slaves running ``MULTIDB_MAX_IN_FLIGHT`` queries are skipped
+    too, but if they are all that's left, ``MULTIDB_IN_FLIGHT_OVERFLOW``
+    applies (see ``multidb.limits``). Slaves in the zone of the process are
+    preferred (see ``multidb.zones``). A sticky thread gets the same alias
+    every time, for as long as that alias stays usable and isn't full.
+    """
+    if not this_thread_is_sticky():
+        return _choose_slave(group)
+    alias = this_thread_slave(group)
+    if alias is None or not _is_usable(alias) or limits.is_full(alias):
+        alias = _choose_slave(group)
+        set_this_thread_slave(alias, group)
+    return alias
+
+
+def get_slave_at(position, group=DEFAULT_GROUP):
+    """Returns the alias of a slave database of ``group`` that has replayed
+    the master's write ``position``, or the master's alias if no usable
+    slave has.
+
+    The slave ``get_slave`` would return is tried first.
+    """
+    first = get_slave(group)
+    aliases = [first] + [alias for alias in groups.get_group(group).aliases
+                         if alias != first and _is_usable(alias)]
+    for alias in aliases:
+        if alias != DEFAULT_DB_ALIAS and positions.has_replayed(alias,
+                                                                position):
+            return alias
+    return DEFAULT_DB_ALIAS
 
 
 class MasterSlaveRouter(object):
 
     def db_for_read(self, model, **hints):
-        """Send reads to slaves in round-robin."""
-        return get_slave()
+        alias = self._read_alias(model, shards.shard_for(model, hints))
+        stats.count_route(self.__class__, 'read', alias, model)
+        return alias
+
+    def _read_alias(self, model, shard):
+        """Send reads to the slaves of the model's group (or ``shard``), as
+        chosen by the group's balancer."""
+        if shard is not None:
+            return get_slave(shard.group)
+        return get_slave(group_for_model(model))
 
     def db_for_write(self, model, **hints):
-        """Send all writes to the master."""
-        return DEFAULT_DB_ALIAS
+        alias = self._write_alias(model, shards.shard_for(model, hints))
+        stats.count_route(self.__class__, 'write', alias, model)
+        return alias
+
+    def _write_alias(self, model, shard):
+        """Send all writes to the master (of ``shard``)."""
+        return DEFAULT_DB_ALIAS if shard is None else shard.master
 
     def allow_relation(self, obj1, obj2, **hints):
         """Allow all relations, so FK validation stays quiet."""
         return True
 
     def allow_syncdb(self, db, model):
-        """Only allow syncdb on the master."""
+        """Only allow syncdb on the masters."""
+        shard = shards.shard_of_alias(db)
+        if shard is not None:
+            return db == shard.master
         return db == DEFAULT_DB_ALIAS
 
 
 class PinningMasterSlaveRouter(MasterSlaveRouter):
 
-    def db_for_read(self, model, **hints):
-        """Send reads to slaves in round-robin unless this thread is pinned."""
-        return DEFAULT_DB_ALIAS if this_thread_is_pinned() else get_slave()
+    def _read_alias(self, model, shard):
+        """Send reads to the slaves unless this thread (or ``shard``) is
+        pinned.
+
+        If the thread has a write position to see, send them to a slave that
+        has replayed it, or to the master if there's none. Reads of the
+        thread's pinned tables go to the master.
+
+        A thread waiting for its first write to get pinned is pinned by a
+        transaction on the master.
+        """
+        master = DEFAULT_DB_ALIAS if shard is None else shard.master
+        if this_thread_is_pinned():
+            return master
+        reason = this_thread_pins_on_write()
+        if reason is not None and connections[master].in_atomic_block:
+            self._pin(reason)
+            return master
+        tables = this_thread_pinned_tables()
+        if tables and model is not None and model._meta.db_table in tables:
+            return master
+        if shard is not None:
+            if shard.name in this_thread_pinned_shards():
+                return master
+            return get_slave(shard.group)
+        group = group_for_model(model)
+        position = this_thread_write_position()
+        if position is None:
+            return get_slave(group)
+        alias = this_thread_position_slave(group)
+        if alias is None:
+            alias = get_slave_at(position, group)
+            set_this_thread_position_slave(alias, group)
+        return alias
+
+    def _write_alias(self, model, shard):
+        """Send all writes to the master (of ``shard``), noting the tables
+        and shards written and pinning a thread that waits for its first
+        write."""
+        if model is not None:
+            add_this_thread_written_table(model._meta.db_table)
+        if shard is not None:
+            add_this_thread_written_shard(shard.name)
+        reason = this_thread_pins_on_write()
+        if reason is not None:
+            self._pin(reason)
+        return super(PinningMasterSlaveRouter, self)._write_alias(model,
+                                                                  shard)
+
+    def _pin(self, reason):
+        pin_this_thread(reason)
+        pin_this_thread_on_write(None)
+
+
+def _setting_changed(sender, setting, **kwargs):
+    if setting in ('MULTIDB_MAX_REPLICATION_LAG', 'MULTIDB_MAX_IN_FLIGHT',
+                   'MULTIDB_ZONE'):
+        _read_checks()
+
+setting_changed.connect(_setting_changed)
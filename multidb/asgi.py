@@ -0,0 +1,63 @@
+"""Pinning middleware for ASGI deployments.
+
+This module needs Python 3.7 or later (for ``contextvars``), Django 3.1 or
+later and asgiref 3.3 or later, which carries changes to context variables
+made in synchronous code back to the calling coroutine.
+"""
+import asyncio
+
+from asgiref.sync import sync_to_async
+
+from multidb.conf import settings
+from multidb.middleware import PinningRouterMiddleware
+
+try:
+    from asgiref.sync import markcoroutinefunction
+except ImportError:  # asgiref < 3.6
+    def markcoroutinefunction(func):
+        func._is_coroutine = asyncio.coroutines._is_coroutine
+        return func
+
+
+class AsyncPinningRouterMiddleware(PinningRouterMiddleware):
+    """``PinningRouterMiddleware`` that also runs natively in an async
+    middleware chain.
+
+    The pinning state lives in context variables, so each request, which
+    ASGI servers run in its own task, has its own, even when many requests
+    share a thread.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        super().__init__(get_response)
+        self._async = asyncio.iscoroutinefunction(get_response)
+        if self._async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self._async:
+            return self.__acall__(request)
+        return super().__call__(request)
+
+    def _blocks(self):
+        """Return whether processing requests and responses may block: the
+        cookieless and pinning key caches are read and written, the master
+        is asked for its write position, and ``request.user`` may be loaded
+        from the database for ``multidb.identity.user_key``. Django also
+        refuses to query databases from the event loop."""
+        return bool(settings.MULTIDB_COOKIELESS_CACHE
+                    or settings.MULTIDB_WRITE_POSITIONS
+                    or settings.MULTIDB_PINNING_KEY_FUNCTIONS)
+
+    async def __acall__(self, request):
+        if self._blocks():
+            await sync_to_async(self.process_request)(request)
+        else:
+            self.process_request(request)
+        response = await self.get_response(request)
+        if self._blocks():
+            return await sync_to_async(self.process_response)(request,
+                                                              response)
+        return self.process_response(request, response)
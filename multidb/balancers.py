@@ -0,0 +1,106 @@
+"""Strategies for choosing a slave.
+
+A balancer is built with the list of slave aliases it serves. Its
+``choose(aliases)`` method is given the (non-empty) subset of those aliases
+that are currently usable, and returns one of them. ``MULTIDB_BALANCER``
+selects the balancer used by ``multidb.get_slave``.
+"""
+import itertools
+import random
+import threading
+
+from multidb import wrappers
+from multidb.conf import settings
+
+
+__all__ = ['Balancer', 'RoundRobinBalancer', 'WeightedRoundRobinBalancer',
+           'LeastOutstandingBalancer', 'PowerOfTwoChoicesBalancer']
+
+
+class Balancer(object):
+    """Base class for balancers."""
+
+    def __init__(self, aliases):
+        self.aliases = list(aliases)
+
+    def choose(self, aliases):
+        """Return one of ``aliases``."""
+        raise NotImplementedError
+
+
+class RoundRobinBalancer(Balancer):
+    """Use the slaves in turn."""
+
+    def __init__(self, aliases):
+        super(RoundRobinBalancer, self).__init__(aliases)
+        self._counter = itertools.count()
+
+    def choose(self, aliases):
+        return aliases[next(self._counter) % len(aliases)]
+
+
+class WeightedRoundRobinBalancer(Balancer):
+    """Use the slaves in turn, each in proportion to its weight in
+    ``MULTIDB_SLAVE_WEIGHTS`` (default 1).
+
+    This is the "smooth" variant, which interleaves the slaves instead of
+    sending a heavy slave its whole share in a row.
+    """
+
+    def __init__(self, aliases):
+        super(WeightedRoundRobinBalancer, self).__init__(aliases)
+        self._lock = threading.Lock()
+        self._current = {}
+
+    def choose(self, aliases):
+        weights = settings.MULTIDB_SLAVE_WEIGHTS
+        with self._lock:
+            total = 0
+            best = None
+            for alias in aliases:
+                weight = weights.get(alias, 1)
+                total += weight
+                self._current[alias] = self._current.get(alias, 0) + weight
+                if best is None or self._current[alias] > self._current[best]:
+                    best = alias
+            self._current[best] -= total
+        return best
+
+
+class LeastOutstandingBalancer(Balancer):
+    """Use the slave on which this process is running the fewest queries.
+    Ties are broken in turn."""
+
+    def __init__(self, aliases):
+        super(LeastOutstandingBalancer, self).__init__(aliases)
+        self._counter = itertools.count()
+        wrappers.register(wrappers.count_in_flight)
+
+    def choose(self, aliases):
+        start = next(self._counter)
+        best = None
+        best_count = None
+        for i in range(len(aliases)):
+            alias = aliases[(start + i) % len(aliases)]
+            count = wrappers.in_flight(alias)
+            if best is None or count < best_count:
+                best = alias
+                best_count = count
+        return best
+
+
+class PowerOfTwoChoicesBalancer(Balancer):
+    """Pick two slaves at random, and use the one on which this process is
+    running fewer queries."""
+
+    def __init__(self, aliases):
+        super(PowerOfTwoChoicesBalancer, self).__init__(aliases)
+        wrappers.register(wrappers.count_in_flight)
+
+    def choose(self, aliases):
+        if len(aliases) == 1:
+            return aliases[0]
+        first, second = random.sample(aliases, 2)
+        if wrappers.in_flight(second) < wrappers.in_flight(first):
+            return second
+        return first
@@ -9,3 +9,49 @@ class MultidbRouterConf(AppConf):
     PINNING_SECONDS = 15
     COOKIELESS_COOKIE = 'multidb_use_cookies'
     COOKIELESS_CACHE = None
+    COOKIELESS_LOCAL_SIZE = 0
+    COOKIELESS_NEGATIVE_SECONDS = 1
+    PINNING_KEY_FUNCTIONS = ()
+    PINNING_KEY_CACHE = 'default'
+    HEALTH_CHECK_INTERVAL = None
+    HEALTH_CHECK_FAILURES = 2
+    HEALTH_CHECK_SUCCESSES = 2
+    REPLICATION_LAG_PROBE = None
+    MAX_REPLICATION_LAG = None
+    ADAPTIVE_PINNING = False
+    BALANCER = 'multidb.balancers.RoundRobinBalancer'
+    SLAVE_WEIGHTS = {}
+    STICKY_SLAVE = False
+    ZONE = None
+    SLAVE_ZONES = {}
+    ZONE_MAX_IN_FLIGHT = None
+    MAX_IN_FLIGHT = {}
+    IN_FLIGHT_OVERFLOW = 'master'
+    WRITE_POSITIONS = None
+    SLAVE_GROUPS = {}
+    SLAVE_ROUTES = {}
+    STATS = False
+    FAILOVER = False
+    FAILOVER_BUDGET = 3
+    CIRCUIT_BREAKER_FAILURES = 3
+    CIRCUIT_BREAKER_SECONDS = 30
+    TABLE_PINNING = False
+    PIN_ONLY_ON_WRITES = False
+    LAZY_PINNING = False
+    SHARDS = {}
+    SHARD_FUNCTION = None
+    TOPOLOGY_FILE = None
+    TOPOLOGY_CACHE = None
+    TOPOLOGY_CACHE_KEY = 'multidb:topology'
+    TOPOLOGY_POLL_INTERVAL = None
+    QUERY_CACHE = None
+    QUERY_CACHE_TABLES = ()
+    QUERY_CACHE_SIZE = 1000
+    QUERY_CACHE_MAX_ROWS = 1000
+    QUERY_CACHE_SECONDS = None
+    HEDGE_DELAY = 0.05
+    HEDGE_PERCENTILE = 95
+    HEDGE_BUDGET = 0.1
+    HEDGE_THREADS = 4
+    WARMUP_JITTER = 0
+    WARMUP_CONCURRENCY = 4
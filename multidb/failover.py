@@ -0,0 +1,159 @@
+"""Transparent failover of the reads from slaves.
+
+With ``MULTIDB_FAILOVER`` set, the ``failover`` execute wrapper catches
+connection errors (``OperationalError`` and ``InterfaceError``) raised by a
+``SELECT`` on a slave outside of a transaction, and runs the query again on the
+other usable slaves of that slave's groups, then on its master. The cursor
+then reads the results from the database the query succeeded on.
+
+Each slave also has a circuit breaker: after
+``MULTIDB_CIRCUIT_BREAKER_FAILURES`` failed queries in a row it opens, and
+``multidb.get_slave`` skips the slave for
+``MULTIDB_CIRCUIT_BREAKER_SECONDS``. Then queries are let through again; a
+success closes the breaker, and another failure opens it again.
+"""
+import logging
+import threading
+import time
+
+from django.db import connections
+from django.db.utils import InterfaceError, OperationalError
+
+from multidb import groups, shards
+from multidb.conf import settings
+from multidb.pinning import (_var, this_thread_failover_budget,
+                             set_this_thread_failover_budget)
+from multidb.utils import slave_aliases
+
+
+__all__ = ['failover', 'is_closed', 'record_success', 'record_failure',
+           'open_breakers', 'reset']
+
+
+log = logging.getLogger('multidb')
+
+CONNECTION_ERRORS = (OperationalError, InterfaceError)
+
+_lock = threading.Lock()
+_failures = {}
+# alias -> time until which its breaker is open.
+_open_until = {}
+# The aliases the query being failed over has been tried on.
+_tried = _var('multidb_failover_tried', ())
+
+
+def is_closed(alias):
+    """Return whether the circuit breaker of ``alias`` lets queries
+    through."""
+    until = _open_until.get(alias)
+    return until is None or until <= time.time()
+
+
+def open_breakers():
+    """Return the set of aliases whose circuit breakers are open."""
+    now = time.time()
+    return set(alias for alias, until in list(_open_until.items())
+               if until > now)
+
+
+def record_success(alias):
+    """Close the circuit breaker of ``alias``."""
+    with _lock:
+        _failures.pop(alias, None)
+        if _open_until.pop(alias, None) is not None:
+            log.info('Closing the circuit breaker of database %r.', alias)
+
+
+def record_failure(alias):
+    """Count a failed query on ``alias``, opening its circuit breaker if it
+    has failed too often."""
+    with _lock:
+        _failures[alias] = _failures.get(alias, 0) + 1
+        if _failures[alias] >= settings.MULTIDB_CIRCUIT_BREAKER_FAILURES:
+            _open_until[alias] = (time.time() +
+                                  settings.MULTIDB_CIRCUIT_BREAKER_SECONDS)
+            log.warning('Opening the circuit breaker of database %r.', alias)
+
+
+def _is_read(sql):
+    return sql.lstrip()[:6].upper() == 'SELECT'
+
+
+def _candidates(alias):
+    """Return the aliases to retry a read that failed on ``alias`` on."""
+    # Imported here because multidb imports us.
+    from multidb import DEFAULT_DB_ALIAS, _is_usable
+    candidates = []
+    for group in groups.all_groups():
+        if alias not in group.aliases:
+            continue
+        for fallback in group.chain:
+            candidates.extend(
+                other for other in fallback.aliases
+                if other not in candidates and other not in _tried.get()
+                and _is_usable(other))
+    shard = shards.shard_of_alias(alias)
+    candidates.append(DEFAULT_DB_ALIAS if shard is None else shard.master)
+    return candidates
+
+
+def _retry(sql, params, many, context, error):
+    for alias in _candidates(context['connection'].alias):
+        budget = this_thread_failover_budget()
+        if budget is not None:
+            if budget <= 0:
+                break
+            set_this_thread_failover_budget(budget - 1)
+        log.warning('Retrying a read that failed on database %r on %r.',
+                    _tried.get()[-1], alias)
+        _tried.set(_tried.get() + (alias,))
+        try:
+            cursor = connections[alias].cursor()
+            if many:
+                result = cursor.executemany(sql, params)
+            else:
+                result = cursor.execute(sql, params)
+        except CONNECTION_ERRORS:
+            continue
+        # Have the cursor the query was run with read the results from the
+        # one it succeeded with.
+        broken = context['cursor'].cursor
+        context['cursor'].cursor = cursor.cursor
+        try:
+            broken.close()
+        except Exception:
+            pass
+        return result
+    raise error
+
+
+def failover(execute, sql, params, many, context):
+    """An execute wrapper that retries failed reads from slaves on other
+    databases."""
+    connection = context['connection']
+    try:
+        result = execute(sql, params, many, context)
+    except CONNECTION_ERRORS as error:
+        alias = connection.alias
+        if alias not in slave_aliases() or not _is_read(sql) \
+                or getattr(connection, 'in_atomic_block', False):
+            raise
+        record_failure(alias)
+        if _tried.get():
+            # We're a retry; the query that is failing over goes on.
+            raise
+        _tried.set((alias,))
+        try:
+            return _retry(sql, params, many, context, error)
+        finally:
+            _tried.set(())
+    if connection.alias in _failures:
+        record_success(connection.alias)
+    return result
+
+
+def reset():
+    """Forget all failures and close every circuit breaker."""
+    with _lock:
+        _failures.clear()
+        _open_until.clear()
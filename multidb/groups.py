@@ -0,0 +1,145 @@
+"""Groups of slaves, and the routing table that sends the reads of each
+model to a group.
+
+``SLAVE_DATABASES`` form the group named ``'default'``, which serves every
+model that isn't routed elsewhere. ``MULTIDB_SLAVE_GROUPS`` declares other
+groups, and ``MULTIDB_SLAVE_ROUTES`` maps app labels (``'reports'``) and
+models (``'catalog.Category'``) to group names. The slaves of each of
+``MULTIDB_SHARDS`` form a group too (see ``shard_group``).
+
+The routing table holds the shards (see ``multidb.shards``) along with the
+groups, so that both are replaced at once.
+"""
+import random
+
+from django.core.exceptions import ImproperlyConfigured
+from django.db import DEFAULT_DB_ALIAS
+
+from multidb.conf import settings
+from multidb.utils import import_object, setting_changed
+
+
+__all__ = ['DEFAULT_GROUP', 'SlaveGroup', 'prepare', 'install', 'build',
+           'get_group', 'all_groups', 'group_for_model', 'shard_group']
+
+
+DEFAULT_GROUP = 'default'
+
+# The groups by name, the routes, a model class -> group name cache filled
+# in as models are first routed, and the shards (as multidb.shards.prepare
+# returns them). Replaced as a whole, never mutated (but for the cache), so
+# that readers always see a consistent table.
+_table = ({}, {}, {}, ({}, {}, None))
+
+
+class SlaveGroup(object):
+    """A set of slaves with its own balancer.
+
+    If none of its slaves is usable, reads go to the ``fallback`` group, or
+    to its ``master`` if there's no fallback.
+    """
+
+    def __init__(self, name, aliases, balancer=None, fallback=None,
+                 master=DEFAULT_DB_ALIAS):
+        self.name = name
+        self.master = master
+        # Shuffle the list so the first slave db isn't slammed during startup.
+        self.aliases = list(aliases)
+        random.shuffle(self.aliases)
+        self.balancer = import_object(
+            balancer or settings.MULTIDB_BALANCER)(self.aliases)
+        self.fallback = fallback
+        # This group, then its fallbacks in order; set by build().
+        self.chain = [self]
+
+
+def prepare():
+    """Return the routing table the settings describe, for ``install``."""
+    # Imported here because shards imports us.
+    from multidb import shards
+    groups = {
+        DEFAULT_GROUP: SlaveGroup(
+            DEFAULT_GROUP, getattr(settings, 'SLAVE_DATABASES', None) or ()),
+    }
+    for name, options in settings.MULTIDB_SLAVE_GROUPS.items():
+        groups[name] = SlaveGroup(name, options.get('DATABASES', ()),
+                                  options.get('BALANCER'),
+                                  options.get('FALLBACK'))
+    for name, options in settings.MULTIDB_SHARDS.items():
+        if 'MASTER' not in options:
+            raise ImproperlyConfigured('Shard %r has no MASTER.' % name)
+        groups[shard_group(name)] = SlaveGroup(
+            shard_group(name), options.get('SLAVES', ()),
+            options.get('BALANCER'), master=options['MASTER'])
+    for group in groups.values():
+        if group.fallback is not None and group.fallback not in groups:
+            raise ImproperlyConfigured(
+                'Slave group %r falls back to unknown group %r.'
+                % (group.name, group.fallback))
+    for group in groups.values():
+        fallback = group.fallback
+        while fallback is not None and groups[fallback] not in group.chain:
+            group.chain.append(groups[fallback])
+            fallback = groups[fallback].fallback
+    routes = {}
+    for label, name in settings.MULTIDB_SLAVE_ROUTES.items():
+        if name not in groups:
+            raise ImproperlyConfigured(
+                'MULTIDB_SLAVE_ROUTES sends %r to unknown group %r.'
+                % (label, name))
+        routes[label.lower()] = name
+    return groups, routes, {}, shards.prepare()
+
+
+def install(table):
+    """Make the routers use ``table``, which ``prepare`` returned."""
+    global _table
+    _table = table
+
+
+def build():
+    """(Re)build the routing table from the settings."""
+    install(prepare())
+
+
+def get_group(name=DEFAULT_GROUP):
+    """Return the ``SlaveGroup`` called ``name``."""
+    return _table[0][name]
+
+
+def shard_group(shard):
+    """Return the name of the group of the slaves of ``shard``."""
+    return 'shard:%s' % shard
+
+
+def all_groups():
+    """Return every ``SlaveGroup``."""
+    return list(_table[0].values())
+
+
+def group_for_model(model):
+    """Return the name of the group that serves the reads of ``model``."""
+    # One table throughout, so that a name computed from the routes of an
+    # older table never lands in the cache of a newer one.
+    _, routes, model_groups, _ = _table
+    try:
+        return model_groups[model]
+    except KeyError:
+        pass
+    name = DEFAULT_GROUP
+    if model is not None:
+        opts = model._meta
+        name = routes.get(
+            '%s.%s' % (opts.app_label.lower(), opts.object_name.lower()),
+            routes.get(opts.app_label.lower(), DEFAULT_GROUP))
+    model_groups[model] = name
+    return name
+
+
+def _setting_changed(sender, setting, **kwargs):
+    if setting in ('SLAVE_DATABASES', 'MULTIDB_SLAVE_GROUPS',
+                   'MULTIDB_SLAVE_ROUTES', 'MULTIDB_BALANCER',
+                   'MULTIDB_SHARDS', 'MULTIDB_SHARD_FUNCTION'):
+        build()
+
+setting_changed.connect(_setting_changed)
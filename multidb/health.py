@@ -0,0 +1,171 @@
+"""Health checking for the slave databases.
+
+Each slave is probed with a cheap query. A slave that fails
+``MULTIDB_HEALTH_CHECK_FAILURES`` probes in a row is ejected from the rotation
+used by ``multidb.get_slave``; it is readmitted after
+``MULTIDB_HEALTH_CHECK_SUCCESSES`` consecutive successful probes.
+"""
+import logging
+import threading
+
+from django.db import connections
+
+from multidb import lag
+from multidb.conf import settings
+from multidb.utils import slave_aliases
+
+
+__all__ = ['is_healthy', 'ejected_slaves', 'record_success', 'record_failure',
+           'ping', 'check', 'check_all', 'HealthChecker',
+           'start_health_checker', 'stop_health_checker', 'reset']
+
+
+log = logging.getLogger('multidb')
+
+_lock = threading.Lock()
+_failures = {}
+_successes = {}
+# Replaced, never mutated, so that is_healthy() can read it without locking.
+_ejected = frozenset()
+_checker = None
+
+
+def is_healthy(alias):
+    """Return whether ``alias`` is in the rotation."""
+    return alias not in _ejected
+
+
+def ejected_slaves():
+    """Return the set of aliases that are currently ejected."""
+    return _ejected
+
+
+def record_success(alias):
+    """Count a successful probe of ``alias``, readmitting it if it has
+    succeeded often enough."""
+    global _ejected
+    with _lock:
+        _failures[alias] = 0
+        if alias not in _ejected:
+            return
+        _successes[alias] = _successes.get(alias, 0) + 1
+        if _successes[alias] >= settings.MULTIDB_HEALTH_CHECK_SUCCESSES:
+            _successes[alias] = 0
+            _ejected = _ejected - frozenset([alias])
+            log.info('Readmitting database %r to the rotation.', alias)
+
+
+def record_failure(alias):
+    """Count a failed probe of ``alias``, ejecting it if it has failed too
+    often."""
+    global _ejected
+    with _lock:
+        _successes[alias] = 0
+        _failures[alias] = _failures.get(alias, 0) + 1
+        if alias in _ejected:
+            return
+        if _failures[alias] >= settings.MULTIDB_HEALTH_CHECK_FAILURES:
+            _ejected = _ejected | frozenset([alias])
+            log.warning('Ejecting database %r from the rotation.', alias)
+
+
+def ping(alias):
+    """Run a trivial query on ``alias``; raise if it fails."""
+    cursor = connections[alias].cursor()
+    try:
+        cursor.execute('SELECT 1')
+        cursor.fetchone()
+    finally:
+        cursor.close()
+
+
+def check(alias):
+    """Probe ``alias`` and record the outcome. Return whether it succeeded."""
+    try:
+        ping(alias)
+    except Exception:
+        log.debug('Health check of database %r failed.', alias,
+                  exc_info=True)
+        _close(alias)
+        record_failure(alias)
+        return False
+    record_success(alias)
+    return True
+
+
+def check_all(aliases=None):
+    """Probe every alias in ``aliases`` (default: all slaves)."""
+    if aliases is None:
+        aliases = slave_aliases()
+    for alias in aliases:
+        check(alias)
+
+
+def _close(alias):
+    try:
+        connections[alias].close()
+    except Exception:
+        pass
+
+
+class HealthChecker(threading.Thread):
+    """A daemon thread that calls ``check_all`` every ``interval`` seconds,
+    and measures the replication lag of the healthy slaves."""
+
+    def __init__(self, interval, aliases=None):
+        super(HealthChecker, self).__init__(name='multidb-health-checker')
+        self.daemon = True
+        self.interval = interval
+        self.aliases = aliases
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.is_set():
+            aliases = self.aliases or slave_aliases()
+            check_all(aliases)
+            lag.measure_all([alias for alias in aliases
+                             if is_healthy(alias)])
+            self._stopped.wait(self.interval)
+        # Django connections are per thread, so these are ours to close.
+        for alias in self.aliases or slave_aliases():
+            _close(alias)
+
+    def stop(self):
+        self._stopped.set()
+
+
+def start_health_checker(interval=None, aliases=None):
+    """Start the background health checker unless it is already running.
+
+    ``interval`` defaults to ``MULTIDB_HEALTH_CHECK_INTERVAL``; if that is not
+    set, nothing is started. Call this after forking (e.g. from your WSGI
+    file or a post-fork hook), since threads do not survive a fork.
+    """
+    global _checker
+    if interval is None:
+        interval = settings.MULTIDB_HEALTH_CHECK_INTERVAL
+    if not interval:
+        return None
+    with _lock:
+        if _checker is None or not _checker.is_alive():
+            _checker = HealthChecker(interval, aliases)
+            _checker.start()
+        return _checker
+
+
+def stop_health_checker():
+    """Stop the background health checker, if it is running."""
+    global _checker
+    with _lock:
+        if _checker is not None:
+            _checker.stop()
+            _checker = None
+
+
+def reset():
+    """Forget all probe results and readmit every alias."""
+    global _ejected
+    with _lock:
+        _failures.clear()
+        _successes.clear()
+        _ejected = frozenset()
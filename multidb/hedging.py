@@ -0,0 +1,236 @@
+"""Hedged reads: reading from a second slave when the first is slow.
+
+``hedged(queryset)`` evaluates ``queryset`` on the slave the router picks,
+in a worker thread. If it hasn't returned after the
+``MULTIDB_HEDGE_PERCENTILE``-th percentile of the latencies of the last
+hedged reads of the slave's group (``MULTIDB_HEDGE_DELAY`` until enough are
+known), the query is sent to another usable slave of the group as well. The
+first result is returned, and the other query is cancelled when the
+database driver can (``cancel()`` for psycopg2, ``interrupt()`` for
+SQLite), or else left to finish and ignored.
+
+Each hedged read earns ``MULTIDB_HEDGE_BUDGET`` of a second query, and
+queries are only hedged while there's a whole one left, so they add at most
+that share of reads. ``MULTIDB_HEDGE_THREADS`` worker threads run the
+queries, each with its own connections; when they're all busy, reads run in
+the calling thread, without hedging.
+"""
+from collections import deque
+import logging
+import threading
+import time
+
+from django.db import connections
+
+from multidb import _is_usable, get_slave, groups, limits, shards, zones
+from multidb.conf import settings
+from multidb.groups import DEFAULT_GROUP, group_for_model
+
+try:
+    from django.db import close_old_connections
+except ImportError:  # Django < 1.6
+    from django.db import close_connection as close_old_connections
+
+try:
+    from queue import Empty, Queue
+except ImportError:  # Python 2
+    from Queue import Empty, Queue
+
+
+__all__ = ['hedged', 'hedged_call', 'hedge_delay', 'reset']
+
+
+log = logging.getLogger('multidb')
+
+# The most second queries the budget can save up.
+MAX_TOKENS = 10
+# The latencies the delay of each group is computed from, and the fewest
+# that are used.
+LATENCY_SAMPLES = 100
+MIN_LATENCY_SAMPLES = 10
+
+_lock = threading.Lock()
+_tasks = Queue()
+_workers = []
+_busy = 0
+_tokens = 0.0
+# group name -> deque of the latest latencies.
+_latencies = {}
+
+
+class _Task(object):
+
+    def __init__(self, func, alias, done):
+        self.func = func
+        self.alias = alias
+        self.done = done
+        self.started = None
+        self.cancelled = False
+        # The connection the task is running a query on, if it is.
+        self._connection = None
+        self._lock = threading.Lock()
+
+    def run(self):
+        self.started = time.time()
+        try:
+            with self._lock:
+                if self.cancelled:
+                    return
+                self._connection = connections[self.alias]
+            value = self.func(self.alias)
+        except Exception as error:
+            self.done.put((self, None, error))
+        else:
+            self.done.put((self, value, None))
+        finally:
+            # So that cancel() can't interrupt the next task's query.
+            with self._lock:
+                self._connection = None
+
+    def cancel(self):
+        with self._lock:
+            self.cancelled = True
+            raw = getattr(self._connection, 'connection', None)
+            for name in ('cancel', 'interrupt'):
+                method = getattr(raw, name, None)
+                if method is not None:
+                    try:
+                        method()
+                    except Exception:
+                        pass
+                    return
+
+
+def _work():
+    global _busy
+    while True:
+        task = _tasks.get()
+        try:
+            task.run()
+        finally:
+            # Like after a request, so that CONN_MAX_AGE applies.
+            close_old_connections()
+            with _lock:
+                _busy -= 1
+
+
+def _submit(task):
+    """Queue ``task`` if a worker is free; return whether it was."""
+    global _busy
+    with _lock:
+        if _busy >= settings.MULTIDB_HEDGE_THREADS:
+            return False
+        _busy += 1
+        if len(_workers) < _busy:
+            worker = threading.Thread(target=_work,
+                                      name='multidb-hedging-%d'
+                                      % len(_workers))
+            worker.daemon = True
+            worker.start()
+            _workers.append(worker)
+    _tasks.put(task)
+    return True
+
+
+def _earn_token():
+    global _tokens
+    with _lock:
+        _tokens = min(MAX_TOKENS, _tokens + settings.MULTIDB_HEDGE_BUDGET)
+
+
+def _spend_token():
+    """Return whether the budget affords a hedge, spending it if it
+    does."""
+    global _tokens
+    with _lock:
+        if _tokens < 1:
+            return False
+        _tokens -= 1
+        return True
+
+
+def _record_latency(group, seconds):
+    with _lock:
+        samples = _latencies.setdefault(group,
+                                        deque(maxlen=LATENCY_SAMPLES))
+        samples.append(seconds)
+
+
+def hedge_delay(group=DEFAULT_GROUP):
+    """Return how long the reads of ``group`` wait before hedging."""
+    samples = sorted(_latencies.get(group, ()))
+    if len(samples) < MIN_LATENCY_SAMPLES:
+        return settings.MULTIDB_HEDGE_DELAY
+    index = int(len(samples) * settings.MULTIDB_HEDGE_PERCENTILE / 100.0)
+    return samples[min(index, len(samples) - 1)]
+
+
+def _second_alias(group, first):
+    slaves = groups.get_group(group)
+    aliases = [alias for alias in slaves.aliases
+               if alias != first and _is_usable(alias)
+               and not limits.is_full(alias)]
+    if not aliases:
+        return None
+    return slaves.balancer.choose(zones.prefer_local(aliases))
+
+
+def hedged_call(func, group=DEFAULT_GROUP, first=None):
+    """Return ``func(alias)`` for the first of two slaves of ``group`` to
+    answer: ``first`` (by default, ``get_slave(group)``), then another one
+    if ``first`` is slow."""
+    if first is None:
+        first = get_slave(group)
+    _earn_token()
+    done = Queue()
+    tasks = [_Task(func, first, done)]
+    if not _submit(tasks[0]):
+        return func(first)
+    pending = 1
+    error = None
+    timeout = hedge_delay(group)
+    while True:
+        try:
+            task, value, task_error = done.get(timeout=timeout)
+        except Empty:
+            timeout = None
+            second = _second_alias(group, first)
+            if second is None or not _spend_token():
+                continue
+            tasks.append(_Task(func, second, done))
+            if _submit(tasks[-1]):
+                log.debug('Hedging a read from %r on %r.', first, second)
+                pending += 1
+            continue
+        pending -= 1
+        if task_error is None:
+            _record_latency(group, time.time() - task.started)
+            for other in tasks:
+                if other is not task:
+                    other.cancel()
+            return value
+        error = error or task_error
+        if not pending:
+            raise error
+
+
+def hedged(queryset):
+    """Return the list of the results of ``queryset``, hedging the read if
+    the router sends it to a slave."""
+    model = queryset.model
+    # Querysets have no hints before Django 1.7.
+    shard = shards.shard_for(model, getattr(queryset, '_hints', {}))
+    group = group_for_model(model) if shard is None else shard.group
+    alias = queryset.db
+    if alias not in groups.get_group(group).aliases:
+        return list(queryset.using(alias))
+    return hedged_call(lambda alias: list(queryset.using(alias)), group,
+                       alias)
+
+
+def reset():
+    """Forget the latencies and the saved up budget."""
+    global _tokens
+    with _lock:
+        _latencies.clear()
+        _tokens = 0.0
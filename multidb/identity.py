@@ -0,0 +1,74 @@
+"""Identifying the clients that don't keep cookies, to pin them on the
+server.
+
+``MULTIDB_PINNING_KEY_FUNCTIONS`` lists functions that take a request and
+return a string that identifies its client, or ``None``. When one of them
+returns a key, ``PinningRouterMiddleware`` keeps the pinning state of the
+client in ``MULTIDB_PINNING_KEY_CACHE`` under that key, instead of relying
+on the client fingerprint (see ``MULTIDB_COOKIELESS_CACHE``), which clients
+behind the same NAT share.
+"""
+from hashlib import md5
+
+from django.utils.encoding import force_bytes
+
+from multidb.conf import settings
+from multidb.utils import import_object
+
+
+__all__ = ['token_key', 'session_key', 'user_key', 'request_keys']
+
+
+KEY_PREFIX = 'multidb:pin:'
+
+# (MULTIDB_PINNING_KEY_FUNCTIONS, the functions it names)
+_functions = ((), [])
+
+
+def _digest(value):
+    return md5(force_bytes(value)).hexdigest()
+
+
+def token_key(request):
+    """Return a key for the bearer token of the ``Authorization`` header."""
+    scheme, _, token = request.META.get('HTTP_AUTHORIZATION', '') \
+        .strip().partition(' ')
+    if scheme.lower() not in ('bearer', 'token') or not token.strip():
+        return None
+    return 't:' + _digest(token.strip())
+
+
+def session_key(request):
+    """Return a key for the session of the request."""
+    key = request.COOKIES.get(settings.SESSION_COOKIE_NAME)
+    return 's:' + _digest(key) if key else None
+
+
+def user_key(request):
+    """Return a key for the authenticated user of the request.
+
+    The user must be known when ``PinningRouterMiddleware`` processes the
+    request, so the middleware that authenticates it must come first.
+    """
+    user = getattr(request, 'user', None)
+    authenticated = getattr(user, 'is_authenticated', False)
+    if callable(authenticated):  # Django < 1.10
+        authenticated = authenticated()
+    return 'u:%s' % user.pk if authenticated else None
+
+
+def request_keys(request):
+    """Return the cache keys of the pinning state of the client of
+    ``request``, as the ``MULTIDB_PINNING_KEY_FUNCTIONS`` find them."""
+    global _functions
+    paths = settings.MULTIDB_PINNING_KEY_FUNCTIONS
+    if not paths:
+        return []
+    if _functions[0] != paths:
+        _functions = (paths, [import_object(path) for path in paths])
+    keys = []
+    for function in _functions[1]:
+        key = function(request)
+        if key is not None:
+            keys.append(KEY_PREFIX + key)
+    return keys
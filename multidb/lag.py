@@ -0,0 +1,156 @@
+"""Replication lag tracking for the slave databases.
+
+A lag probe is a callable that takes a database alias and returns how many
+seconds that slave is behind the master, or ``None`` if it can't tell.
+``MULTIDB_REPLICATION_LAG_PROBE`` selects the probe; the health checker calls
+``measure_all`` after every round of health checks.
+"""
+import logging
+import math
+
+from django.db import connections
+
+from multidb.conf import settings
+from multidb.utils import import_object, slave_aliases
+
+
+__all__ = ['postgresql_lag', 'mysql_lag', 'vendor_lag', 'get_probe',
+           'measure', 'measure_all', 'record_lag', 'get_lag', 'is_lagging',
+           'pinning_seconds', 'reset']
+
+
+log = logging.getLogger('multidb')
+
+_lags = {}
+
+
+def postgresql_lag(alias):
+    """Return the replay lag of a PostgreSQL (10 or later) standby.
+
+    A standby that has replayed everything it received is not lagging, even
+    if the master has been idle since its last transaction.
+    """
+    cursor = connections[alias].cursor()
+    try:
+        cursor.execute(
+            'SELECT CASE WHEN pg_last_wal_receive_lsn() = '
+            'pg_last_wal_replay_lsn() THEN 0 ELSE EXTRACT(EPOCH FROM '
+            'now() - pg_last_xact_replay_timestamp()) END')
+        row = cursor.fetchone()
+    finally:
+        cursor.close()
+    if row is None or row[0] is None:
+        return None
+    return max(float(row[0]), 0.0)
+
+
+def mysql_lag(alias):
+    """Return ``Seconds_Behind_Master`` of a MySQL replica."""
+    cursor = connections[alias].cursor()
+    try:
+        cursor.execute('SHOW SLAVE STATUS')
+        row = cursor.fetchone()
+        columns = [column[0] for column in cursor.description or ()]
+    finally:
+        cursor.close()
+    if row is None:
+        return None
+    status = dict(zip(columns, row))
+    lag = status.get('Seconds_Behind_Master',
+                     status.get('Seconds_Behind_Source'))
+    return None if lag is None else float(lag)
+
+
+_vendor_probes = {
+    'postgresql': postgresql_lag,
+    'mysql': mysql_lag,
+}
+
+
+def vendor_lag(alias):
+    """Dispatch to the built-in probe for the vendor of ``alias``."""
+    probe = _vendor_probes.get(connections[alias].vendor)
+    return probe(alias) if probe else None
+
+
+def get_probe():
+    """Return the configured lag probe, or ``None``."""
+    probe = settings.MULTIDB_REPLICATION_LAG_PROBE
+    return import_object(probe) if probe else None
+
+
+def record_lag(alias, lag):
+    """Remember that ``alias`` is ``lag`` seconds behind (``None``: unknown).
+    """
+    _lags[alias] = lag
+
+
+def get_lag(alias):
+    """Return the last measured lag of ``alias``, or ``None``."""
+    return _lags.get(alias)
+
+
+def measure(alias, probe=None):
+    """Measure and record the lag of ``alias``; return it."""
+    probe = probe or get_probe()
+    if probe is None:
+        return None
+    try:
+        lag = probe(alias)
+    except Exception:
+        log.debug('Measuring the lag of database %r failed.', alias,
+                  exc_info=True)
+        lag = None
+    record_lag(alias, lag)
+    return lag
+
+
+def measure_all(aliases=None):
+    """Measure the lag of every alias in ``aliases`` (default: all
+    slaves)."""
+    probe = get_probe()
+    if probe is None:
+        return
+    if aliases is None:
+        aliases = slave_aliases()
+    for alias in aliases:
+        measure(alias, probe)
+
+
+def is_lagging(alias):
+    """Return whether ``alias`` is further behind than
+    ``MULTIDB_MAX_REPLICATION_LAG``. Unknown lag doesn't count."""
+    maximum = settings.MULTIDB_MAX_REPLICATION_LAG
+    if maximum is None:
+        return False
+    lag = _lags.get(alias)
+    return lag is not None and lag > maximum
+
+
+def pinning_seconds(aliases=None):
+    """Return for how long to pin a client that may have written.
+
+    Unless ``MULTIDB_ADAPTIVE_PINNING`` is set, this is
+    ``MULTIDB_PINNING_SECONDS``. Otherwise it's the worst lag among the
+    slaves in ``aliases`` (default: all slaves) that reads may go to,
+    rounded up plus one second, and never more than
+    ``MULTIDB_PINNING_SECONDS``. If the lag of any such slave is unknown,
+    it's ``MULTIDB_PINNING_SECONDS``.
+    """
+    maximum = settings.MULTIDB_PINNING_SECONDS
+    if not settings.MULTIDB_ADAPTIVE_PINNING:
+        return maximum
+    # Imported here because health imports us.
+    from multidb import health
+    if aliases is None:
+        aliases = slave_aliases()
+    lags = [_lags.get(alias) for alias in aliases
+            if health.is_healthy(alias) and not is_lagging(alias)]
+    if not lags or None in lags:
+        return maximum
+    return min(maximum, int(math.ceil(max(lags))) + 1)
+
+
+def reset():
+    """Forget all measurements."""
+    _lags.clear()
@@ -0,0 +1,74 @@
+"""Limiting the queries this process runs on each slave at once.
+
+``MULTIDB_MAX_IN_FLIGHT`` maps slave aliases to the most queries this
+process may run on them at the same time, as counted by
+``multidb.wrappers.count_in_flight`` (all threads together).
+``multidb.get_slave`` skips the slaves that are at their limit, and sends
+``multidb.signals.read_rejected`` for each of them; when every usable slave
+of a group and of its fallback groups is, ``MULTIDB_IN_FLIGHT_OVERFLOW``
+says what happens to the read: ``'master'`` sends it to the master,
+``'fail'`` raises ``SlavesOverloaded``.
+
+The counts are read when a query is routed, and change when queries start
+and finish, so a burst of threads routing at the same moment can overshoot
+a limit by a few queries.
+"""
+import logging
+
+from django.core.exceptions import ImproperlyConfigured
+from django.db import DatabaseError
+
+from multidb import stats, wrappers
+from multidb.conf import settings
+
+
+__all__ = ['SlavesOverloaded', 'is_full', 'not_full', 'overflow']
+
+
+log = logging.getLogger('multidb')
+
+OVERFLOW_MODES = ('master', 'fail')
+
+
+class SlavesOverloaded(DatabaseError):
+    """Raised for a read when all the slaves it could go to are at their
+    ``MULTIDB_MAX_IN_FLIGHT`` and ``MULTIDB_IN_FLIGHT_OVERFLOW`` is
+    ``'fail'``."""
+
+
+def is_full(alias):
+    """Return whether this process runs as many queries on ``alias`` as
+    ``MULTIDB_MAX_IN_FLIGHT`` allows."""
+    limit = settings.MULTIDB_MAX_IN_FLIGHT.get(alias)
+    return limit is not None and wrappers.in_flight(alias) >= limit
+
+
+def not_full(aliases, group):
+    """Return those of ``aliases`` that aren't full, reporting the others as
+    rejected reads of ``group``."""
+    if not settings.MULTIDB_MAX_IN_FLIGHT:
+        return aliases
+    free = []
+    for alias in aliases:
+        if is_full(alias):
+            stats.count_rejection(alias, group)
+        else:
+            free.append(alias)
+    return free
+
+
+def overflow(group, master):
+    """Return where a read of ``group`` goes when all its slaves are full:
+    ``master``, or nowhere (``SlavesOverloaded`` is raised)."""
+    mode = settings.MULTIDB_IN_FLIGHT_OVERFLOW
+    if mode not in OVERFLOW_MODES:
+        raise ImproperlyConfigured(
+            'MULTIDB_IN_FLIGHT_OVERFLOW must be one of %s, not %r.'
+            % (', '.join(repr(m) for m in OVERFLOW_MODES), mode))
+    if mode == 'fail':
+        raise SlavesOverloaded(
+            'All the slaves of group %r are running as many queries as '
+            'MULTIDB_MAX_IN_FLIGHT allows.' % group)
+    log.debug('All the slaves of group %r are full; reading from %r.',
+              group, master)
+    return master
@@ -0,0 +1,56 @@
+import threading
+import time
+
+try:
+    from collections import OrderedDict
+except ImportError:  # Python 2.6
+    from django.utils.datastructures import SortedDict as OrderedDict
+
+
+__all__ = ['LRUCache', 'MISSING']
+
+
+# Returned by LRUCache.get() for keys it doesn't have; None is a value.
+MISSING = object()
+
+
+class LRUCache(object):
+    """A thread-safe, in-process cache of at most ``size`` entries, each
+    with its own expiry time. The least recently used entry is evicted when
+    it's full."""
+
+    def __init__(self, size):
+        self.size = size
+        self._lock = threading.Lock()
+        self._data = OrderedDict()
+
+    def get(self, key, default=MISSING):
+        now = time.time()
+        with self._lock:
+            try:
+                expires, value = self._data.pop(key)
+            except KeyError:
+                return default
+            if expires <= now:
+                return default
+            self._data[key] = expires, value
+            return value
+
+    def set(self, key, value, timeout):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = time.time() + timeout, value
+            while len(self._data) > self.size:
+                # The least recently used key comes first.
+                del self._data[next(iter(self._data))]
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
@@ -1,19 +1,87 @@
 from hashlib import md5
+import math
+import numbers
+import time
 
-from django.core.cache import get_cache
+from django.utils.encoding import force_bytes
 
+from multidb import DEFAULT_DB_ALIAS, identity, positions, tokens
 from multidb.conf import settings
+from multidb.utils import get_cache, string_types
+from .lag import pinning_seconds
+from .lru import LRUCache, MISSING
 from .pinning import (pin_this_thread, unpin_this_thread,
+                      this_thread_is_pinned,
+                      pin_this_thread_on_write, this_thread_pins_on_write,
                       set_db_write_for_this_thread_if_needed,
                       this_thread_has_db_write_set,
-                      unset_db_write_for_this_thread)
+                      unset_db_write_for_this_thread,
+                      stick_this_thread, unstick_this_thread,
+                      set_this_thread_write_position,
+                      set_this_thread_failover_budget,
+                      set_this_thread_pinned_tables,
+                      this_thread_written_tables,
+                      set_this_thread_written_tables,
+                      this_thread_has_written, set_this_thread_has_written,
+                      set_this_thread_pinned_shards,
+                      this_thread_written_shards,
+                      set_this_thread_written_shards)
 
 
 READ_ONLY_METHODS = ('GET', 'TRACE', 'HEAD', 'OPTIONS')
 
+_local_cache = None
+
+
+# Beyond this many tables, a client is pinned to the master for all reads,
+# to keep the cookie small.
+MAX_PINNED_TABLES = 20
+
+
+def _live(expiries):
+    """Return the entries of a name -> expiry time dict that haven't
+    expired, or None if ``expiries`` isn't such a dict: it comes from the
+    client, which can send anything. Expiries later than we could have set
+    are cut down to MULTIDB_PINNING_SECONDS from now."""
+    if not isinstance(expiries, dict):
+        return None
+    now = time.time()
+    latest = int(now + settings.MULTIDB_PINNING_SECONDS) + 1
+    live = {}
+    for name, expires in expiries.items():
+        if not isinstance(name, string_types) \
+                or not isinstance(expires, numbers.Real) \
+                or math.isinf(expires) or math.isnan(expires):
+            return None
+        if expires > now:
+            live[name] = min(expires, latest)
+    return live
+
+
+def get_local_cache():
+    """Return the in-process cache in front of MULTIDB_COOKIELESS_CACHE, or
+    None if MULTIDB_COOKIELESS_LOCAL_SIZE is not set."""
+    global _local_cache
+    size = settings.MULTIDB_COOKIELESS_LOCAL_SIZE
+    if not size:
+        return None
+    if _local_cache is None or _local_cache.size != size:
+        _local_cache = LRUCache(size)
+    return _local_cache
+
 
 class PinningRouterMiddleware(object):
 
+    def __init__(self, get_response=None):
+        # get_response is passed by Django 1.10 and later, when the
+        # middleware is listed in MIDDLEWARE rather than MIDDLEWARE_CLASSES.
+        self.get_response = get_response
+
+    def __call__(self, request):
+        self.process_request(request)
+        response = self.get_response(request)
+        return self.process_response(request, response)
+
     def _client_fingerprint(self, request):
         """Return hash generated from client IP and browser headers."""
         HASH_COMPONENTS = ('HTTP_X_FORWARDED_FOR', 'REMOTE_ADDR',
@@ -21,72 +89,221 @@ class PinningRouterMiddleware(object):
                            'HTTP_USER_AGENT')
         idstring = '\n'.join([request.META.get(component, '')
                               for component in HASH_COMPONENTS])
-        return md5(idstring).hexdigest()
+        return md5(force_bytes(idstring)).hexdigest()
 
-    def _pinned_because_of_prior_request(self, request):
-        """Return True if a previous request has pinned us."""
+    def _prior_pinning_state(self, request):
+        """Return the pinning state left by a previous request (see
+        multidb.tokens), or None if a previous request hasn't pinned us."""
 
         # If pinning cookie set, the answer's yes
         if settings.MULTIDB_PINNING_COOKIE in request.COOKIES:
-            return True
+            request._multidb_pinned_by = 'cookie'
+            return tokens.loads(
+                request.COOKIES[settings.MULTIDB_PINNING_COOKIE])
+
+        # If we know who the client is, the server-side store has the answer.
+        keys = identity.request_keys(request)
+        if keys:
+            request._multidb_pinned_by = 'identity'
+            cache = get_cache(settings.MULTIDB_PINNING_KEY_CACHE)
+            values = cache.get_many(keys)
+            for key in keys:
+                if values.get(key):
+                    return tokens.loads(values[key])
+            return None
 
         # We don't have pinning cookie; if we aren't configured to use the
         # client fingerprint, end of story, it's a no.
         if not settings.MULTIDB_COOKIELESS_CACHE:
-            return False
+            return None
 
         # We are configured to use the client fingerprint. This means we also
         # use an additional cookie to signify the existence of cookies. If it's
         # set, we're not cookieless, so the absence of the pinning cookie means
         # it's a no.
         if settings.MULTIDB_COOKIELESS_COOKIE in request.COOKIES:
-            return False
+            return None
 
         # We're possibly cookieless, and we are configured to use client
-        # fingerprints. Check it.
-        cache = get_cache(settings.MULTIDB_COOKIELESS_CACHE)
-        return bool(cache.get(self._client_fingerprint(request)))
+        # fingerprints. Check it, in the local cache first if we have one.
+        request._multidb_pinned_by = 'cookieless'
+        fingerprint = self._client_fingerprint(request)
+        local_cache = get_local_cache()
+        value = MISSING
+        if local_cache is not None:
+            value = local_cache.get(fingerprint)
+        if value is MISSING:
+            cache = get_cache(settings.MULTIDB_COOKIELESS_CACHE)
+            value = cache.get(fingerprint)
+            if local_cache is not None and value:
+                local_cache.set(fingerprint, value,
+                                settings.MULTIDB_PINNING_SECONDS)
+            elif local_cache is not None:
+                # Remember that we're not pinned, but not for long, since
+                # another server may pin us.
+                local_cache.set(fingerprint, None,
+                                settings.MULTIDB_COOKIELESS_NEGATIVE_SECONDS)
+        return tokens.loads(value) if value else None
+
+    def _pinned_because_of_prior_request(self, request):
+        """Return True if a previous request has pinned us."""
+        return self._prior_pinning_state(request) is not None
 
     def process_request(self, request):
         """Set the thread's pinning flag according to the presence of the
         incoming cookie and/or client fingerprint in the cache."""
         unset_db_write_for_this_thread()
+        set_this_thread_has_written(False)
+        set_this_thread_write_position(None)
+        if settings.MULTIDB_FAILOVER:
+            set_this_thread_failover_budget(settings.MULTIDB_FAILOVER_BUDGET)
+        # In case the last request this thread served was pinned:
+        unpin_this_thread()
+        pin_this_thread_on_write(None)
+        set_this_thread_pinned_tables(())
+        if settings.MULTIDB_TABLE_PINNING:
+            set_this_thread_written_tables(())
+        set_this_thread_pinned_shards(())
+        if settings.MULTIDB_SHARDS:
+            set_this_thread_written_shards(())
+        # Table -> expiry time of the tables prior requests pinned us to;
+        # None if they pinned us to the master for everything.
+        request._multidb_pinned_tables = {}
+        # Shard -> expiry time of the shards prior requests pinned us to.
+        request._multidb_pinned_shards = {}
         set_db_write_for_this_thread_if_needed(request)
-        if self._pinned_because_of_prior_request(request) \
-                or this_thread_has_db_write_set():
-            pin_this_thread()
-        else:
-            # In case the last request this thread served was pinned:
-            unpin_this_thread()
+        state = self._prior_pinning_state(request)
+        if state is not None and 's' in state:
+            shards = _live(state.pop('s'))
+            if shards is None:
+                # Malformed: pin to the default master, as 'y' does.
+                state = {}
+            else:
+                request._multidb_pinned_shards = shards
+                set_this_thread_pinned_shards(shards)
+                # Unless 'm' says so, the prior requests only pinned shards.
+                if state.pop('m', None) is None and not state:
+                    state = None
+        # What prior requests left about the default master.
+        request._multidb_prior_state = state
+        if state is not None and 't' in state \
+                and settings.MULTIDB_TABLE_PINNING:
+            # None (a plain pin) if the tables are malformed.
+            request._multidb_pinned_tables = _live(state['t'])
+        elif state is not None:
+            request._multidb_pinned_tables = None
+        lazy = this_thread_has_db_write_set() and settings.MULTIDB_LAZY_PINNING
+        if this_thread_has_db_write_set() and not lazy:
+            pin_this_thread('post')
+        elif state is not None and 'p' in state \
+                and positions.get_backend() is not None:
+            # We know how far the prior request wrote; slaves that have
+            # replayed that far are as good as the master.
+            set_this_thread_write_position(state['p'])
+        elif request._multidb_pinned_tables:
+            # Prior requests wrote these tables only.
+            set_this_thread_pinned_tables(request._multidb_pinned_tables)
+        elif state is not None and request._multidb_pinned_tables is None:
+            pin_this_thread(request._multidb_pinned_by)
+        if lazy and not this_thread_is_pinned():
+            # Stay on the slaves until the view writes.
+            pin_this_thread_on_write('post')
+        if settings.MULTIDB_STICKY_SLAVE:
+            stick_this_thread()
 
     def process_view(self, request, view_func, view_args, view_kwargs):
         """Pin the thread if the current view is in MULTIDB_PINNING_VIEWS."""
         set_db_write_for_this_thread_if_needed(request, view_func)
-        if this_thread_has_db_write_set():
-            pin_this_thread()
+        if not this_thread_has_db_write_set():
+            return
+        if not settings.MULTIDB_LAZY_PINNING:
+            pin_this_thread('view')
+        elif this_thread_pins_on_write() is None \
+                and not this_thread_is_pinned():
+            pin_this_thread_on_write('view')
+
+    def _pin_next_requests(self, request, response, master=True):
+        """Pin the next requests to the shards written, and to the default
+        master if ``master`` is true."""
+        seconds = pinning_seconds()
+        now = time.time()
+        state = {}
+        # Only worth a query if the default master may have been written.
+        position = positions.master_position(DEFAULT_DB_ALIAS) \
+            if master else None
+        tables = getattr(request, '_multidb_pinned_tables', None)
+        written = this_thread_written_tables()
+        if not master:
+            # Keep what the prior requests left about the default master.
+            state = getattr(request, '_multidb_prior_state', None)
+            if state is not None and tables:
+                state = dict(state, t=tables)
+        elif position is not None:
+            state['p'] = position
+        elif written and tables is not None:
+            # Only pin the reads of the tables written, by this request and
+            # the prior ones.
+            tables = dict(tables)
+            for table in written:
+                tables[table] = int(now + seconds) + 1
+            if len(tables) <= MAX_PINNED_TABLES:
+                state['t'] = tables
+                seconds = max(tables.values()) - int(now)
+        shards = dict(getattr(request, '_multidb_pinned_shards', {}))
+        for shard in this_thread_written_shards() or ():
+            shards[shard] = int(now + seconds) + 1
+        if shards:
+            if state is None:
+                state = {}
+                seconds = 0
+            elif not state:
+                state = {'m': 1}
+            state['s'] = shards
+            seconds = max(seconds, max(shards.values()) - int(now))
+        value = tokens.dumps(state)
 
-    def _pin_next_requests(self, request, response):
         # Set the cookie anyway
-        response.set_cookie(settings.MULTIDB_PINNING_COOKIE, value='y',
-                            max_age=settings.MULTIDB_PINNING_SECONDS)
+        response.set_cookie(settings.MULTIDB_PINNING_COOKIE, value=value,
+                            max_age=seconds)
 
+        # Keep the state on the server for clients we can identify.
+        keys = identity.request_keys(request)
+        if keys:
+            cache = get_cache(settings.MULTIDB_PINNING_KEY_CACHE)
+            cache.set_many(dict((key, value) for key in keys), seconds)
         # If there's suspicion we are cookieless, try to set cache as well
-        if settings.MULTIDB_COOKIELESS_CACHE \
+        elif settings.MULTIDB_COOKIELESS_CACHE \
                 and settings.MULTIDB_COOKIELESS_COOKIE not in request.COOKIES:
+            fingerprint = self._client_fingerprint(request)
             cache = get_cache(settings.MULTIDB_COOKIELESS_CACHE)
-            cache.set(self._client_fingerprint(request), 'y',
-                      settings.MULTIDB_PINNING_SECONDS)
+            cache.set(fingerprint, value, seconds)
+            local_cache = get_local_cache()
+            if local_cache is not None:
+                local_cache.set(fingerprint, value, seconds)
 
     def process_response(self, request, response):
         # If there is reason to think there was a DB write, pin the next
         # requests
-        if this_thread_has_db_write_set() or getattr(response, '_db_write',
-                                                     False):
-            self._pin_next_requests(request, response)
+        if settings.MULTIDB_PIN_ONLY_ON_WRITES:
+            # POSTs and MULTIDB_PINNING_VIEWS only pinned this request.
+            wrote = this_thread_has_written()
+        else:
+            wrote = this_thread_has_db_write_set() \
+                or bool(this_thread_written_tables())
+        wrote = wrote or getattr(response, '_db_write', False)
+        if wrote or this_thread_written_shards():
+            self._pin_next_requests(request, response, wrote)
 
         # If we are configured to use client fingerprints, signify that this
         # user is not cookieless
         if settings.MULTIDB_COOKIELESS_CACHE:
             response.set_cookie(settings.MULTIDB_COOKIELESS_COOKIE, value='y')
 
+        # Let the next request this thread serves pick its own slave
+        unstick_this_thread()
+        # Reads outside of requests have no failover budget
+        set_this_thread_failover_budget(None)
+        set_this_thread_written_tables(None)
+        set_this_thread_written_shards(None)
+        pin_this_thread_on_write(None)
         return response
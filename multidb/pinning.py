@@ -1,28 +1,129 @@
 from functools import wraps
 import threading
 
-from multidb.conf import settings
+from multidb import stats
+from multidb.policy import get_policy
+
+try:
+    from contextvars import ContextVar
+except ImportError:  # Python < 3.7
+    ContextVar = None
 
 
 __all__ = ['this_thread_is_pinned', 'pin_this_thread', 'unpin_this_thread',
            'use_master', 'db_write', 'set_db_write_for_this_thread',
            'use_slave', 'unset_db_write_for_this_thread',
            'this_thread_has_db_write_set',
-           'set_db_write_for_this_thread_if_needed']
-
-
-_locals = threading.local()
+           'set_db_write_for_this_thread_if_needed',
+           'this_thread_is_sticky', 'stick_this_thread',
+           'unstick_this_thread', 'this_thread_slave',
+           'set_this_thread_slave', 'use_sticky_slave',
+           'this_thread_write_position', 'set_this_thread_write_position',
+           'this_thread_position_slave', 'set_this_thread_position_slave',
+           'this_thread_failover_budget', 'set_this_thread_failover_budget',
+           'this_thread_pinned_tables', 'set_this_thread_pinned_tables',
+           'this_thread_written_tables', 'set_this_thread_written_tables',
+           'add_this_thread_written_table', 'this_thread_has_written',
+           'set_this_thread_has_written', 'pin_this_thread_on_write',
+           'this_thread_pins_on_write', 'this_thread_shard', 'use_shard',
+           'this_thread_pinned_shards', 'set_this_thread_pinned_shards',
+           'this_thread_written_shards', 'set_this_thread_written_shards',
+           'add_this_thread_written_shard']
+
+
+class _ThreadLocalVar(threading.local):
+    """The part of ``contextvars.ContextVar`` we use, with one value per
+    thread, for Pythons that don't have ``contextvars``."""
+
+    def __init__(self, name, default=None):
+        # Called again in each thread that uses the variable, so that the
+        # value is always set: a missing attribute is slow to look up.
+        self.name = name
+        self.value = default
+
+    def get(self):
+        return self.value
+
+    def set(self, value):
+        self.value = value
+
+
+def _var(name, default):
+    # Context variables are per thread in threaded servers, and per request
+    # (task) under ASGI, where one thread serves many requests at once.
+    if ContextVar is None:
+        return _ThreadLocalVar(name, default=default)
+    return ContextVar(name, default=default)
+
+
+_pinned = _var('multidb_pinned', False)
+_db_write = _var('multidb_db_write', False)
+_sticky = _var('multidb_sticky', False)
+# Slave group name -> alias. Replaced, never mutated, since contexts copied
+# from each other share the value.
+_slaves = _var('multidb_slaves', None)
+_write_position = _var('multidb_write_position', None)
+_position_slaves = _var('multidb_position_slaves', None)
+_failover_budget = _var('multidb_failover_budget', None)
+_pinned_tables = _var('multidb_pinned_tables', frozenset())
+_written_tables = _var('multidb_written_tables', None)
+_has_written = _var('multidb_has_written', False)
+# The reason to pin the thread for at its first write, if it's waiting for one.
+_pin_on_write = _var('multidb_pin_on_write', None)
+_shard = _var('multidb_shard', None)
+_pinned_shards = _var('multidb_pinned_shards', frozenset())
+_written_shards = _var('multidb_written_shards', None)
+# What the context managers below must restore on exit, innermost last.
+_saved = _var('multidb_saved', ())
+
+
+def _get_in(var, group):
+    return (var.get() or {}).get(group)
+
+
+def _set_in(var, group, alias):
+    mapping = dict(var.get() or {})
+    mapping[group] = alias
+    var.set(mapping)
+
+
+def _save(state):
+    _saved.set(_saved.get() + (state,))
+
+
+def _restore():
+    saved = _saved.get()
+    _saved.set(saved[:-1])
+    return saved[-1]
 
 
 def this_thread_is_pinned():
     """Return whether the current thread should send all its reads to the
     master DB."""
-    return getattr(_locals, 'pinned', False)
+    return _pinned.get()
+
+
+def pin_this_thread(reason=None):
+    """Mark this thread as "stuck" to the master for all DB access.
 
+    If the thread wasn't marked and a ``reason`` is given, it's counted (see
+    ``multidb.stats``).
+    """
+    if reason is not None and not _pinned.get():
+        stats.count_pin(reason)
+    _pinned.set(True)
+
+
+def pin_this_thread_on_write(reason):
+    """Pin this thread for ``reason`` once it writes to, or opens a
+    transaction on, the master; ``None`` cancels this."""
+    _pin_on_write.set(reason)
 
-def pin_this_thread():
-    """Mark this thread as "stuck" to the master for all DB access."""
-    _locals.pinned = True
+
+def this_thread_pins_on_write():
+    """Return the reason this thread will be pinned for at its first write,
+    or ``None``."""
+    return _pin_on_write.get()
 
 
 def unpin_this_thread():
@@ -30,21 +131,162 @@ def unpin_this_thread():
 
     If the thread wasn't marked, do nothing.
     """
-    _locals.pinned = False
+    _pinned.set(False)
+
+
+def this_thread_is_sticky():
+    """Return whether the current thread should send all its reads to the
+    same slave."""
+    return _sticky.get()
+
+
+def stick_this_thread():
+    """Make this thread send all its reads to the same slave, chosen at the
+    first read, until ``unstick_this_thread`` is called."""
+    _sticky.set(True)
+    _slaves.set(None)
+
+
+def unstick_this_thread():
+    """Let this thread's reads go to any slave again."""
+    _sticky.set(False)
+    _slaves.set(None)
+
+
+def this_thread_slave(group='default'):
+    """Return the slave of ``group`` this sticky thread is using, or
+    ``None`` if it hasn't read from that group yet."""
+    return _get_in(_slaves, group)
+
+
+def set_this_thread_slave(alias, group='default'):
+    _set_in(_slaves, group, alias)
+
+
+def this_thread_write_position():
+    """Return the master write position this thread's reads must see, or
+    ``None``."""
+    return _write_position.get()
+
+
+def set_this_thread_write_position(position):
+    """Make this thread read from slaves that have replayed the master's
+    write ``position`` (``None``: any slave)."""
+    _write_position.set(position)
+    _position_slaves.set(None)
+
+
+def this_thread_position_slave(group='default'):
+    """Return the database of ``group`` found to have replayed this
+    thread's write position, or ``None`` if none has been looked for yet."""
+    return _get_in(_position_slaves, group)
+
+
+def set_this_thread_position_slave(alias, group='default'):
+    _set_in(_position_slaves, group, alias)
+
+
+def this_thread_failover_budget():
+    """Return how many more times this thread's failed reads may be retried
+    on another database, or ``None`` if there's no limit."""
+    return _failover_budget.get()
+
+
+def set_this_thread_failover_budget(retries):
+    _failover_budget.set(retries)
+
+
+def this_thread_pinned_tables():
+    """Return the set of tables whose reads this thread sends to the
+    master."""
+    return _pinned_tables.get()
+
+
+def set_this_thread_pinned_tables(tables):
+    _pinned_tables.set(frozenset(tables))
+
+
+def this_thread_written_tables():
+    """Return the set of tables this thread has been seen to write, or
+    ``None`` if it isn't keeping track."""
+    return _written_tables.get()
+
+
+def set_this_thread_written_tables(tables):
+    """Start keeping track of the tables this thread writes, starting with
+    ``tables``; ``None`` stops."""
+    _written_tables.set(None if tables is None else frozenset(tables))
+
+
+def add_this_thread_written_table(table):
+    """Note that this thread writes ``table``, and send the reads of that
+    table to the master from now on, if it's keeping track."""
+    written = _written_tables.get()
+    if written is None or table in written:
+        return
+    _written_tables.set(written | frozenset([table]))
+    _pinned_tables.set(_pinned_tables.get() | frozenset([table]))
+
+
+def this_thread_shard():
+    """Return the shard of the queries that don't name one, or ``None``."""
+    return _shard.get()
+
+
+def this_thread_pinned_shards():
+    """Return the set of shards whose reads this thread sends to their
+    masters."""
+    return _pinned_shards.get()
+
+
+def set_this_thread_pinned_shards(shards):
+    _pinned_shards.set(frozenset(shards))
+
+
+def this_thread_written_shards():
+    """Return the set of shards this thread has been seen to write, or
+    ``None`` if it isn't keeping track."""
+    return _written_shards.get()
+
+
+def set_this_thread_written_shards(shards):
+    """Start keeping track of the shards this thread writes, starting with
+    ``shards``; ``None`` stops."""
+    _written_shards.set(None if shards is None else frozenset(shards))
+
+
+def add_this_thread_written_shard(shard):
+    """Note that this thread writes ``shard``, and send the reads from
+    that shard to its master from now on, if it's keeping track."""
+    written = _written_shards.get()
+    if written is None or shard in written:
+        return
+    _written_shards.set(written | frozenset([shard]))
+    _pinned_shards.set(_pinned_shards.get() | frozenset([shard]))
+
+
+def this_thread_has_written():
+    """Return whether this thread has been seen running a write on the
+    master (see ``multidb.wrappers.note_writes``)."""
+    return _has_written.get()
+
+
+def set_this_thread_has_written(written=True):
+    _has_written.set(written)
 
 
 def set_db_write_for_this_thread():
-    _locals.db_write = True
+    _db_write.set(True)
 
 
 def unset_db_write_for_this_thread():
-    _locals.db_write = False
+    _db_write.set(False)
 
 
 def this_thread_has_db_write_set():
     """Return whether the db_write flag is set for the current thread
     (this means we should set the cookie."""
-    return getattr(_locals, 'db_write', False)
+    return _db_write.get()
 
 
 def set_db_write_for_this_thread_if_needed(request, view_func=False):
@@ -60,22 +302,16 @@ def set_db_write_for_this_thread_if_needed(request, view_func=False):
         return
     if not view_func:
         return
-    module = view_func.__module__
-    try:
-        name = view_func.__name__
-    except AttributeError:
-        # view_func doesn't have __name__; it's probably an object view
-        # like django.contrib.syndication.views.Feed().
-        name = view_func.__class__.__name__
-    view_name = module + '.' + name
-    if view_name in settings.MULTIDB_PINNING_VIEWS:
+    if get_policy().is_write(request, view_func):
         set_db_write_for_this_thread()
         return
 
 
 class UseMaster(object):
     """A contextmanager/decorator to use the master database."""
-    old = False
+
+    def __init__(self, reason='use_master'):
+        self.reason = reason
 
     def __call__(self, func):
         @wraps(func)
@@ -85,11 +321,11 @@ class UseMaster(object):
         return decorator
 
     def __enter__(self):
-        self.old = this_thread_is_pinned()
-        pin_this_thread()
+        _save(this_thread_is_pinned())
+        pin_this_thread(self.reason)
 
     def __exit__(self, type, value, tb):
-        if not self.old:
+        if not _restore():
             unpin_this_thread()
 
 use_master = UseMaster()
@@ -99,29 +335,67 @@ class UseSlave(UseMaster):
     """A contextmanager/decorator to use the slave database."""
     "Use this in cases where the usual behavior would be to pin to master,"
     "such as when the request method is POST, but you know you're not doing any writing."
-    old = False
 
     def __enter__(self):
-        self.old = this_thread_is_pinned()
+        _save(this_thread_is_pinned())
         unpin_this_thread()
 
     def __exit__(self, type, value, tb):
-        if self.old:
+        if _restore():
             pin_this_thread()
 
 use_slave = UseSlave()
 
 
+class UseStickySlave(UseMaster):
+    """A contextmanager/decorator to send all reads to the same slave.
+
+    This is what ``MULTIDB_STICKY_SLAVE`` does for each request; use it for
+    units of work outside of HTTP requests, such as tasks.
+    """
+
+    def __enter__(self):
+        _save((this_thread_is_sticky(), _slaves.get()))
+        stick_this_thread()
+
+    def __exit__(self, type, value, tb):
+        sticky, slaves = _restore()
+        _sticky.set(sticky)
+        _slaves.set(slaves)
+
+use_sticky_slave = UseStickySlave()
+
+
+class UseShard(UseMaster):
+    """A context manager/decorator to send the queries that don't name a
+    shard to ``shard``."""
+
+    def __init__(self, shard):
+        self.shard = shard
+
+    def __enter__(self):
+        _save(_shard.get())
+        _shard.set(self.shard)
+
+    def __exit__(self, type, value, tb):
+        _shard.set(_restore())
+
+use_shard = UseShard
+
+
 def mark_as_write(response):
     """Mark a response as having done a DB write."""
     response._db_write = True
     return response
 
 
+_use_master_to_write = UseMaster('db_write')
+
+
 def db_write(fn):
     @wraps(fn)
     def _wrapped(*args, **kw):
-        with use_master:
+        with _use_master_to_write:
             response = fn(*args, **kw)
         return mark_as_write(response)
     return _wrapped
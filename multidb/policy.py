@@ -0,0 +1,144 @@
+"""The compiled form of ``MULTIDB_PINNING_VIEWS``.
+
+Each rule in the setting is one of:
+
+* the full dotted name of a view, like ``'myapp.views.edit'``;
+* a glob pattern over such names, like ``'myapp.views.*'`` (a prefix) or
+  ``'*.edit_*'``;
+* ``'url:'`` followed by a URL name, or a glob pattern over URL names, which
+  include their namespaces: ``'url:edit-profile'``, ``'url:admin:*'``;
+
+optionally preceded by a comma-separated list of HTTP methods and a space,
+like ``'GET,HEAD myapp.views.feed'``, to make the rule apply to those methods
+only.
+
+The rules are compiled once, and the decision for each view function (and
+URL name) is cached, so that deciding costs a dict lookup per request.
+"""
+from fnmatch import translate
+import re
+
+from multidb.conf import settings
+from multidb.utils import setting_changed
+
+
+__all__ = ['view_name', 'PinningPolicy', 'get_policy']
+
+
+# Any HTTP method
+ALL = '*'
+NONE = frozenset()
+
+# Bounds the caches, in case views are created on the fly.
+MAX_CACHED = 10000
+
+_policy = None
+
+
+def view_name(view_func):
+    """Return the name of a view as used in ``MULTIDB_PINNING_VIEWS``."""
+    module = view_func.__module__
+    try:
+        name = view_func.__name__
+    except AttributeError:
+        # view_func doesn't have __name__; it's probably an object view
+        # like django.contrib.syndication.views.Feed().
+        name = view_func.__class__.__name__
+    return module + '.' + name
+
+
+def _union(methods, more):
+    if methods is ALL or more is ALL:
+        return ALL
+    return methods | more
+
+
+class _Rules(object):
+    """The rules for one kind of name (view names or URL names)."""
+
+    def __init__(self):
+        self.exact = {}
+        self.patterns = []
+
+    def add(self, pattern, methods):
+        if any(char in pattern for char in '*?['):
+            self.patterns.append((re.compile(translate(pattern)), methods))
+        else:
+            self.exact[pattern] = _union(self.exact.get(pattern, NONE),
+                                         methods)
+
+    def methods(self, name):
+        """Return the methods for which ``name`` is a write: ``ALL`` or a
+        frozenset."""
+        methods = self.exact.get(name, NONE)
+        for regex, more in self.patterns:
+            if regex.match(name):
+                methods = _union(methods, more)
+        return methods
+
+    def __bool__(self):
+        return bool(self.exact or self.patterns)
+    __nonzero__ = __bool__
+
+
+class PinningPolicy(object):
+    """Decides whether a request to a view should be assumed to write."""
+
+    def __init__(self, rules):
+        self.views = _Rules()
+        self.urls = _Rules()
+        for rule in rules:
+            methods = ALL
+            parts = rule.split()
+            if len(parts) == 2:
+                methods = frozenset(method.upper()
+                                    for method in parts[0].split(','))
+            name = parts[-1]
+            if name.startswith('url:'):
+                self.urls.add(name[4:], methods)
+            else:
+                self.views.add(name, methods)
+        self._view_methods = {}
+        self._url_methods = {}
+
+    def _remember(self, cache, key, methods):
+        if len(cache) >= MAX_CACHED:
+            cache.clear()
+        cache[key] = methods
+        return methods
+
+    def is_write(self, request, view_func):
+        """Return whether ``request``, to be handled by ``view_func``,
+        should be assumed to write."""
+        methods = self._view_methods.get(view_func)
+        if methods is None:
+            methods = self._remember(
+                self._view_methods, view_func,
+                self.views.methods(view_name(view_func)))
+        if methods is ALL or request.method in methods:
+            return True
+        match = getattr(request, 'resolver_match', None)
+        if not self.urls or match is None:
+            return False
+        name = match.view_name
+        methods = self._url_methods.get(name)
+        if methods is None:
+            methods = self._remember(self._url_methods, name,
+                                     self.urls.methods(name))
+        return methods is ALL or request.method in methods
+
+
+def get_policy():
+    """Return the policy compiled from ``MULTIDB_PINNING_VIEWS``."""
+    global _policy
+    if _policy is None:
+        _policy = PinningPolicy(settings.MULTIDB_PINNING_VIEWS)
+    return _policy
+
+
+def _setting_changed(sender, setting, **kwargs):
+    global _policy
+    if setting == 'MULTIDB_PINNING_VIEWS':
+        _policy = None
+
+setting_changed.connect(_setting_changed)
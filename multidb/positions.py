@@ -0,0 +1,123 @@
+"""Write positions: how far the master has written, and whether a slave has
+replayed that far.
+
+``MULTIDB_WRITE_POSITIONS`` is the dotted path of a ``WritePositions``
+subclass. When it is set, ``PinningRouterMiddleware`` remembers the master's
+position after a write instead of pinning the client to the master, and the
+client's next reads go to any slave that has caught up with it.
+"""
+import logging
+
+from django.db import connections
+
+from multidb.conf import settings
+from multidb.utils import import_object
+
+
+__all__ = ['WritePositions', 'PostgreSQLPositions', 'MySQLPositions',
+           'FakePositions', 'get_backend', 'master_position',
+           'has_replayed']
+
+
+log = logging.getLogger('multidb')
+
+_backends = {}
+
+
+class WritePositions(object):
+    """Base class for write position backends. Positions are strings."""
+
+    def master_position(self, alias):
+        """Return the current write position of the master ``alias``."""
+        raise NotImplementedError
+
+    def has_replayed(self, alias, position):
+        """Return whether the slave ``alias`` has replayed ``position``."""
+        raise NotImplementedError
+
+    def _fetch_value(self, alias, sql, params=()):
+        cursor = connections[alias].cursor()
+        try:
+            cursor.execute(sql, params)
+            row = cursor.fetchone()
+        finally:
+            cursor.close()
+        return None if row is None else row[0]
+
+
+class PostgreSQLPositions(WritePositions):
+    """WAL locations (LSNs) of PostgreSQL 10 or later."""
+
+    def master_position(self, alias):
+        return self._fetch_value(alias, 'SELECT pg_current_wal_lsn()::text')
+
+    def has_replayed(self, alias, position):
+        return bool(self._fetch_value(
+            alias,
+            'SELECT COALESCE(pg_last_wal_replay_lsn() >= %s::pg_lsn, false)',
+            [position]))
+
+
+class MySQLPositions(WritePositions):
+    """GTID sets of MySQL 5.6 or later."""
+
+    def master_position(self, alias):
+        gtids = self._fetch_value(alias, 'SELECT @@GLOBAL.gtid_executed')
+        return None if gtids is None else ''.join(gtids.split())
+
+    def has_replayed(self, alias, position):
+        return bool(self._fetch_value(
+            alias, 'SELECT GTID_SUBSET(%s, @@GLOBAL.gtid_executed)',
+            [position]))
+
+
+class FakePositions(WritePositions):
+    """Positions kept in memory, for tests and databases without
+    replication, like SQLite.
+
+    The master is at ``FakePositions.master``; each slave is at its entry in
+    ``FakePositions.replayed``, or 0.
+    """
+    master = 0
+    replayed = {}
+
+    def master_position(self, alias):
+        return str(FakePositions.master)
+
+    def has_replayed(self, alias, position):
+        return FakePositions.replayed.get(alias, 0) >= int(position)
+
+
+def get_backend():
+    """Return the configured ``WritePositions`` instance, or ``None``."""
+    path = settings.MULTIDB_WRITE_POSITIONS
+    if not path:
+        return None
+    if path not in _backends:
+        _backends[path] = import_object(path)()
+    return _backends[path]
+
+
+def master_position(alias):
+    """Return the write position of the master ``alias``, or ``None`` if
+    positions are not configured or it can't be told."""
+    backend = get_backend()
+    if backend is None:
+        return None
+    try:
+        return backend.master_position(alias)
+    except Exception:
+        log.warning('Getting the write position of database %r failed.',
+                    alias, exc_info=True)
+        return None
+
+
+def has_replayed(alias, position):
+    """Return whether the slave ``alias`` has replayed ``position``; if that
+    can't be told, assume it hasn't."""
+    try:
+        return get_backend().has_replayed(alias, position)
+    except Exception:
+        log.debug('Checking the write position of database %r failed.',
+                  alias, exc_info=True)
+        return False
@@ -0,0 +1,231 @@
+"""A cache of the results of hot reads from slaves.
+
+With ``MULTIDB_QUERY_CACHE`` set to the name of a Django cache, the
+``cache_reads`` execute wrapper keeps the rows of the ``SELECT`` queries run
+on slaves that only read tables of ``MULTIDB_QUERY_CACHE_TABLES``, and
+serves the same queries from memory until they expire.
+
+Results are kept in an in-process LRU cache of ``MULTIDB_QUERY_CACHE_SIZE``
+queries of at most ``MULTIDB_QUERY_CACHE_MAX_ROWS`` rows each, for
+``MULTIDB_QUERY_CACHE_SECONDS``, which can't be longer than
+``MULTIDB_PINNING_SECONDS``. Each table has a version in the Django cache,
+which is part of the keys of the results. ``cache_reads`` also sees the
+``INSERT``, ``UPDATE`` and ``DELETE`` statements run on masters, and
+changes the versions of the tables they write once they are done: at once
+in autocommit mode, or when the transaction commits (on Django 1.9 and
+later; before that, at once too). Every process then stops using the
+results that read the tables. Bumping a version any earlier would let
+another process cache the rows from before the write under the new
+version.
+
+Reads from masters (of pinned threads, for instance) are never cached, so a
+client that wrote still sees its writes. Nor are the reads of threads that
+follow a write position or pinned tables (see ``multidb.positions`` and
+``MULTIDB_TABLE_PINNING``): their slave has replayed their writes, but a
+result cached from a slave that hadn't may carry the new versions. Others
+may see results as old as a slave's; that is what reading from slaves
+already gives.
+"""
+import re
+import threading
+import time
+
+from django.db import transaction
+
+from multidb.conf import settings
+from multidb.lru import LRUCache, MISSING
+from multidb.pinning import (this_thread_pinned_tables,
+                             this_thread_write_position)
+from multidb.utils import get_cache, slave_aliases
+from multidb.wrappers import is_write
+
+
+__all__ = ['tables_of', 'invalidate', 'invalidate_model', 'cache_reads',
+           'get_results_cache']
+
+
+# The tables (or, at worst, other names, which then aren't cached tables)
+# a query reads: the lists after FROM and JOIN, with their aliases.
+_TABLE = r'[`"\[]?[\w.]+[`"\]]?(?:\s+(?:AS\s+)?[`"]?\w+[`"]?)?'
+_TABLES = re.compile(r'\b(?:FROM|JOIN)\s+(%s(?:\s*,\s*%s)*)'
+                     % (_TABLE, _TABLE), re.IGNORECASE)
+_NAME = re.compile(r'(?:^|,)\s*[`"\[]?([\w.]+)')
+# The table a statement writes.
+_WRITTEN = re.compile(r'^\s*(?:INSERT\s+(?:OR\s+\w+\s+)?INTO|REPLACE\s+INTO|'
+                      r'UPDATE|DELETE\s+FROM)\s+[`"\[]?([\w.]+)',
+                      re.IGNORECASE)
+
+_lock = threading.Lock()
+_results = None
+
+
+def get_results_cache():
+    """Return the in-process cache of the results."""
+    global _results
+    size = settings.MULTIDB_QUERY_CACHE_SIZE
+    with _lock:
+        if _results is None or _results.size != size:
+            _results = LRUCache(size)
+        return _results
+
+
+def _seconds():
+    seconds = settings.MULTIDB_QUERY_CACHE_SECONDS
+    if seconds is None:
+        return settings.MULTIDB_PINNING_SECONDS
+    return min(seconds, settings.MULTIDB_PINNING_SECONDS)
+
+
+def _version_key(table):
+    return 'multidb:table:%s' % table
+
+
+def tables_of(sql):
+    """Return the set of the tables ``sql`` reads."""
+    return frozenset(name for tables in _TABLES.findall(sql)
+                     for name in _NAME.findall(tables))
+
+
+def _versions(tables):
+    cache = get_cache(settings.MULTIDB_QUERY_CACHE)
+    keys = [_version_key(table) for table in tables]
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            # Never a version the table had before its key was evicted.
+            cache.add(key, int(time.time() * 1000), None)
+            versions[key] = cache.get(key)
+    return tuple(versions[key] for key in keys)
+
+
+def invalidate(table):
+    """Stop using the results of the queries that read ``table``."""
+    if not settings.MULTIDB_QUERY_CACHE \
+            or table not in settings.MULTIDB_QUERY_CACHE_TABLES:
+        return
+    cache = get_cache(settings.MULTIDB_QUERY_CACHE)
+    try:
+        cache.incr(_version_key(table))
+    except ValueError:
+        cache.set(_version_key(table), int(time.time() * 1000), None)
+
+
+def invalidate_model(model):
+    """Stop using the results of the queries that read the table of
+    ``model``."""
+    if model is not None:
+        invalidate(model._meta.db_table)
+
+
+def _written(connection, sql):
+    """Invalidate the table ``sql`` wrote on ``connection``, once the write
+    is visible to others."""
+    match = _WRITTEN.match(sql)
+    if match is None \
+            or match.group(1) not in settings.MULTIDB_QUERY_CACHE_TABLES:
+        return
+    table = match.group(1)
+    on_commit = getattr(transaction, 'on_commit', None)  # Django 1.9+
+    if on_commit is not None and getattr(connection, 'in_atomic_block',
+                                         False):
+        on_commit(lambda: invalidate(table), using=connection.alias)
+    else:
+        invalidate(table)
+
+
+class _ResultCursor(object):
+    """A cursor that returns ``rows``, then, if ``more``, whatever
+    ``cursor`` has left."""
+
+    def __init__(self, rows, description, cursor, more):
+        self._rows = list(rows)
+        self.description = description
+        self.cursor = cursor
+        self.more = more
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+    def __iter__(self):
+        while True:
+            row = self.fetchone()
+            if row is None:
+                return
+            yield row
+
+    def fetchone(self):
+        if self._rows:
+            return self._rows.pop(0)
+        if self.more:
+            return self.cursor.fetchone()
+        return None
+
+    def fetchmany(self, size=None):
+        if size is None:
+            size = self.cursor.arraysize
+        rows, self._rows = self._rows[:size], self._rows[size:]
+        if len(rows) < size and self.more:
+            rows += list(self.cursor.fetchmany(size - len(rows)))
+        return rows
+
+    def fetchall(self):
+        rows, self._rows = self._rows, []
+        if self.more:
+            rows += list(self.cursor.fetchall())
+        return rows
+
+
+def _key(alias, sql, params, versions):
+    if isinstance(params, dict):
+        params = tuple(sorted(params.items()))
+    elif params is not None:
+        params = tuple(params)
+    # The alias, so that slaves of different shards, which have different
+    # rows in the same tables, don't share results.
+    key = (alias, sql, params, versions)
+    hash(key)
+    return key
+
+
+def cache_reads(execute, sql, params, many, context):
+    """An execute wrapper that serves repeated reads from slaves from the
+    cache, and invalidates the tables written on masters."""
+    connection = context['connection']
+    if isinstance(context['cursor'].cursor, _ResultCursor):
+        # The cursor runs another query: the rows of the last one are gone.
+        context['cursor'].cursor = context['cursor'].cursor.cursor
+    if connection.alias not in slave_aliases():
+        result = execute(sql, params, many, context)
+        if is_write(sql):
+            _written(connection, sql)
+        return result
+    if many or sql.lstrip()[:6].upper() != 'SELECT' \
+            or getattr(connection, 'in_atomic_block', False) \
+            or this_thread_write_position() is not None \
+            or this_thread_pinned_tables():
+        return execute(sql, params, many, context)
+    tables = tables_of(sql)
+    cached_tables = settings.MULTIDB_QUERY_CACHE_TABLES
+    if not tables or not all(table in cached_tables for table in tables):
+        return execute(sql, params, many, context)
+    try:
+        key = _key(connection.alias, sql, params,
+                   _versions(sorted(tables)))
+    except TypeError:  # Unhashable parameters.
+        return execute(sql, params, many, context)
+    results = get_results_cache()
+    cached = results.get(key)
+    if cached is not MISSING:
+        rows, description = cached
+        context['cursor'].cursor = _ResultCursor(
+            rows, description, context['cursor'].cursor, False)
+        return context['cursor'].cursor
+    result = execute(sql, params, many, context)
+    cursor = context['cursor'].cursor
+    max_rows = settings.MULTIDB_QUERY_CACHE_MAX_ROWS
+    rows = tuple(cursor.fetchmany(max_rows + 1))
+    if len(rows) <= max_rows:
+        results.set(key, (rows, cursor.description), _seconds())
+    context['cursor'].cursor = _ResultCursor(rows, cursor.description,
+                                             cursor, True)
+    return result
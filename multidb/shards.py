@@ -0,0 +1,86 @@
+"""Shards: several masters, each with its own slaves.
+
+``MULTIDB_SHARDS`` maps the name of each shard to its ``MASTER`` alias, its
+``SLAVES`` and optionally their ``BALANCER``. A query goes to a shard if
+
+* the router hints name it: ``Book.objects.db_manager(hints={'shard':
+  'eu'})``;
+* the instance in the hints was loaded from one of the shard's databases;
+* ``MULTIDB_SHARD_FUNCTION``, called with the model and the hints, returns
+  its name; or
+* it runs in ``use_shard(name)``.
+
+Other queries go to ``DEFAULT_DB_ALIAS`` and its slaves.
+
+The shards are part of the routing table of ``multidb.groups``, which
+``multidb.groups.build()`` replaces.
+"""
+from multidb import groups
+from multidb.conf import settings
+from multidb.pinning import this_thread_shard
+from multidb.utils import import_object
+
+
+__all__ = ['Shard', 'prepare', 'get_shard', 'shard_for', 'shard_of_alias']
+
+
+class Shard(object):
+
+    def __init__(self, name, master, slaves):
+        self.name = name
+        self.master = master
+        self.slaves = list(slaves)
+        # The SlaveGroup of the slaves.
+        self.group = groups.shard_group(name)
+
+
+def prepare():
+    """Return the shards by name, the shards by alias (of their masters and
+    slaves) and ``MULTIDB_SHARD_FUNCTION``, as the settings describe them,
+    for the routing table."""
+    shards = {}
+    aliases = {}
+    for name, options in settings.MULTIDB_SHARDS.items():
+        shard = Shard(name, options['MASTER'], options.get('SLAVES', ()))
+        shards[name] = shard
+        for alias in [shard.master] + shard.slaves:
+            aliases[alias] = shard
+    function = settings.MULTIDB_SHARD_FUNCTION
+    return shards, aliases, import_object(function) if function else None
+
+
+def get_shard(name):
+    """Return the ``Shard`` called ``name``."""
+    return groups._table[3][0][name]
+
+
+def shard_of_alias(alias):
+    """Return the ``Shard`` ``alias`` belongs to, or ``None``."""
+    return groups._table[3][1].get(alias)
+
+
+def shard_for(model, hints):
+    """Return the ``Shard`` of a query of ``model`` with the router
+    ``hints``, or ``None``. Raise ``ValueError`` if they name a shard that
+    isn't in ``MULTIDB_SHARDS``."""
+    shards, aliases, function = groups._table[3]
+    if not shards:
+        return None
+    name = hints.get('shard')
+    if name is None:
+        instance = hints.get('instance')
+        db = getattr(getattr(instance, '_state', None), 'db', None)
+        if db in aliases:
+            return aliases[db]
+        if function is not None:
+            name = function(model, **hints)
+        if name is None:
+            name = this_thread_shard()
+    if name is None:
+        return None
+    try:
+        return shards[name]
+    except KeyError:
+        raise ValueError('Unknown shard %r; MULTIDB_SHARDS has %s.'
+                         % (name, ', '.join(repr(known)
+                                            for known in sorted(shards))))
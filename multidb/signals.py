@@ -0,0 +1,19 @@
+from django.dispatch import Signal
+
+
+# Sent when a router picks a database. Arguments: operation ('read' or
+# 'write'), alias, model.
+db_routed = Signal()
+
+# Sent when the current thread (or context) gets pinned to the master.
+# Arguments: reason ('cookie', 'cookieless', 'identity', 'post', 'view',
+# 'use_master', 'db_write' or 'task').
+pinned = Signal()
+
+# Sent when a read skips a slave that runs MULTIDB_MAX_IN_FLIGHT queries.
+# Arguments: alias, group.
+read_rejected = Signal()
+
+# Sent when multidb.topology.update() changes the slaves or shards.
+# Arguments: added, removed (sets of aliases).
+topology_changed = Signal()
@@ -0,0 +1,164 @@
+"""Routing and pinning statistics of this process.
+
+Signals (see ``multidb.signals``) are always sent. Counters and query latency
+histograms are only kept when ``MULTIDB_STATS`` is set; the histograms are
+collected by the ``time_queries`` execute wrapper.
+"""
+import bisect
+import threading
+import time
+
+from multidb.conf import settings
+from multidb.signals import db_routed, pinned, read_rejected
+from multidb.utils import setting_changed
+
+
+__all__ = ['count_route', 'count_pin', 'count_rejection', 'time_queries',
+           'snapshot', 'reset', 'prometheus_text', 'LATENCY_BUCKETS']
+
+
+# Upper bounds, in seconds, of the latency histogram buckets; the last
+# bucket (infinity) is implied.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0)
+
+_lock = threading.Lock()
+_routes = {}
+_pins = {}
+_rejections = {}
+_latencies = {}
+
+
+def _read_enabled():
+    # MULTIDB_STATS, read once rather than for every query routed.
+    global _enabled
+    _enabled = bool(settings.MULTIDB_STATS)
+
+_read_enabled()
+
+
+def count_route(sender, operation, alias, model):
+    """Record that ``sender`` sent a ``operation`` of ``model`` to
+    ``alias``."""
+    if _enabled:
+        key = operation, alias
+        with _lock:
+            _routes[key] = _routes.get(key, 0) + 1
+    if db_routed.receivers:  # Sending to no one takes time too.
+        db_routed.send(sender=sender, operation=operation, alias=alias,
+                       model=model)
+
+
+def count_pin(reason):
+    """Record that the current thread got pinned because of ``reason``."""
+    if _enabled:
+        with _lock:
+            _pins[reason] = _pins.get(reason, 0) + 1
+    pinned.send(sender=None, reason=reason)
+
+
+def count_rejection(alias, group):
+    """Record that a read of ``group`` skipped ``alias`` because it was
+    running too many queries."""
+    if _enabled:
+        with _lock:
+            _rejections[alias] = _rejections.get(alias, 0) + 1
+    read_rejected.send(sender=None, alias=alias, group=group)
+
+
+class _Histogram(object):
+
+    def __init__(self):
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def add(self, seconds):
+        self.buckets[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+
+def time_queries(execute, sql, params, many, context):
+    """An execute wrapper that records query latencies per alias."""
+    start = time.time()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        elapsed = time.time() - start
+        alias = context['connection'].alias
+        with _lock:
+            histogram = _latencies.get(alias)
+            if histogram is None:
+                histogram = _latencies[alias] = _Histogram()
+            histogram.add(elapsed)
+
+
+def snapshot():
+    """Return a copy of the statistics gathered so far::
+
+        {'routes': {('read', 'slave-1'): 12, ...},
+         'pins': {'post': 3, ...},
+         'rejections': {'slave-1': 2, ...},
+         'latencies': {'slave-1': {'buckets': [...], 'count': 12,
+                                   'sum': 0.034}, ...}}
+
+    ``buckets`` has one count per bound in ``LATENCY_BUCKETS``, plus one for
+    slower queries; counts are not cumulative.
+    """
+    with _lock:
+        return {
+            'routes': dict(_routes),
+            'pins': dict(_pins),
+            'rejections': dict(_rejections),
+            'latencies': dict(
+                (alias, {'buckets': list(histogram.buckets),
+                         'count': histogram.count,
+                         'sum': histogram.sum})
+                for alias, histogram in _latencies.items()),
+        }
+
+
+def reset():
+    """Forget the statistics gathered so far."""
+    with _lock:
+        _routes.clear()
+        _pins.clear()
+        _rejections.clear()
+        _latencies.clear()
+
+
+def prometheus_text():
+    """Return the statistics in the Prometheus text exposition format."""
+    stats = snapshot()
+    lines = ['# TYPE multidb_routes_total counter']
+    for (operation, alias), count in sorted(stats['routes'].items()):
+        lines.append('multidb_routes_total{operation="%s",alias="%s"} %d'
+                     % (operation, alias, count))
+    lines.append('# TYPE multidb_pins_total counter')
+    for reason, count in sorted(stats['pins'].items()):
+        lines.append('multidb_pins_total{reason="%s"} %d' % (reason, count))
+    lines.append('# TYPE multidb_rejections_total counter')
+    for alias, count in sorted(stats['rejections'].items()):
+        lines.append('multidb_rejections_total{alias="%s"} %d'
+                     % (alias, count))
+    lines.append('# TYPE multidb_query_seconds histogram')
+    for alias, histogram in sorted(stats['latencies'].items()):
+        cumulative = 0
+        bounds = ['%g' % bound for bound in LATENCY_BUCKETS] + ['+Inf']
+        for bound, count in zip(bounds, histogram['buckets']):
+            cumulative += count
+            lines.append('multidb_query_seconds_bucket{alias="%s",le="%s"} %d'
+                         % (alias, bound, cumulative))
+        lines.append('multidb_query_seconds_sum{alias="%s"} %r'
+                     % (alias, histogram['sum']))
+        lines.append('multidb_query_seconds_count{alias="%s"} %d'
+                     % (alias, histogram['count']))
+    return '\n'.join(lines) + '\n'
+
+
+def _setting_changed(sender, setting, **kwargs):
+    if setting == 'MULTIDB_STATS':
+        _read_enabled()
+
+setting_changed.connect(_setting_changed)
@@ -0,0 +1,128 @@
+"""Carrying the pinning state of a request over to the tasks it queues.
+
+``pinning_state()`` describes, as a short string, how fresh the data read by
+the current thread has to be: all of it (after a write), that of some tables
+(see ``MULTIDB_TABLE_PINNING``) or shards (see ``multidb.shards``), or as of
+a write position (see ``MULTIDB_WRITE_POSITIONS``).
+``use_pinning_state(state)`` makes another thread, typically a task worker or
+a management command, read as fresh data, until ``MULTIDB_PINNING_SECONDS``
+after the state was taken.
+
+``pinning_kwargs()`` and ``pinned_task`` pass the state as a keyword argument
+of a task::
+
+    @app.task
+    @pinned_task
+    def send_receipt(order_id):
+        ...
+
+    send_receipt.delay(order.id, **pinning_kwargs())
+"""
+from functools import wraps
+import time
+
+from multidb import DEFAULT_DB_ALIAS, positions, tokens
+from multidb.conf import settings
+from multidb.pinning import (this_thread_is_pinned, pin_this_thread,
+                             unpin_this_thread, this_thread_has_db_write_set,
+                             this_thread_has_written,
+                             this_thread_pinned_tables,
+                             set_this_thread_pinned_tables,
+                             this_thread_write_position,
+                             set_this_thread_write_position,
+                             this_thread_pinned_shards,
+                             set_this_thread_pinned_shards)
+
+
+__all__ = ['STATE_KWARG', 'pinning_state', 'UsePinningState',
+           'use_pinning_state', 'pinning_kwargs', 'pinned_task']
+
+
+# The keyword argument pinning_kwargs() and pinned_task() pass the state in.
+STATE_KWARG = 'multidb_pinning_state'
+
+
+def pinning_state():
+    """Return the pinning state of the current thread as a string, or
+    ``None`` if it may read from any slave."""
+    state = {'w': int(time.time())}
+    if this_thread_is_pinned() or this_thread_has_db_write_set() \
+            or this_thread_has_written():
+        position = positions.master_position(DEFAULT_DB_ALIAS)
+        if position is not None:
+            state['p'] = position
+        else:
+            state['m'] = 1
+    elif this_thread_pinned_tables():
+        state['t'] = sorted(this_thread_pinned_tables())
+    elif this_thread_write_position() is not None:
+        state['p'] = this_thread_write_position()
+    elif not this_thread_pinned_shards():
+        return None
+    if this_thread_pinned_shards():
+        state['s'] = sorted(this_thread_pinned_shards())
+    return tokens.dumps(state)
+
+
+class UsePinningState(object):
+    """A context manager/decorator to read as fresh data as the thread that
+    took ``state`` with ``pinning_state()`` did. ``None`` and expired states
+    change nothing."""
+
+    def __init__(self, state):
+        self.state = state
+
+    def __call__(self, func):
+        @wraps(func)
+        def decorator(*args, **kw):
+            # A new instance for each call, since they may overlap.
+            with UsePinningState(self.state):
+                return func(*args, **kw)
+        return decorator
+
+    def __enter__(self):
+        self._saved = (this_thread_is_pinned(), this_thread_pinned_tables(),
+                       this_thread_write_position(),
+                       this_thread_pinned_shards())
+        state = tokens.loads(self.state) if self.state else {}
+        taken = state.get('w', 0)
+        if taken + settings.MULTIDB_PINNING_SECONDS <= time.time():
+            return
+        if 's' in state:
+            set_this_thread_pinned_shards(this_thread_pinned_shards() |
+                                          frozenset(state['s']))
+        if 't' in state:
+            set_this_thread_pinned_tables(this_thread_pinned_tables() |
+                                          frozenset(state['t']))
+        elif 'p' in state and positions.get_backend() is not None:
+            set_this_thread_write_position(state['p'])
+        elif 's' not in state or 'm' in state or 'p' in state:
+            pin_this_thread('task')
+
+    def __exit__(self, type, value, tb):
+        pinned, tables, position, shards = self._saved
+        if not pinned:
+            unpin_this_thread()
+        set_this_thread_pinned_tables(tables)
+        set_this_thread_pinned_shards(shards)
+        if position != this_thread_write_position():
+            set_this_thread_write_position(position)
+
+use_pinning_state = UsePinningState
+
+
+def pinning_kwargs():
+    """Return the keyword arguments to pass the pinning state of the current
+    thread to a ``pinned_task``."""
+    state = pinning_state()
+    return {STATE_KWARG: state} if state else {}
+
+
+def pinned_task(func):
+    """Decorate a task to run with the pinning state passed to it by
+    ``pinning_kwargs()``."""
+    @wraps(func)
+    def _wrapped(*args, **kw):
+        with UsePinningState(kw.pop(STATE_KWARG, None)):
+            return func(*args, **kw)
+    return _wrapped
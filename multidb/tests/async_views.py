@@ -0,0 +1,46 @@
+"""Async views and helpers for the tests of ``multidb.asgi``, which need
+Python 3 and Django 3.1 or later."""
+import asyncio
+from types import SimpleNamespace
+
+from django.utils.asyncio import async_unsafe
+from django.utils.functional import SimpleLazyObject
+
+from multidb.asgi import AsyncPinningRouterMiddleware
+from multidb.positions import FakePositions
+from multidb.tests.views import _pinned
+
+
+async def async_dummy_view(request):
+    # Let the other requests run, as a view waiting for I/O would.
+    await asyncio.sleep(0)
+    return _pinned()
+
+
+class SyncOnlyPositions(FakePositions):
+    """Positions that, like those of real databases, can't be read from the
+    event loop."""
+
+    @async_unsafe
+    def master_position(self, alias):
+        return super().master_position(alias)
+
+
+def lazy_user(pk):
+    """Return a user that, like ``request.user`` of Django's authentication
+    middleware, is loaded from the database on first use."""
+    @async_unsafe
+    def load():
+        return SimpleNamespace(pk=pk, is_authenticated=True)
+    return SimpleLazyObject(load)
+
+
+def run(*requests, view=async_dummy_view):
+    """Return the responses of ``AsyncPinningRouterMiddleware`` to
+    ``requests``, served concurrently on an event loop."""
+    middleware = AsyncPinningRouterMiddleware(view)
+
+    async def serve():
+        return await asyncio.gather(*[middleware(request)
+                                      for request in requests])
+    return asyncio.run(serve())
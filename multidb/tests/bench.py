@@ -0,0 +1,184 @@
+"""Benchmarks of the router and middleware hot paths.
+
+Run them with ``./run.sh bench``; see ``./run.sh bench --help`` for the
+options. They use the SQLite databases and the locmem cache of
+``test_settings`` and never touch a database, so the numbers only depend on
+this code, the Python and Django versions and the machine; run them on the
+same machine to compare commits::
+
+    ./run.sh bench --json > before.json
+    git checkout other-branch
+    ./run.sh bench --json > after.json
+
+Each benchmark is run ``--repeat`` times in each of ``--threads`` threads
+(the default, ``1,8``, measures one thread, then eight at once, to show
+contention on shared state like the balancers' counters); the best run is
+reported as the wall time per call.
+"""
+import json
+from optparse import OptionParser
+import sys
+import threading
+import time
+
+import django
+if hasattr(django, 'setup'):
+    django.setup()
+
+from django.http import HttpRequest, HttpResponse
+from django.test.utils import override_settings
+
+from multidb import MasterSlaveRouter, PinningMasterSlaveRouter
+from multidb.conf import settings
+from multidb.middleware import PinningRouterMiddleware, get_local_cache
+from multidb.pinning import (pin_this_thread, unpin_this_thread,
+                             use_master)
+from multidb.tests.views import dummy_view
+
+
+# Routing never connects to the slaves, so they don't need to exist.
+SLAVES = ['slave', 'slave-2', 'slave-3']
+
+
+def _request(method='GET', cookies=None):
+    request = HttpRequest()
+    request.method = method
+    request.META['REMOTE_ADDR'] = '127.0.0.1'
+    request.META['HTTP_USER_AGENT'] = 'bench'
+    request.COOKIES.update(cookies or {})
+    return request
+
+
+def _middleware_round_trip(request):
+    middleware = PinningRouterMiddleware()
+    response = HttpResponse()
+
+    def round_trip():
+        middleware.process_request(request)
+        middleware.process_view(request, dummy_view, (), {})
+        middleware.process_response(request, response)
+    return round_trip
+
+
+def read():
+    return MasterSlaveRouter().db_for_read, (None,)
+
+
+def pinning_read():
+    unpin_this_thread()
+    return PinningMasterSlaveRouter().db_for_read, (None,)
+
+
+def pinned_read():
+    pin_this_thread()
+    return PinningMasterSlaveRouter().db_for_read, (None,)
+
+
+def write():
+    return PinningMasterSlaveRouter().db_for_write, (None,)
+
+
+def use_master_block():
+    def block():
+        with use_master:
+            pass
+    return block, ()
+
+
+def middleware_get():
+    return _middleware_round_trip(_request()), ()
+
+
+def middleware_pinned_get():
+    cookies = {settings.MULTIDB_PINNING_COOKIE: 'y'}
+    return _middleware_round_trip(_request(cookies=cookies)), ()
+
+
+def middleware_post():
+    return _middleware_round_trip(_request('POST')), ()
+
+
+def middleware_cookieless():
+    return _middleware_round_trip(_request()), ()
+
+
+# name -> (function returning a callable and its arguments, settings)
+BENCHMARKS = [
+    ('read', read, {}),
+    ('pinning_read', pinning_read, {}),
+    ('pinned_read', pinned_read, {}),
+    ('write', write, {}),
+    ('use_master', use_master_block, {}),
+    ('middleware_get', middleware_get, {}),
+    ('middleware_pinned_get', middleware_pinned_get, {}),
+    ('middleware_post', middleware_post, {}),
+    ('middleware_cookieless', middleware_cookieless,
+     {'MULTIDB_COOKIELESS_CACHE': 'default'}),
+    ('middleware_cookieless_local', middleware_cookieless,
+     {'MULTIDB_COOKIELESS_CACHE': 'default',
+      'MULTIDB_COOKIELESS_LOCAL_SIZE': 1000}),
+]
+
+
+def _loop(setup, number):
+    func, args = setup()
+    for _ in range(number):
+        func(*args)
+
+
+def run(setup, number, threads):
+    """Return the wall time of ``number`` calls in each of ``threads``
+    threads, divided by the total number of calls."""
+    workers = [threading.Thread(target=_loop, args=(setup, number))
+               for _ in range(threads)]
+    start = time.time()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return (time.time() - start) / (number * threads)
+
+
+def main(argv=None):
+    parser = OptionParser(usage='%prog [options] [benchmark ...]')
+    parser.add_option('-n', '--number', type='int', default=10000,
+                      help='calls per thread and run [%default]')
+    parser.add_option('-r', '--repeat', type='int', default=3,
+                      help='runs of each benchmark [%default]')
+    parser.add_option('-t', '--threads', default='1,8',
+                      help='comma-separated thread counts [%default]')
+    parser.add_option('--json', action='store_true',
+                      help='print the results as JSON')
+    options, names = parser.parse_args(argv)
+    thread_counts = [int(count) for count in options.threads.split(',')]
+    unknown = set(names) - set(name for name, _, _ in BENCHMARKS)
+    if unknown:
+        parser.error('unknown benchmarks: %s' % ', '.join(sorted(unknown)))
+
+    results = []
+    for name, setup, overrides in BENCHMARKS:
+        if names and name not in names:
+            continue
+        overrides = dict(overrides, SLAVE_DATABASES=SLAVES)
+        with override_settings(**overrides):
+            for threads in thread_counts:
+                local_cache = get_local_cache()
+                if local_cache is not None:
+                    local_cache.clear()
+                best = min(run(setup, options.number, threads)
+                           for _ in range(options.repeat))
+                results.append({'name': name, 'threads': threads,
+                                'usec_per_call': best * 1e6})
+                if not options.json:
+                    sys.stdout.write('%-28s %3d threads %10.2f usec/call\n'
+                                     % (name, threads, best * 1e6))
+    if options.json:
+        json.dump({'python': sys.version.split()[0],
+                   'django': django.get_version(),
+                   'results': results}, sys.stdout, indent=2,
+                  sort_keys=True)
+        sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,248 @@
+"""A replication lag simulator, to check read-your-writes and measure how
+many reads the router moves off the master.
+
+Run it with ``./run.sh simulate``; see ``./run.sh simulate --help`` for the
+options. It points ``default`` and ``slave`` of ``test_settings`` at two
+SQLite files in a temporary directory, and copies the master's data to the
+slave in a background thread, ``--lag`` seconds late. Then it replays user
+sessions through ``PinningRouterMiddleware`` and
+``PinningMasterSlaveRouter`` with the Django test client, once for each of
+the ``--pinning-seconds``, and reports:
+
+* the reads that went to the master and to the slave, and the share of
+  them the slave served; and
+* the stale reads: those that didn't return what the same user last wrote.
+
+A session is a list of ``[action, delay]`` steps, where ``action`` is
+``"write"`` or ``"read"`` and ``delay`` the seconds since the session's
+previous step. ``--script`` reads a JSON list of sessions from a file;
+otherwise each of ``--users`` writes ``--writes`` times and reads
+``--reads`` times after each write, ``--think`` seconds apart. The steps of
+all sessions are replayed in the order of their times::
+
+    ./run.sh simulate --lag 1 --pinning-seconds 0,1,2,3
+
+Like browsers, the test client is made to drop the pinning cookie on the
+whole second it expires, so a client can be pinned for up to a second less
+than ``MULTIDB_PINNING_SECONDS``.
+"""
+from collections import deque
+import json
+from optparse import OptionParser
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+import django
+if hasattr(django, 'setup'):
+    django.setup()
+
+from django.db import connections
+from django.http import HttpResponse
+from django.test.client import Client
+from django.test.utils import override_settings
+
+from multidb import PinningMasterSlaveRouter
+from multidb.pinning import unpin_this_thread
+from multidb.tests.test_all import expire_cookies
+
+try:
+    from django.urls import re_path as url
+except ImportError:  # Django < 2.0
+    from django.conf.urls import url
+
+
+SCHEMA = 'CREATE TABLE note (user varchar(40) PRIMARY KEY, value integer)'
+
+
+def note(request, user):
+    """Store the ``value`` POSTed for ``user``, or return the stored one,
+    with the alias of the database used."""
+    router = PinningMasterSlaveRouter()
+    if request.method == 'POST':
+        alias = router.db_for_write(None)
+        cursor = connections[alias].cursor()
+        cursor.execute('DELETE FROM note WHERE user = %s', [user])
+        cursor.execute('INSERT INTO note VALUES (%s, %s)',
+                       [user, int(request.POST['value'])])
+        value = int(request.POST['value'])
+    else:
+        alias = router.db_for_read(None)
+        cursor = connections[alias].cursor()
+        cursor.execute('SELECT value FROM note WHERE user = %s', [user])
+        row = cursor.fetchone()
+        value = row[0] if row else None
+    return HttpResponse(json.dumps({'alias': alias, 'value': value}),
+                        content_type='application/json')
+
+urlpatterns = [url(r'^note/(?P<user>\w+)/$', note)]
+
+
+class Replicator(threading.Thread):
+    """Copies the notes of the ``master`` SQLite file to the ``slave`` one,
+    ``lag`` seconds after they were there."""
+
+    def __init__(self, master, slave, lag):
+        super(Replicator, self).__init__(name='multidb-replicator')
+        self.daemon = True
+        self.master = master
+        self.slave = slave
+        self.lag = lag
+        self._stopped = threading.Event()
+
+    def run(self):
+        master = sqlite3.connect(self.master)
+        slave = sqlite3.connect(self.slave)
+        snapshots = deque()
+        while not self._stopped.is_set():
+            now = time.time()
+            snapshots.append(
+                (now, master.execute('SELECT user, value FROM note')
+                 .fetchall()))
+            rows = None
+            while snapshots and snapshots[0][0] <= now - self.lag:
+                rows = snapshots.popleft()[1]
+            if rows is not None:
+                with slave:
+                    slave.execute('DELETE FROM note')
+                    slave.executemany('INSERT INTO note VALUES (?, ?)', rows)
+            self._stopped.wait(min(0.01, self.lag or 0.01))
+        master.close()
+        slave.close()
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+
+def default_sessions(users, writes, reads, think):
+    session = []
+    for _ in range(writes):
+        session.append(['write', think])
+        session.extend(['read', think] for _ in range(reads))
+    return [session] * users
+
+
+def replay(sessions):
+    """Replay ``sessions``; return the numbers of reads from the master and
+    the slave, and of stale reads."""
+    steps = []
+    for user, session in enumerate(sessions):
+        at = 0
+        for action, delay in session:
+            at += delay
+            steps.append((at, 'u%d' % user, action))
+    steps.sort()
+    clients = dict((user, Client()) for _, user, _ in steps)
+    written = {}
+    counts = {'master_reads': 0, 'slave_reads': 0, 'stale_reads': 0}
+    start = time.time()
+    for at, user, action in steps:
+        time.sleep(max(0, start + at - time.time()))
+        client = clients[user]
+        expire_cookies(client.cookies)
+        path = '/note/%s/' % user
+        if action == 'write':
+            written[user] = written.get(user, 0) + 1
+            client.post(path, {'value': written[user]})
+            continue
+        result = json.loads(client.get(path).content.decode('utf-8'))
+        if result['alias'] == 'slave':
+            counts['slave_reads'] += 1
+        else:
+            counts['master_reads'] += 1
+        if result['value'] != written.get(user):
+            counts['stale_reads'] += 1
+    unpin_this_thread()
+    return counts
+
+
+def run(sessions, lag, pinning_seconds):
+    directory = tempfile.mkdtemp(prefix='multidb-simulate-')
+    try:
+        files = {}
+        for alias in ('default', 'slave'):
+            files[alias] = os.path.join(directory, '%s.db' % alias)
+            connection = sqlite3.connect(files[alias])
+            connection.execute(SCHEMA)
+            connection.close()
+            connections[alias].close()
+            connections[alias].settings_dict['NAME'] = files[alias]
+        replicator = Replicator(files['default'], files['slave'], lag)
+        replicator.start()
+        middleware = ('multidb.middleware.PinningRouterMiddleware',)
+        try:
+            with override_settings(ROOT_URLCONF=__name__,
+                                   MIDDLEWARE=middleware,
+                                   MIDDLEWARE_CLASSES=middleware,
+                                   SLAVE_DATABASES=['slave'],
+                                   MULTIDB_PINNING_SECONDS=pinning_seconds):
+                counts = replay(sessions)
+        finally:
+            replicator.stop()
+            for alias in files:
+                connections[alias].close()
+    finally:
+        shutil.rmtree(directory)
+    reads = counts['master_reads'] + counts['slave_reads']
+    counts.update(lag=lag, pinning_seconds=pinning_seconds, reads=reads,
+                  offload=float(counts['slave_reads']) / reads if reads
+                  else 0.0)
+    return counts
+
+
+def main(argv=None):
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--lag', type='float', default=0.5,
+                      help='replication lag, in seconds [%default]')
+    parser.add_option('-p', '--pinning-seconds', default='0,1,2',
+                      help='comma-separated values of '
+                           'MULTIDB_PINNING_SECONDS [%default]')
+    parser.add_option('--script', help='a JSON file of sessions')
+    parser.add_option('-u', '--users', type='int', default=5,
+                      help='sessions [%default]')
+    parser.add_option('-w', '--writes', type='int', default=2,
+                      help='writes per session [%default]')
+    parser.add_option('-r', '--reads', type='int', default=4,
+                      help='reads after each write [%default]')
+    parser.add_option('-t', '--think', type='float', default=0.25,
+                      help='seconds between the steps of a session '
+                           '[%default]')
+    parser.add_option('--json', action='store_true',
+                      help='print the results as JSON')
+    options, args = parser.parse_args(argv)
+    if args:
+        parser.error('unexpected arguments: %s' % ' '.join(args))
+    if options.script:
+        with open(options.script) as script:
+            sessions = json.load(script)
+    else:
+        sessions = default_sessions(options.users, options.writes,
+                                    options.reads, options.think)
+
+    results = []
+    for seconds in options.pinning_seconds.split(','):
+        result = run(sessions, options.lag, float(seconds))
+        results.append(result)
+        if not options.json:
+            sys.stdout.write(
+                'lag %.2fs, pinning %.2fs: %d reads, %d from the master, '
+                '%d from the slave (%.0f%% offloaded), %d stale\n'
+                % (result['lag'], result['pinning_seconds'],
+                   result['reads'], result['master_reads'],
+                   result['slave_reads'], result['offload'] * 100,
+                   result['stale_reads']))
+    if options.json:
+        json.dump({'python': sys.version.split()[0],
+                   'django': django.get_version(),
+                   'results': results}, sys.stdout, indent=2,
+                  sort_keys=True)
+        sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,30 +1,106 @@
-from datetime import datetime
+from email.utils import mktime_tz, parsedate_tz
+import json
+import os
+import tempfile
+import threading
 import time
 
+import django
 from django.http import HttpRequest, HttpResponse
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase
 from django.test.client import Client
 from django.test.utils import override_settings
 
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.db import DatabaseError, connections, transaction
+from django.db.utils import OperationalError
+
+try:
+    from unittest import skipIf
+except ImportError:  # Python 2.6
+    from django.utils.unittest import skipIf
+
 from multidb import (DEFAULT_DB_ALIAS, MasterSlaveRouter,
-                     PinningMasterSlaveRouter, get_slave)
+                     PinningMasterSlaveRouter, get_slave, health, lag,
+                     wrappers)
+from multidb.balancers import (RoundRobinBalancer, WeightedRoundRobinBalancer,
+                               LeastOutstandingBalancer,
+                               PowerOfTwoChoicesBalancer)
 from multidb.conf import settings
-from multidb.middleware import PinningRouterMiddleware
+from multidb import (failover, groups, hedging, identity, limits, querycache,
+                     shards, stats, tokens, topology, warmup, zones)
+from multidb.utils import slave_aliases
+from multidb.signals import (db_routed, pinned, read_rejected,
+                             topology_changed)
+from multidb.middleware import (PinningRouterMiddleware, get_local_cache,
+                                MAX_PINNED_TABLES)
+from multidb.lru import LRUCache, MISSING
+from multidb.policy import PinningPolicy
+from multidb.positions import FakePositions
+from multidb.tests.views import dummy_view, object_dummy_view
+from multidb.tasks import (pinning_state, use_pinning_state, pinning_kwargs,
+                           pinned_task, STATE_KWARG)
+from multidb.views import metrics
 from multidb.pinning import (this_thread_is_pinned, pin_this_thread,
-                             unpin_this_thread, use_master, use_slave, db_write)
+                             unpin_this_thread, use_master, use_slave,
+                             db_write, unset_db_write_for_this_thread,
+                             use_sticky_slave,
+                             this_thread_is_sticky, this_thread_slave,
+                             unstick_this_thread, set_this_thread_slave,
+                             set_this_thread_write_position,
+                             set_this_thread_failover_budget,
+                             this_thread_written_tables,
+                             set_this_thread_written_tables,
+                             set_this_thread_pinned_tables,
+                             this_thread_has_written,
+                             set_this_thread_has_written,
+                             this_thread_pins_on_write,
+                             this_thread_pinned_tables,
+                             this_thread_write_position, use_shard,
+                             set_this_thread_pinned_shards)
+
+if django.VERSION >= (3, 1):
+    from multidb.asgi import AsyncPinningRouterMiddleware
+    from multidb.tests import async_views
+
+
+def fake_model(app_label, object_name):
+    """Return a class that routers can't tell from a model."""
+    class Options(object):
+        pass
+    opts = Options()
+    opts.app_label = app_label
+    opts.object_name = object_name
+    opts.db_table = '%s_%s' % (app_label, object_name.lower())
+    return type(object_name, (object,), {'_meta': opts})
+
+
+def fake_lag(alias):
+    return 0.25
+
+
+def fake_shard_function(model, **hints):
+    return 'us' if model is not None and model._meta.app_label == 'us' \
+        else None
+
+
+class CountingPositions(FakePositions):
+    """FakePositions that count the master positions fetched."""
+    fetched = 0
+
+    def master_position(self, alias):
+        CountingPositions.fetched += 1
+        return super(CountingPositions, self).master_position(alias)
 
 
 def expire_cookies(cookies):
-    cookie_names = cookies.keys()
-    for cookie_name in cookie_names:
-        cookie = cookies[cookie_name]
-        try:
-            cookie_expiration_date = datetime.strptime(
-                cookie['expires'], '%a, %d-%b-%Y %H:%M:%S %Z')
-            if cookie_expiration_date < datetime.utcnow():
-                del cookies[cookie_name]
-        except ValueError:
-            pass
+    for cookie_name in list(cookies.keys()):
+        # Django < 1.9 formats the dates as 'Wed, 21-Oct-2015 07:28:00 GMT',
+        # later versions as 'Wed, 21 Oct 2015 07:28:00 GMT'.
+        expires = parsedate_tz(cookies[cookie_name]['expires'])
+        if expires is not None and mktime_tz(expires) < time.time():
+            del cookies[cookie_name]
 
 
 class MasterSlaveRouterTests(TestCase):
@@ -372,3 +448,1988 @@ class ContextDecoratorTests(TestCase):
                 self.assertFalse(this_thread_is_pinned())
                 raise ValueError
         self.assertTrue(this_thread_is_pinned())
+
+
+class HealthTests(TestCase):
+    """Tests for ejecting unhealthy slaves from the rotation"""
+
+    def tearDown(self):
+        health.reset()
+
+    def test_check(self):
+        self.assertTrue(health.check('slave'))
+        self.assertTrue(health.is_healthy('slave'))
+
+    def test_check_failure(self):
+        self.assertFalse(health.check('nonexistent'))
+
+    @override_settings(MULTIDB_HEALTH_CHECK_FAILURES=2)
+    def test_eject(self):
+        health.record_failure('slave')
+        self.assertEquals(get_slave(), 'slave')
+        health.record_failure('slave')
+        self.assertFalse(health.is_healthy('slave'))
+        self.assertEquals(get_slave(), DEFAULT_DB_ALIAS)
+        self.assertEquals(MasterSlaveRouter().db_for_read(None),
+                          DEFAULT_DB_ALIAS)
+
+    @override_settings(MULTIDB_HEALTH_CHECK_FAILURES=1,
+                       MULTIDB_HEALTH_CHECK_SUCCESSES=2)
+    def test_readmit(self):
+        health.record_failure('slave')
+        self.assertFalse(health.is_healthy('slave'))
+        health.check('slave')
+        self.assertFalse(health.is_healthy('slave'))
+        health.check('slave')
+        self.assertTrue(health.is_healthy('slave'))
+        self.assertEquals(get_slave(), 'slave')
+
+    @override_settings(MULTIDB_HEALTH_CHECK_FAILURES=1,
+                       MULTIDB_HEALTH_CHECK_SUCCESSES=2)
+    def test_failure_resets_successes(self):
+        health.record_failure('slave')
+        health.record_success('slave')
+        health.record_failure('slave')
+        health.record_success('slave')
+        self.assertFalse(health.is_healthy('slave'))
+
+    def test_checker_thread(self):
+        checker = health.start_health_checker(interval=0.01,
+                                              aliases=['nonexistent'])
+        try:
+            self.assertTrue(health.start_health_checker(0.01) is checker)
+            time.sleep(0.1)
+            self.assertFalse(health.is_healthy('nonexistent'))
+        finally:
+            health.stop_health_checker()
+        checker.join(1)
+        self.assertFalse(checker.is_alive())
+
+
+class LagTests(TestCase):
+    """Tests for replication lag aware routing and pinning"""
+
+    def tearDown(self):
+        lag.reset()
+        unpin_this_thread()
+        unset_db_write_for_this_thread()
+
+    @override_settings(MULTIDB_MAX_REPLICATION_LAG=5)
+    def test_skip_lagging_slave(self):
+        lag.record_lag('slave', 4)
+        self.assertEquals(get_slave(), 'slave')
+        lag.record_lag('slave', 6)
+        self.assertEquals(get_slave(), DEFAULT_DB_ALIAS)
+        lag.record_lag('slave', None)
+        self.assertEquals(get_slave(), 'slave')
+
+    def test_no_maximum(self):
+        lag.record_lag('slave', 600)
+        self.assertEquals(get_slave(), 'slave')
+
+    @override_settings(
+        MULTIDB_REPLICATION_LAG_PROBE='multidb.tests.test_all.fake_lag')
+    def test_measure(self):
+        self.assertEquals(lag.measure('slave'), 0.25)
+        self.assertEquals(lag.get_lag('slave'), 0.25)
+
+    def test_measure_without_probe(self):
+        self.assertEquals(lag.measure('slave'), None)
+
+    def test_vendor_lag(self):
+        # There's no built-in probe for SQLite.
+        self.assertEquals(lag.vendor_lag('slave'), None)
+
+    @override_settings(MULTIDB_ADAPTIVE_PINNING=True,
+                       MULTIDB_PINNING_SECONDS=15)
+    def test_pinning_seconds(self):
+        self.assertEquals(lag.pinning_seconds(), 15)
+        lag.record_lag('slave', 0.25)
+        self.assertEquals(lag.pinning_seconds(), 2)
+        lag.record_lag('slave', 60)
+        self.assertEquals(lag.pinning_seconds(), 15)
+
+    @override_settings(MULTIDB_PINNING_SECONDS=15)
+    def test_pinning_seconds_not_adaptive(self):
+        lag.record_lag('slave', 0.25)
+        self.assertEquals(lag.pinning_seconds(), 15)
+
+    @override_settings(MULTIDB_ADAPTIVE_PINNING=True)
+    def test_adaptive_cookie(self):
+        lag.record_lag('slave', 2.5)
+        request = HttpRequest()
+        request.method = 'POST'
+        middleware = PinningRouterMiddleware()
+        middleware.process_request(request)
+        response = middleware.process_response(request, HttpResponse())
+        self.assertEquals(
+            response.cookies[settings.MULTIDB_PINNING_COOKIE]['max-age'], 4)
+
+
+class BalancerTests(TestCase):
+    """Tests for the slave balancing strategies"""
+
+    aliases = ['a', 'b', 'c']
+
+    def choices(self, balancer, n, aliases=None):
+        return [balancer.choose(aliases or self.aliases) for _ in range(n)]
+
+    def test_round_robin(self):
+        balancer = RoundRobinBalancer(self.aliases)
+        self.assertEquals(self.choices(balancer, 6), self.aliases * 2)
+
+    def test_round_robin_subset(self):
+        balancer = RoundRobinBalancer(self.aliases)
+        self.assertEquals(sorted(self.choices(balancer, 2, ['a', 'c'])),
+                          ['a', 'c'])
+
+    @override_settings(MULTIDB_SLAVE_WEIGHTS={'a': 4, 'b': 2})
+    def test_weighted_round_robin(self):
+        balancer = WeightedRoundRobinBalancer(self.aliases)
+        choices = self.choices(balancer, 14)
+        self.assertEquals([choices.count(alias) for alias in self.aliases],
+                          [8, 4, 2])
+        # The heavy slave doesn't get its whole share in a row.
+        self.assertNotEquals(choices[:4], ['a'] * 4)
+
+    def test_least_outstanding(self):
+        balancer = LeastOutstandingBalancer(self.aliases)
+        wrappers._in_flight.update({'a': 2, 'b': 0, 'c': 1})
+        try:
+            self.assertEquals(self.choices(balancer, 3), ['b'] * 3)
+            self.assertEquals(balancer.choose(['a', 'c']), 'c')
+        finally:
+            wrappers._in_flight.clear()
+
+    def test_power_of_two_choices(self):
+        balancer = PowerOfTwoChoicesBalancer(self.aliases)
+        wrappers._in_flight.update({'a': 5, 'b': 5})
+        try:
+            # 'c' is never the loser of a pair.
+            self.assertTrue('c' in self.choices(balancer, 20))
+            self.assertEquals(balancer.choose(['a']), 'a')
+        finally:
+            wrappers._in_flight.clear()
+
+
+class WrapperTests(TestCase):
+    """Tests for the process-wide execute wrappers"""
+
+    def setUp(self):
+        self.seen = []
+        wrappers.register(self.wrapper)
+
+    def tearDown(self):
+        wrappers.unregister(self.wrapper)
+
+    def wrapper(self, execute, sql, params, many, context):
+        self.seen.append((context['connection'].alias, sql))
+        self.assertEquals(wrappers.in_flight(context['connection'].alias), 1)
+        return execute(sql, params, many, context)
+
+    def test_wrapper(self):
+        wrappers.register(wrappers.count_in_flight)
+        cursor = connections['slave'].cursor()
+        cursor.execute('SELECT 1')
+        self.assertEquals(cursor.fetchone(), (1,))
+        self.assertEquals(self.seen, [('slave', 'SELECT 1')])
+        self.assertEquals(wrappers.in_flight('slave'), 0)
+
+    def test_context_manager(self):
+        with connections['slave'].cursor() as cursor:
+            cursor.execute('SELECT 1')
+            self.assertEquals(cursor.fetchone(), (1,))
+        self.assertEquals(self.seen, [('slave', 'SELECT 1')])
+
+    def test_unregister(self):
+        wrappers.unregister(self.wrapper)
+        connections['slave'].cursor().execute('SELECT 1')
+        self.assertEquals(self.seen, [])
+
+
+@override_settings(SLAVE_DATABASES=['slave', 'slave2'])
+class StickySlaveTests(TestCase):
+    """Tests for sending all reads of a request to the same slave"""
+
+    def tearDown(self):
+        unstick_this_thread()
+        health.reset()
+
+    def test_not_sticky(self):
+        self.assertEquals(len(set(get_slave() for _ in range(4))), 2)
+
+    def test_sticky(self):
+        with use_sticky_slave:
+            self.assertTrue(this_thread_is_sticky())
+            self.assertEquals(len(set(get_slave() for _ in range(4))), 1)
+            self.assertEquals(this_thread_slave(), get_slave())
+        self.assertFalse(this_thread_is_sticky())
+        self.assertEquals(this_thread_slave(), None)
+
+    @override_settings(MULTIDB_HEALTH_CHECK_FAILURES=1)
+    def test_sticky_slave_ejected(self):
+        with use_sticky_slave:
+            alias = get_slave()
+            health.record_failure(alias)
+            self.assertNotEquals(get_slave(), alias)
+
+    @override_settings(MULTIDB_STICKY_SLAVE=True)
+    def test_middleware(self):
+        request = HttpRequest()
+        request.method = 'GET'
+        middleware = PinningRouterMiddleware()
+        middleware.process_request(request)
+        self.assertTrue(this_thread_is_sticky())
+        self.assertEquals(len(set(get_slave() for _ in range(4))), 1)
+        middleware.process_response(request, HttpResponse())
+        self.assertFalse(this_thread_is_sticky())
+        self.assertEquals(this_thread_slave(), None)
+
+
+class PinningStateTests(TestCase):
+    """Tests for keeping the pinning state per thread (or per context)"""
+
+    def tearDown(self):
+        unpin_this_thread()
+
+    def test_other_thread(self):
+        pin_this_thread()
+        seen = []
+        thread = threading.Thread(
+            target=lambda: seen.append(this_thread_is_pinned()))
+        thread.start()
+        thread.join()
+        self.assertEquals(seen, [False])
+        self.assertTrue(this_thread_is_pinned())
+
+    def test_nested_context_managers(self):
+        unpin_this_thread()
+        with use_master:
+            with use_slave:
+                self.assertFalse(this_thread_is_pinned())
+                with use_master:
+                    self.assertTrue(this_thread_is_pinned())
+                self.assertFalse(this_thread_is_pinned())
+            self.assertTrue(this_thread_is_pinned())
+        self.assertFalse(this_thread_is_pinned())
+
+    def test_context_manager_in_two_threads(self):
+        """use_master is shared; what it restores must not be."""
+        unpin_this_thread()
+        entered = threading.Event()
+        leave = threading.Event()
+        seen = []
+
+        def other():
+            pin_this_thread()
+            with use_master:
+                entered.set()
+                leave.wait(1)
+            seen.append(this_thread_is_pinned())
+
+        thread = threading.Thread(target=other)
+        thread.start()
+        entered.wait(1)
+        with use_master:
+            leave.set()
+            thread.join()
+        self.assertFalse(this_thread_is_pinned())
+        self.assertEquals(seen, [True])
+
+    def test_new_style_middleware(self):
+        request = HttpRequest()
+        request.method = 'POST'
+
+        def get_response(request):
+            self.assertTrue(this_thread_is_pinned())
+            return HttpResponse()
+
+        response = PinningRouterMiddleware(get_response)(request)
+        self.assertTrue(settings.MULTIDB_PINNING_COOKIE in response.cookies)
+        unset_db_write_for_this_thread()
+
+
+@override_settings(MULTIDB_WRITE_POSITIONS='multidb.positions.FakePositions')
+class WritePositionTests(TestCase):
+    """Tests for routing reads by the master's write position"""
+
+    def setUp(self):
+        FakePositions.master = 7
+        FakePositions.replayed = {}
+        self.middleware = PinningRouterMiddleware()
+        self.router = PinningMasterSlaveRouter()
+
+    def tearDown(self):
+        FakePositions.master = 0
+        FakePositions.replayed = {}
+        unpin_this_thread()
+        unset_db_write_for_this_thread()
+        set_this_thread_write_position(None)
+
+    def request(self, method='GET', cookie=None):
+        request = HttpRequest()
+        request.method = method
+        if cookie is not None:
+            request.COOKIES[settings.MULTIDB_PINNING_COOKIE] = cookie
+        self.middleware.process_request(request)
+        return request
+
+    def test_tokens(self):
+        self.assertEquals(tokens.dumps({}), 'y')
+        self.assertEquals(tokens.loads('y'), {})
+        self.assertEquals(tokens.loads(tokens.dumps({'p': '0/16B3748'})),
+                          {'p': '0/16B3748'})
+        self.assertEquals(tokens.loads('not a token'), {})
+
+    def test_cookie_carries_position(self):
+        request = self.request('POST')
+        response = self.middleware.process_response(request, HttpResponse())
+        cookie = response.cookies[settings.MULTIDB_PINNING_COOKIE].value
+        self.assertEquals(tokens.loads(cookie), {'p': '7'})
+
+    def test_read_from_slave_that_caught_up(self):
+        FakePositions.replayed['slave'] = 7
+        self.request(cookie=tokens.dumps({'p': '7'}))
+        self.assertFalse(this_thread_is_pinned())
+        self.assertEquals(self.router.db_for_read(None), 'slave')
+
+    def test_read_from_master_until_caught_up(self):
+        FakePositions.replayed['slave'] = 6
+        self.request(cookie=tokens.dumps({'p': '7'}))
+        self.assertEquals(self.router.db_for_read(None), DEFAULT_DB_ALIAS)
+        # The answer holds for the rest of the request.
+        FakePositions.replayed['slave'] = 7
+        self.assertEquals(self.router.db_for_read(None), DEFAULT_DB_ALIAS)
+        self.request(cookie=tokens.dumps({'p': '7'}))
+        self.assertEquals(self.router.db_for_read(None), 'slave')
+
+    def test_plain_cookie_pins(self):
+        FakePositions.replayed['slave'] = 7
+        self.request(cookie='y')
+        self.assertTrue(this_thread_is_pinned())
+
+    @override_settings(MULTIDB_WRITE_POSITIONS=None)
+    def test_position_ignored_when_not_configured(self):
+        self.request(cookie=tokens.dumps({'p': '7'}))
+        self.assertTrue(this_thread_is_pinned())
+
+
+@override_settings(
+    SLAVE_DATABASES=['slave'],
+    MULTIDB_SLAVE_GROUPS={
+        'analytics': {'DATABASES': ['analytics1', 'analytics2'],
+                      'FALLBACK': 'default'},
+        'lookup': {'DATABASES': ['lookup1'],
+                   'BALANCER': 'multidb.balancers.LeastOutstandingBalancer'},
+    },
+    MULTIDB_SLAVE_ROUTES={'reports': 'analytics',
+                          'catalog.Category': 'lookup'})
+class SlaveGroupTests(TestCase):
+    """Tests for routing the reads of models to groups of slaves"""
+
+    Report = fake_model('reports', 'Report')
+    Category = fake_model('catalog', 'Category')
+    Product = fake_model('catalog', 'Product')
+
+    def tearDown(self):
+        health.reset()
+        unpin_this_thread()
+
+    def test_group_for_model(self):
+        self.assertEquals(groups.group_for_model(self.Report), 'analytics')
+        self.assertEquals(groups.group_for_model(self.Category), 'lookup')
+        self.assertEquals(groups.group_for_model(self.Product), 'default')
+        self.assertEquals(groups.group_for_model(None), 'default')
+
+    def test_db_for_read(self):
+        router = MasterSlaveRouter()
+        self.assertEquals(
+            sorted(set(router.db_for_read(self.Report) for _ in range(4))),
+            ['analytics1', 'analytics2'])
+        self.assertEquals(router.db_for_read(self.Category), 'lookup1')
+        self.assertEquals(router.db_for_read(self.Product), 'slave')
+
+    def test_pinned(self):
+        pin_this_thread()
+        self.assertEquals(PinningMasterSlaveRouter().db_for_read(self.Report),
+                          DEFAULT_DB_ALIAS)
+
+    def test_balancer(self):
+        self.assertTrue(isinstance(groups.get_group('lookup').balancer,
+                                   LeastOutstandingBalancer))
+        self.assertTrue(isinstance(groups.get_group('analytics').balancer,
+                                   RoundRobinBalancer))
+
+    @override_settings(MULTIDB_HEALTH_CHECK_FAILURES=1)
+    def test_fallback(self):
+        health.record_failure('analytics1')
+        health.record_failure('analytics2')
+        self.assertEquals(get_slave('analytics'), 'slave')
+        health.record_failure('lookup1')
+        self.assertEquals(get_slave('lookup'), DEFAULT_DB_ALIAS)
+
+    def test_sticky_per_group(self):
+        with use_sticky_slave:
+            self.assertEquals(get_slave('lookup'), 'lookup1')
+            self.assertEquals(get_slave(), 'slave')
+            self.assertEquals(this_thread_slave('lookup'), 'lookup1')
+
+    def test_unknown_group(self):
+        routes = settings.MULTIDB_SLAVE_ROUTES
+        settings.MULTIDB_SLAVE_ROUTES = {'reports': 'nope'}
+        try:
+            self.assertRaises(ImproperlyConfigured, groups.build)
+        finally:
+            settings.MULTIDB_SLAVE_ROUTES = routes
+            groups.build()
+
+
+class PinningPolicyTests(TestCase):
+    """Tests for the compiled MULTIDB_PINNING_VIEWS rules"""
+    urls = 'multidb.tests.urls'
+
+    def is_write(self, rules, view_func, method='GET'):
+        request = HttpRequest()
+        request.method = method
+        return PinningPolicy(rules).is_write(request, view_func)
+
+    def test_exact(self):
+        self.assertTrue(self.is_write(['multidb.tests.views.dummy_view'],
+                                      dummy_view))
+        self.assertFalse(self.is_write(['multidb.tests.views.dummy'],
+                                       dummy_view))
+
+    def test_object_view(self):
+        self.assertTrue(self.is_write(
+            ['multidb.tests.views.object_dummy_view'], object_dummy_view()))
+
+    def test_glob(self):
+        self.assertTrue(self.is_write(['multidb.tests.*'], dummy_view))
+        self.assertTrue(self.is_write(['*.dummy_*'], dummy_view))
+        self.assertFalse(self.is_write(['multidb.other.*'], dummy_view))
+
+    def test_methods(self):
+        rules = ['PUT,patch multidb.tests.views.dummy_view']
+        self.assertFalse(self.is_write(rules, dummy_view, 'GET'))
+        self.assertTrue(self.is_write(rules, dummy_view, 'PUT'))
+        self.assertTrue(self.is_write(rules, dummy_view, 'PATCH'))
+
+    def test_rules_combine(self):
+        rules = ['GET multidb.tests.views.dummy_view', 'multidb.tests.*']
+        self.assertTrue(self.is_write(rules, dummy_view, 'DELETE'))
+
+    def test_decision_cached(self):
+        policy = PinningPolicy(['multidb.tests.views.dummy_view'])
+        request = HttpRequest()
+        request.method = 'GET'
+        self.assertTrue(policy.is_write(request, dummy_view))
+        policy.views.exact.clear()
+        self.assertTrue(policy.is_write(request, dummy_view))
+
+    def test_url_name(self):
+        middleware = ('multidb.middleware.PinningRouterMiddleware',)
+        for rules, url, result in [(('url:named-dummy',), '/ndummy/', True),
+                                   (('url:named-*',), '/ndummy/', True),
+                                   (('url:named-*',), '/dummy/', False),
+                                   (('POST url:named-*',), '/ndummy/', False)]:
+            with self.settings(MIDDLEWARE_CLASSES=middleware,
+                               MULTIDB_PINNING_VIEWS=rules):
+                response = Client().get(url)
+                self.assertEquals(response.content == "pinned", result)
+
+
+class LRUCacheTests(TestCase):
+    """Tests for the in-process LRU cache"""
+
+    def test_get_set(self):
+        lru = LRUCache(2)
+        self.assertTrue(lru.get('a') is MISSING)
+        lru.set('a', None, 10)
+        self.assertEquals(lru.get('a'), None)
+
+    def test_expiry(self):
+        lru = LRUCache(2)
+        lru.set('a', 1, 0.01)
+        time.sleep(0.02)
+        self.assertTrue(lru.get('a') is MISSING)
+
+    def test_eviction(self):
+        lru = LRUCache(2)
+        lru.set('a', 1, 10)
+        lru.set('b', 2, 10)
+        lru.get('a')
+        lru.set('c', 3, 10)
+        self.assertEquals(len(lru), 2)
+        self.assertTrue(lru.get('b') is MISSING)
+        self.assertEquals(lru.get('a'), 1)
+
+
+@override_settings(MULTIDB_COOKIELESS_CACHE='default',
+                   MULTIDB_COOKIELESS_LOCAL_SIZE=10,
+                   MULTIDB_COOKIELESS_NEGATIVE_SECONDS=0.1)
+class LocalCookielessCacheTests(TestCase):
+    """Tests for the in-process cache in front of MULTIDB_COOKIELESS_CACHE"""
+
+    def setUp(self):
+        get_local_cache().clear()
+        cache.clear()
+        self.middleware = PinningRouterMiddleware()
+        self.fingerprint = self.middleware._client_fingerprint(self.request())
+
+    def tearDown(self):
+        unpin_this_thread()
+        unset_db_write_for_this_thread()
+
+    def request(self, method='GET'):
+        request = HttpRequest()
+        request.method = method
+        return request
+
+    def pinned(self):
+        return self.middleware._pinned_because_of_prior_request(
+            self.request())
+
+    def test_disabled(self):
+        with self.settings(MULTIDB_COOKIELESS_LOCAL_SIZE=0):
+            self.assertEquals(get_local_cache(), None)
+            self.assertFalse(self.pinned())
+            cache.set(self.fingerprint, 'y')
+            self.assertTrue(self.pinned())
+
+    def test_positive(self):
+        cache.set(self.fingerprint, 'y')
+        self.assertTrue(self.pinned())
+        cache.delete(self.fingerprint)
+        self.assertTrue(self.pinned())
+
+    def test_negative(self):
+        self.assertFalse(self.pinned())
+        cache.set(self.fingerprint, 'y')
+        self.assertFalse(self.pinned())
+        time.sleep(0.15)
+        self.assertTrue(self.pinned())
+
+    def test_write_through(self):
+        self.assertFalse(self.pinned())
+        request = self.request('POST')
+        self.middleware.process_request(request)
+        self.middleware.process_response(request, HttpResponse())
+        self.assertEquals(get_local_cache().get(self.fingerprint), 'y')
+        self.assertTrue(self.pinned())
+
+
+@override_settings(MULTIDB_STATS=True)
+class StatsTests(TestCase):
+    """Tests for the routing and pinning statistics"""
+
+    def setUp(self):
+        stats.reset()
+
+    def tearDown(self):
+        unpin_this_thread()
+        unset_db_write_for_this_thread()
+        stats.reset()
+
+    def test_routes(self):
+        router = PinningMasterSlaveRouter()
+        router.db_for_read(None)
+        router.db_for_write(None)
+        with use_master:
+            router.db_for_read(None)
+        self.assertEquals(stats.snapshot()['routes'],
+                          {('read', 'slave'): 1, ('read', DEFAULT_DB_ALIAS): 1,
+                           ('write', DEFAULT_DB_ALIAS): 1})
+
+    def test_disabled(self):
+        with self.settings(MULTIDB_STATS=False):
+            MasterSlaveRouter().db_for_read(None)
+            with use_master:
+                pass
+        self.assertEquals(stats.snapshot()['routes'], {})
+        self.assertEquals(stats.snapshot()['pins'], {})
+
+    def test_pin_reasons(self):
+        with use_master:
+            with use_master:
+                pass
+        db_write(lambda: HttpResponse())()
+        middleware = PinningRouterMiddleware()
+        request = HttpRequest()
+        request.method = 'POST'
+        middleware.process_request(request)
+        request = HttpRequest()
+        request.method = 'GET'
+        request.COOKIES[settings.MULTIDB_PINNING_COOKIE] = 'y'
+        middleware.process_request(request)
+        # Still pinned from the cookie:
+        middleware.process_view(request, dummy_view, (), {})
+        self.assertEquals(stats.snapshot()['pins'],
+                          {'use_master': 1, 'db_write': 1, 'post': 1,
+                           'cookie': 1})
+
+    def test_signals(self):
+        seen = []
+
+        def routed(sender, operation, alias, model, **kwargs):
+            seen.append((operation, alias))
+
+        def pinned_(sender, reason, **kwargs):
+            seen.append(reason)
+
+        db_routed.connect(routed)
+        pinned.connect(pinned_)
+        try:
+            with use_master:
+                MasterSlaveRouter().db_for_write(None)
+        finally:
+            db_routed.disconnect(routed)
+            pinned.disconnect(pinned_)
+        self.assertEquals(seen, ['use_master', ('write', DEFAULT_DB_ALIAS)])
+
+    def test_latencies(self):
+        wrappers.register(stats.time_queries)
+        try:
+            connections['slave'].cursor().execute('SELECT 1')
+        finally:
+            wrappers.unregister(stats.time_queries)
+        latencies = stats.snapshot()['latencies']['slave']
+        self.assertEquals(latencies['count'], 1)
+        self.assertEquals(sum(latencies['buckets']), 1)
+        self.assertEquals(len(latencies['buckets']),
+                          len(stats.LATENCY_BUCKETS) + 1)
+
+    def test_metrics_view(self):
+        MasterSlaveRouter().db_for_read(None)
+        with use_master:
+            pass
+        response = metrics(HttpRequest())
+        self.assertTrue(response['Content-Type'].startswith('text/plain'))
+        self.assertTrue(
+            'multidb_routes_total{operation="read",alias="slave"} 1'
+            in response.content.decode('utf-8'))
+        self.assertTrue('multidb_pins_total{reason="use_master"} 1'
+                        in response.content.decode('utf-8'))
+
+
+class FailoverTests(TestCase):
+    """Tests for the failover of reads from slaves"""
+
+    def setUp(self):
+        self.seen = []
+        self.failing = set()
+        wrappers.register(failover.failover)
+        wrappers.register(self.break_reads)
+
+    def tearDown(self):
+        wrappers.unregister(self.break_reads)
+        wrappers.unregister(failover.failover)
+        set_this_thread_failover_budget(None)
+        failover.reset()
+
+    def break_reads(self, execute, sql, params, many, context):
+        alias = context['connection'].alias
+        self.seen.append(alias)
+        if alias in self.failing and sql.startswith('SELECT'):
+            raise OperationalError('server closed the connection')
+        return execute(sql, params, many, context)
+
+    def test_no_failure(self):
+        cursor = connections['slave'].cursor()
+        cursor.execute('SELECT 2')
+        self.assertEquals(cursor.fetchone(), (2,))
+        self.assertEquals(self.seen, ['slave'])
+
+    def test_retry_on_master(self):
+        self.failing.add('slave')
+        cursor = connections['slave'].cursor()
+        cursor.execute('SELECT 2')
+        self.assertEquals(cursor.fetchone(), (2,))
+        self.assertEquals(self.seen, ['slave', DEFAULT_DB_ALIAS])
+
+    def test_budget(self):
+        self.failing.add('slave')
+        set_this_thread_failover_budget(1)
+        connections['slave'].cursor().execute('SELECT 2')
+        cursor = connections['slave'].cursor()
+        self.assertRaises(OperationalError, cursor.execute, 'SELECT 2')
+
+    def test_master_failure(self):
+        self.failing.update(['slave', DEFAULT_DB_ALIAS])
+        cursor = connections['slave'].cursor()
+        self.assertRaises(OperationalError, cursor.execute, 'SELECT 2')
+        cursor = connections[DEFAULT_DB_ALIAS].cursor()
+        self.assertRaises(OperationalError, cursor.execute, 'SELECT 2')
+        self.assertEquals(self.seen, ['slave', DEFAULT_DB_ALIAS,
+                                      DEFAULT_DB_ALIAS])
+
+    def test_not_in_transaction(self):
+        self.failing.add('slave')
+        with transaction.atomic(using='slave'):
+            cursor = connections['slave'].cursor()
+            self.assertRaises(OperationalError, cursor.execute, 'SELECT 2')
+
+    def test_candidates(self):
+        with self.settings(SLAVE_DATABASES=['slave', 'slave2']):
+            candidates = failover._candidates('slave')
+            self.assertEquals(sorted(candidates[:2]), ['slave', 'slave2'])
+            self.assertEquals(candidates[2:], [DEFAULT_DB_ALIAS])
+            failover._tried.set(('slave',))
+            try:
+                self.assertEquals(failover._candidates('slave'),
+                                  ['slave2', DEFAULT_DB_ALIAS])
+            finally:
+                failover._tried.set(())
+
+    def test_circuit_breaker(self):
+        self.failing.add('slave')
+        with self.settings(MULTIDB_CIRCUIT_BREAKER_FAILURES=2):
+            connections['slave'].cursor().execute('SELECT 2')
+            self.assertTrue(failover.is_closed('slave'))
+            self.assertEquals(get_slave(), 'slave')
+            connections['slave'].cursor().execute('SELECT 2')
+            self.assertFalse(failover.is_closed('slave'))
+            self.assertEquals(failover.open_breakers(), set(['slave']))
+            self.assertEquals(get_slave(), DEFAULT_DB_ALIAS)
+        self.failing.clear()
+        connections['slave'].cursor().execute('SELECT 2')
+        self.assertTrue(failover.is_closed('slave'))
+        self.assertEquals(get_slave(), 'slave')
+
+    def test_half_open(self):
+        self.failing.add('slave')
+        with self.settings(MULTIDB_CIRCUIT_BREAKER_FAILURES=1,
+                           MULTIDB_CIRCUIT_BREAKER_SECONDS=0.1):
+            connections['slave'].cursor().execute('SELECT 2')
+            self.assertFalse(failover.is_closed('slave'))
+            time.sleep(0.15)
+            self.assertTrue(failover.is_closed('slave'))
+            connections['slave'].cursor().execute('SELECT 2')
+            self.assertFalse(failover.is_closed('slave'))
+
+    def test_budget_set_per_request(self):
+        set_this_thread_failover_budget(0)
+        middleware = PinningRouterMiddleware()
+        request = HttpRequest()
+        request.method = 'GET'
+        with self.settings(MULTIDB_FAILOVER=True):
+            middleware.process_request(request)
+            self.assertEquals(failover.this_thread_failover_budget(),
+                              settings.MULTIDB_FAILOVER_BUDGET)
+            middleware.process_response(request, HttpResponse())
+        self.assertEquals(failover.this_thread_failover_budget(), None)
+
+
+@override_settings(MULTIDB_TABLE_PINNING=True)
+class TablePinningTests(TestCase):
+    """Tests for pinning the reads of the tables written only"""
+
+    def setUp(self):
+        self.router = PinningMasterSlaveRouter()
+        self.middleware = PinningRouterMiddleware()
+        self.books = fake_model('library', 'Book')
+        self.authors = fake_model('library', 'Author')
+
+    def tearDown(self):
+        unpin_this_thread()
+        unset_db_write_for_this_thread()
+        set_this_thread_pinned_tables(())
+        set_this_thread_written_tables(None)
+
+    def request(self, method='GET', write=(), cookie=None):
+        """Run a request that writes the models in ``write``; return the
+        pinning cookie it sets, or None."""
+        request = HttpRequest()
+        request.method = method
+        if cookie is not None:
+            request.COOKIES[settings.MULTIDB_PINNING_COOKIE] = cookie
+        self.middleware.process_request(request)
+        for model in write:
+            self.router.db_for_write(model)
+        response = self.middleware.process_response(request, HttpResponse())
+        cookie = response.cookies.get(settings.MULTIDB_PINNING_COOKIE)
+        return cookie.value if cookie is not None else None
+
+    def test_reads_after_write(self):
+        request = HttpRequest()
+        request.method = 'GET'
+        self.middleware.process_request(request)
+        self.assertEquals(self.router.db_for_read(self.books), 'slave')
+        self.router.db_for_write(self.books)
+        self.assertEquals(self.router.db_for_read(self.books),
+                          DEFAULT_DB_ALIAS)
+        self.assertEquals(self.router.db_for_read(self.authors), 'slave')
+        self.assertFalse(this_thread_is_pinned())
+
+    def test_next_request(self):
+        cookie = self.request(write=[self.books])
+        self.assertEquals(list(tokens.loads(cookie)['t']), ['library_book'])
+        request = HttpRequest()
+        request.method = 'GET'
+        request.COOKIES[settings.MULTIDB_PINNING_COOKIE] = cookie
+        self.middleware.process_request(request)
+        self.assertFalse(this_thread_is_pinned())
+        self.assertEquals(self.router.db_for_read(self.books),
+                          DEFAULT_DB_ALIAS)
+        self.assertEquals(self.router.db_for_read(self.authors), 'slave')
+
+    def test_merge(self):
+        cookie = self.request(write=[self.books])
+        cookie = self.request(write=[self.authors], cookie=cookie)
+        self.assertEquals(sorted(tokens.loads(cookie)['t']),
+                          ['library_author', 'library_book'])
+
+    def test_no_write(self):
+        self.assertEquals(self.request(), None)
+
+    def test_expired(self):
+        cookie = tokens.dumps({'t': {'library_book': time.time() - 1}})
+        self.assertEquals(self.request(cookie=cookie), None)
+        self.assertEquals(self.router.db_for_read(self.books), 'slave')
+
+    def test_forged(self):
+        for tables in (5, {'library_book': 'zz'}, ['library_book']):
+            cookie = tokens.dumps({'t': tables})
+            self.assertEquals(self.request(cookie=cookie), None)
+            self.assertTrue(this_thread_is_pinned())
+            self.assertEquals(self.router.db_for_read(self.authors),
+                              DEFAULT_DB_ALIAS)
+
+    def test_forged_expiry(self):
+        cookie = tokens.dumps({'t': {'library_author': 1e300}})
+        cookie = self.request(write=[self.books], cookie=cookie)
+        self.assertTrue(max(tokens.loads(cookie)['t'].values())
+                        <= time.time() + settings.MULTIDB_PINNING_SECONDS + 1)
+        for expires in (float('inf'), float('nan')):
+            cookie = tokens.dumps({'t': {'library_author': expires}})
+            self.assertEquals(self.request(write=[self.books], cookie=cookie),
+                              tokens.PINNED)
+
+    def test_post_without_writes_pins_everything(self):
+        self.assertEquals(self.request(method='POST'), tokens.PINNED)
+
+    def test_after_plain_pin(self):
+        cookie = self.request(write=[self.books], cookie=tokens.PINNED)
+        self.assertEquals(cookie, tokens.PINNED)
+
+    def test_too_many_tables(self):
+        models = [fake_model('library', 'Model%d' % i)
+                  for i in range(MAX_PINNED_TABLES + 1)]
+        self.assertEquals(self.request(write=models), tokens.PINNED)
+
+    def test_disabled(self):
+        cookie = self.request(write=[self.books])
+        with self.settings(MULTIDB_TABLE_PINNING=False):
+            request = HttpRequest()
+            request.method = 'GET'
+            request.COOKIES[settings.MULTIDB_PINNING_COOKIE] = cookie
+            self.middleware.process_request(request)
+            self.assertTrue(this_thread_is_pinned())
+            self.assertEquals(this_thread_written_tables(), None)
+            self.router.db_for_write(self.books)
+            self.assertEquals(this_thread_written_tables(), None)
+
+
+@override_settings(MULTIDB_PIN_ONLY_ON_WRITES=True)
+class PinOnlyOnWritesTests(TestCase):
+    """Tests for pinning the next requests only after real writes"""
+
+    def setUp(self):
+        self.middleware = PinningRouterMiddleware()
+
+    def tearDown(self):
+        unpin_this_thread()
+        unset_db_write_for_this_thread()
+        set_this_thread_has_written(False)
+
+    def request(self, method, write=False, mark=False):
+        """Return whether the request pins the next requests."""
+        request = HttpRequest()
+        request.method = method
+        self.middleware.process_request(request)
+        self.pinned = this_thread_is_pinned()
+        if write:
+            set_this_thread_has_written()
+        response = HttpResponse()
+        if mark:
+            response._db_write = True
+        response = self.middleware.process_response(request, response)
+        return settings.MULTIDB_PINNING_COOKIE in response.cookies
+
+    def test_is_write(self):
+        self.assertFalse(wrappers.is_write('SELECT 1'))
+        self.assertFalse(wrappers.is_write('  select * from t'))
+        self.assertFalse(wrappers.is_write('(SELECT 1) UNION (SELECT 2)'))
+        self.assertFalse(wrappers.is_write('SAVEPOINT s1'))
+        self.assertFalse(wrappers.is_write(''))
+        self.assertTrue(wrappers.is_write('INSERT INTO t VALUES (1)'))
+        self.assertTrue(wrappers.is_write('update t set x = 1'))
+        self.assertTrue(wrappers.is_write('WITH x AS (DELETE FROM t) '
+                                          'SELECT 1'))
+
+    def test_note_writes(self):
+        wrappers.register(wrappers.note_writes)
+        try:
+            connections[DEFAULT_DB_ALIAS].cursor().execute('SELECT 1')
+            self.assertFalse(this_thread_has_written())
+            connections['slave'].cursor().execute(
+                'CREATE TEMPORARY TABLE multidb_test (x int)')
+            self.assertFalse(this_thread_has_written())
+            connections[DEFAULT_DB_ALIAS].cursor().execute(
+                'CREATE TEMPORARY TABLE multidb_test (x int)')
+            self.assertTrue(this_thread_has_written())
+        finally:
+            wrappers.unregister(wrappers.note_writes)
+
+    def test_post_without_writes(self):
+        self.assertFalse(self.request('POST'))
+        self.assertTrue(self.pinned)
+
+    def test_post_with_writes(self):
+        self.assertTrue(self.request('POST', write=True))
+
+    def test_get_with_writes(self):
+        self.assertTrue(self.request('GET', write=True))
+        self.assertFalse(self.request('GET'))
+
+    def test_marked_response(self):
+        self.assertTrue(self.request('GET', mark=True))
+
+    def test_disabled(self):
+        with self.settings(MULTIDB_PIN_ONLY_ON_WRITES=False):
+            self.assertTrue(self.request('POST'))
+
+
+@override_settings(MULTIDB_LAZY_PINNING=True)
+class LazyPinningTests(TransactionTestCase):
+    """Tests for pinning requests that may write at their first write"""
+    # Not TestCase, whose tests run in a transaction.
+
+    def setUp(self):
+        self.router = PinningMasterSlaveRouter()
+        self.middleware = PinningRouterMiddleware()
+
+    def tearDown(self):
+        unpin_this_thread()
+        unset_db_write_for_this_thread()
+        self.middleware.process_response(HttpRequest(), HttpResponse())
+
+    def request(self, method='POST', cookies=None):
+        request = HttpRequest()
+        request.method = method
+        request.COOKIES.update(cookies or {})
+        self.middleware.process_request(request)
+        return request
+
+    def test_pinned_at_first_write(self):
+        self.request()
+        self.assertFalse(this_thread_is_pinned())
+        self.assertEquals(this_thread_pins_on_write(), 'post')
+        self.assertEquals(self.router.db_for_read(None), 'slave')
+        self.assertEquals(self.router.db_for_write(None), DEFAULT_DB_ALIAS)
+        self.assertTrue(this_thread_is_pinned())
+        self.assertEquals(this_thread_pins_on_write(), None)
+        self.assertEquals(self.router.db_for_read(None), DEFAULT_DB_ALIAS)
+
+    def test_pinned_in_transaction(self):
+        self.request()
+        with transaction.atomic():
+            self.assertEquals(self.router.db_for_read(None),
+                              DEFAULT_DB_ALIAS)
+        self.assertTrue(this_thread_is_pinned())
+
+    def test_get(self):
+        self.request('GET')
+        with transaction.atomic():
+            self.assertEquals(self.router.db_for_read(None), 'slave')
+        self.router.db_for_write(None)
+        self.assertFalse(this_thread_is_pinned())
+
+    def test_cookie(self):
+        self.request(cookies={settings.MULTIDB_PINNING_COOKIE: 'y'})
+        self.assertTrue(this_thread_is_pinned())
+        self.assertEquals(this_thread_pins_on_write(), None)
+
+    def test_view(self):
+        request = self.request('GET')
+        with self.settings(MULTIDB_PINNING_VIEWS=[
+                'multidb.tests.views.dummy_view']):
+            self.middleware.process_view(request, dummy_view, (), {})
+        self.assertFalse(this_thread_is_pinned())
+        self.assertEquals(this_thread_pins_on_write(), 'view')
+
+    def test_next_requests_pinned(self):
+        request = self.request()
+        response = self.middleware.process_response(request, HttpResponse())
+        self.assertTrue(settings.MULTIDB_PINNING_COOKIE in response.cookies)
+        self.assertEquals(this_thread_pins_on_write(), None)
+
+    @override_settings(MULTIDB_STATS=True)
+    def test_pin_reason(self):
+        stats.reset()
+        self.request()
+        self.assertEquals(stats.snapshot()['pins'], {})
+        self.router.db_for_write(None)
+        self.assertEquals(stats.snapshot()['pins'], {'post': 1})
+        stats.reset()
+
+
+class TaskPinningTests(TestCase):
+    """Tests for carrying the pinning state over to tasks"""
+
+    def tearDown(self):
+        unpin_this_thread()
+        set_this_thread_pinned_tables(())
+        set_this_thread_write_position(None)
+        FakePositions.master = 0
+
+    def take(self):
+        """Return the pinning state of this thread, and reset it."""
+        state = pinning_state()
+        self.tearDown()
+        return state
+
+    def test_nothing_to_carry(self):
+        self.assertEquals(pinning_state(), None)
+        self.assertEquals(pinning_kwargs(), {})
+        with use_pinning_state(None):
+            self.assertFalse(this_thread_is_pinned())
+
+    def test_pinned(self):
+        pin_this_thread()
+        state = self.take()
+        with use_pinning_state(state):
+            self.assertTrue(this_thread_is_pinned())
+        self.assertFalse(this_thread_is_pinned())
+
+    def test_already_pinned(self):
+        pin_this_thread()
+        state = pinning_state()
+        with use_pinning_state(state):
+            self.assertTrue(this_thread_is_pinned())
+        self.assertTrue(this_thread_is_pinned())
+
+    def test_expired(self):
+        pin_this_thread()
+        state = self.take()
+        with self.settings(MULTIDB_PINNING_SECONDS=0):
+            with use_pinning_state(state):
+                self.assertFalse(this_thread_is_pinned())
+
+    def test_tables(self):
+        set_this_thread_pinned_tables(['library_book'])
+        state = self.take()
+        with use_pinning_state(state):
+            self.assertFalse(this_thread_is_pinned())
+            self.assertEquals(this_thread_pinned_tables(),
+                              frozenset(['library_book']))
+        self.assertEquals(this_thread_pinned_tables(), frozenset())
+
+    @override_settings(
+        MULTIDB_WRITE_POSITIONS='multidb.positions.FakePositions')
+    def test_write_position(self):
+        FakePositions.master = 5
+        pin_this_thread()
+        state = self.take()
+        with use_pinning_state(state):
+            self.assertFalse(this_thread_is_pinned())
+            self.assertEquals(this_thread_write_position(), '5')
+        self.assertEquals(this_thread_write_position(), None)
+
+    def test_pinned_task(self):
+        @pinned_task
+        def task(arg, **kw):
+            self.assertEquals(kw, {})
+            return arg, this_thread_is_pinned()
+
+        pin_this_thread()
+        kwargs = pinning_kwargs()
+        self.assertEquals(list(kwargs), [STATE_KWARG])
+        self.tearDown()
+        self.assertEquals(task(1, **kwargs), (1, True))
+        self.assertEquals(task(2), (2, False))
+        self.assertFalse(this_thread_is_pinned())
+
+
+@override_settings(MULTIDB_SHARDS={
+    'eu': {'MASTER': 'eu', 'SLAVES': ['eu-slave']},
+    'us': {'MASTER': 'us'},
+}, MULTIDB_SHARD_FUNCTION='multidb.tests.test_all.fake_shard_function')
+class ShardTests(TestCase):
+    """Tests for routing to shards"""
+
+    def setUp(self):
+        self.router = PinningMasterSlaveRouter()
+        self.middleware = PinningRouterMiddleware()
+
+    def tearDown(self):
+        unpin_this_thread()
+        unset_db_write_for_this_thread()
+        self.middleware.process_response(HttpRequest(), HttpResponse())
+        set_this_thread_pinned_shards(())
+
+    def test_unsharded(self):
+        self.assertEquals(self.router.db_for_read(None), 'slave')
+        self.assertEquals(self.router.db_for_write(None), DEFAULT_DB_ALIAS)
+
+    def test_hints(self):
+        self.assertEquals(self.router.db_for_read(None, shard='eu'),
+                          'eu-slave')
+        self.assertEquals(self.router.db_for_write(None, shard='eu'), 'eu')
+        self.assertEquals(MasterSlaveRouter().db_for_read(None, shard='eu'),
+                          'eu-slave')
+
+    def test_instance(self):
+        class State(object):
+            db = 'eu-slave'
+
+        class Instance(object):
+            _state = State()
+
+        self.assertEquals(self.router.db_for_write(None, instance=Instance()),
+                          'eu')
+
+    def test_function(self):
+        self.assertEquals(self.router.db_for_write(fake_model('us', 'Order')),
+                          'us')
+
+    def test_unknown_shard(self):
+        self.assertRaises(ValueError, self.router.db_for_read, None,
+                          shard='asia')
+        with use_shard('asia'):
+            self.assertRaises(ValueError, self.router.db_for_write, None)
+        # MULTIDB_SHARD_FUNCTION names 'us'.
+        with self.settings(MULTIDB_SHARDS={'eu': {'MASTER': 'eu'}}):
+            self.assertRaises(ValueError, self.router.db_for_write,
+                              fake_model('us', 'Order'))
+
+    def test_use_shard(self):
+        with use_shard('eu'):
+            self.assertEquals(self.router.db_for_read(None), 'eu-slave')
+            with use_shard('us'):
+                self.assertEquals(self.router.db_for_read(None), 'us')
+            self.assertEquals(self.router.db_for_write(None), 'eu')
+        self.assertEquals(self.router.db_for_read(None), 'slave')
+
+    def test_no_usable_slave(self):
+        self.assertEquals(self.router.db_for_read(None, shard='us'), 'us')
+
+    def test_pinned(self):
+        with use_master:
+            self.assertEquals(self.router.db_for_read(None, shard='eu'),
+                              'eu')
+
+    def test_missing_master(self):
+        shards_setting = settings.MULTIDB_SHARDS
+        settings.MULTIDB_SHARDS = {'eu': {'SLAVES': ['eu-slave']}}
+        try:
+            self.assertRaises(ImproperlyConfigured, groups.build)
+        finally:
+            settings.MULTIDB_SHARDS = shards_setting
+            groups.build()
+
+    def test_slave_aliases(self):
+        self.assertTrue('eu-slave' in slave_aliases())
+        self.assertEquals(shards.shard_of_alias('eu-slave').master, 'eu')
+
+    def test_allow_syncdb(self):
+        self.assertTrue(self.router.allow_syncdb('eu', None))
+        self.assertFalse(self.router.allow_syncdb('eu-slave', None))
+        self.assertTrue(self.router.allow_syncdb(DEFAULT_DB_ALIAS, None))
+
+    def request(self, method='GET', cookie=None, shard=None):
+        request = HttpRequest()
+        request.method = method
+        if cookie is not None:
+            request.COOKIES[settings.MULTIDB_PINNING_COOKIE] = cookie
+        self.middleware.process_request(request)
+        if shard is not None:
+            self.router.db_for_write(None, shard=shard)
+        response = self.middleware.process_response(request, HttpResponse())
+        cookie = response.cookies.get(settings.MULTIDB_PINNING_COOKIE)
+        return cookie.value if cookie is not None else None
+
+    def test_pinned_per_shard(self):
+        request = HttpRequest()
+        request.method = 'GET'
+        self.middleware.process_request(request)
+        self.router.db_for_write(None, shard='eu')
+        self.assertEquals(self.router.db_for_read(None, shard='eu'), 'eu')
+        self.assertEquals(self.router.db_for_read(None), 'slave')
+
+    def test_next_requests(self):
+        cookie = self.request(shard='eu')
+        self.assertEquals(list(tokens.loads(cookie)), ['s'])
+        request = HttpRequest()
+        request.method = 'GET'
+        request.COOKIES[settings.MULTIDB_PINNING_COOKIE] = cookie
+        self.middleware.process_request(request)
+        self.assertFalse(this_thread_is_pinned())
+        self.assertEquals(self.router.db_for_read(None, shard='eu'), 'eu')
+        self.assertEquals(self.router.db_for_read(None), 'slave')
+
+    def test_post(self):
+        cookie = self.request('POST', shard='eu')
+        self.assertEquals(sorted(tokens.loads(cookie)), ['m', 's'])
+        request = HttpRequest()
+        request.method = 'GET'
+        request.COOKIES[settings.MULTIDB_PINNING_COOKIE] = cookie
+        self.middleware.process_request(request)
+        self.assertTrue(this_thread_is_pinned())
+
+    def test_forged(self):
+        for value in (['x'], 5, {'eu': None}):
+            cookie = tokens.dumps({'s': value})
+            self.assertEquals(self.request(cookie=cookie), None)
+            self.assertTrue(this_thread_is_pinned())
+            self.assertEquals(self.router.db_for_read(None, shard='eu'),
+                              'eu')
+
+    def test_forged_expiry(self):
+        cookie = tokens.dumps({'s': {'us': 1e300}})
+        cookie = self.request(cookie=cookie, shard='eu')
+        self.assertTrue(max(tokens.loads(cookie)['s'].values())
+                        <= time.time() + settings.MULTIDB_PINNING_SECONDS + 1)
+        for expires in (float('inf'), float('nan')):
+            cookie = tokens.dumps({'s': {'us': expires}})
+            cookie = self.request(cookie=cookie, shard='eu')
+            self.assertEquals(sorted(tokens.loads(cookie)), ['m', 's'])
+
+    @override_settings(
+        MULTIDB_WRITE_POSITIONS='multidb.tests.test_all.CountingPositions')
+    def test_write_position(self):
+        CountingPositions.fetched = 0
+        cookie = self.request(shard='eu')
+        self.assertEquals(list(tokens.loads(cookie)), ['s'])
+        self.assertEquals(CountingPositions.fetched, 0)
+        cookie = self.request('POST', shard='eu')
+        self.assertEquals(sorted(tokens.loads(cookie)), ['p', 's'])
+        self.assertEquals(CountingPositions.fetched, 1)
+
+    def test_prior_pin_kept(self):
+        cookie = self.request(cookie=tokens.PINNED, shard='eu')
+        self.assertEquals(sorted(tokens.loads(cookie)), ['m', 's'])
+        cookie = self.request(cookie=cookie, shard='us')
+        self.assertEquals(sorted(tokens.loads(cookie)['s']), ['eu', 'us'])
+        self.assertEquals(tokens.loads(cookie)['m'], 1)
+
+    def test_task_state(self):
+        set_this_thread_pinned_shards(['eu'])
+        state = pinning_state()
+        set_this_thread_pinned_shards(())
+        with use_pinning_state(state):
+            self.assertFalse(this_thread_is_pinned())
+            self.assertEquals(self.router.db_for_read(None, shard='eu'),
+                              'eu')
+        self.assertEquals(self.router.db_for_read(None, shard='eu'),
+                          'eu-slave')
+
+
+class WarmUpTests(TestCase):
+    """Tests for opening the connections before the first requests"""
+
+    def setUp(self):
+        settings.DATABASES['slave']['CONN_MAX_AGE'] = 60
+
+    def tearDown(self):
+        del settings.DATABASES['slave']['CONN_MAX_AGE']
+        health.reset()
+
+    @override_settings(MULTIDB_SHARDS={'us': {'MASTER': 'us',
+                                              'SLAVES': ['slave', 'us-1']}})
+    def test_database_aliases(self):
+        self.assertEquals(warmup.database_aliases(),
+                          [DEFAULT_DB_ALIAS, 'us', 'slave', 'us-1'])
+
+    def test_warm_up(self):
+        connections['slave'].close()
+        self.assertEquals(warmup.warm_up(jitter=0), {})
+        self.assertTrue(connections['slave'].connection is not None)
+
+    def test_not_persistent(self):
+        settings.DATABASES['slave']['CONN_MAX_AGE'] = 0
+        pinged = []
+        original, health.ping = health.ping, pinged.append
+        try:
+            self.assertEquals(warmup.warm_up(['slave'], jitter=0), {})
+        finally:
+            health.ping = original
+        self.assertEquals(pinged, [])
+
+    @override_settings(MULTIDB_HEALTH_CHECK_FAILURES=1)
+    def test_failure(self):
+        failed = warmup.warm_up(['slave', 'nonexistent'], jitter=0)
+        self.assertEquals(list(failed), ['nonexistent'])
+        self.assertTrue(health.is_healthy('slave'))
+
+    @override_settings(MULTIDB_HEALTH_CHECK_FAILURES=1)
+    def test_failures_of_slaves_only(self):
+        def ping(alias):
+            raise OperationalError(alias)
+        original, health.ping = health.ping, ping
+        settings.DATABASES[DEFAULT_DB_ALIAS]['CONN_MAX_AGE'] = 60
+        try:
+            failed = warmup.warm_up([DEFAULT_DB_ALIAS, 'slave'], jitter=0)
+        finally:
+            health.ping = original
+            del settings.DATABASES[DEFAULT_DB_ALIAS]['CONN_MAX_AGE']
+        self.assertEquals(sorted(failed), [DEFAULT_DB_ALIAS, 'slave'])
+        self.assertFalse(health.is_healthy('slave'))
+        self.assertEquals(health.ejected_slaves(), frozenset(['slave']))
+
+    @override_settings(MULTIDB_WARMUP_CONCURRENCY=1)
+    def test_concurrency(self):
+        connecting = []
+        most = []
+        lock = threading.Lock()
+
+        def ping(alias):
+            with lock:
+                connecting.append(alias)
+                most.append(len(connecting))
+            time.sleep(0.01)
+            with lock:
+                connecting.remove(alias)
+        original, health.ping = health.ping, ping
+        try:
+            threads = [threading.Thread(target=warmup.warm_up,
+                                        args=(['slave'], 0))
+                       for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            health.ping = original
+        self.assertEquals(max(most), 1)
+
+
+@override_settings(SLAVE_DATABASES=['slave'])
+class TopologyTests(TestCase):
+    """Tests for changing the slaves at runtime"""
+
+    def setUp(self):
+        self.changes = []
+        topology_changed.connect(self.changed)
+        # update() sets the settings for good, which override_settings
+        # doesn't undo.
+        self.saved = dict((name, getattr(settings, name))
+                          for name in topology.TOPOLOGY_SETTINGS
+                          if name != 'DATABASES')
+        self.aliases = set(settings.DATABASES)
+
+    def tearDown(self):
+        topology_changed.disconnect(self.changed)
+        for name, value in self.saved.items():
+            setattr(settings, name, value)
+        for alias in set(settings.DATABASES) - self.aliases:
+            del settings.DATABASES[alias]
+        groups.build()
+        topology.reset()
+
+    def changed(self, sender, added, removed, **kwargs):
+        self.changes.append((added, removed))
+
+    def add_slave(self):
+        topology.update({
+            'DATABASES': {'slave-2': {'NAME': 'slave-2',
+                                      'ENGINE': 'django.db.backends.sqlite3'}},
+            'SLAVE_DATABASES': ['slave', 'slave-2'],
+        })
+
+    def test_add(self):
+        self.add_slave()
+        self.assertEquals(set(get_slave() for _ in range(4)),
+                          set(['slave', 'slave-2']))
+        self.assertEquals(self.changes, [(set(['slave-2']), set())])
+        self.assertEquals(settings.DATABASES['slave-2']['TEST_MIRROR'],
+                          DEFAULT_DB_ALIAS)
+
+    def test_remove(self):
+        cursor = connections['slave'].cursor()
+        topology.update({'SLAVE_DATABASES': []})
+        self.assertEquals(get_slave(), DEFAULT_DB_ALIAS)
+        self.assertTrue(topology.is_retired('slave'))
+        self.assertEquals(self.changes, [(set(), set(['slave']))])
+        # Queries running on the slave go on until the thread is done.
+        cursor.execute('SELECT 1')
+        closed = []
+        # SQLite ignores closing in-memory test databases.
+        connections['slave'].close = lambda: closed.append(True)
+        try:
+            topology.close_retired()
+        finally:
+            del connections['slave'].close
+        self.assertEquals(closed, [True])
+        topology.update({'SLAVE_DATABASES': ['slave']})
+        self.assertFalse(topology.is_retired('slave'))
+        self.assertEquals(get_slave(), 'slave')
+
+    def test_shards_swapped_with_groups(self):
+        table = groups._table
+        topology.update({'MULTIDB_SHARDS': {'eu': {'MASTER': 'slave2'}}})
+        # The table the routers had is left as it was.
+        self.assertEquals(table[3][0], {})
+        self.assertFalse(groups.shard_group('eu') in table[0])
+        self.assertEquals(shards.get_shard('eu').group,
+                          groups.shard_group('eu'))
+        self.assertTrue(groups.shard_group('eu') in groups._table[0])
+
+    def test_sticky_slave_removed(self):
+        self.add_slave()
+        with use_sticky_slave:
+            set_this_thread_slave('slave-2')
+            topology.update({'SLAVE_DATABASES': ['slave']})
+            self.assertEquals(get_slave(), 'slave')
+
+    def test_unknown_database(self):
+        self.assertRaises(ImproperlyConfigured, topology.update,
+                          {'SLAVE_DATABASES': ['slave', 'nonexistent']})
+        self.assertEquals(settings.SLAVE_DATABASES, ['slave'])
+        self.assertEquals(groups.get_group().aliases, ['slave'])
+
+    def test_unknown_setting(self):
+        self.assertRaises(ImproperlyConfigured, topology.update,
+                          {'DEBUG': True})
+
+    def test_reload_file(self):
+        fd, path = tempfile.mkstemp()
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'SLAVE_DATABASES': []}, f)
+        try:
+            with override_settings(MULTIDB_TOPOLOGY_FILE=path):
+                self.assertTrue(topology.reload())
+                self.assertFalse(topology.reload())
+        finally:
+            os.remove(path)
+        self.assertEquals(get_slave(), DEFAULT_DB_ALIAS)
+
+    @override_settings(MULTIDB_TOPOLOGY_CACHE='default')
+    def test_reload_cache(self):
+        self.assertFalse(topology.reload())
+        topology.publish({'SLAVE_DATABASES': []})
+        try:
+            self.assertTrue(topology.reload())
+        finally:
+            cache.delete(settings.MULTIDB_TOPOLOGY_CACHE_KEY)
+        self.assertEquals(get_slave(), DEFAULT_DB_ALIAS)
+
+
+@override_settings(MULTIDB_QUERY_CACHE='default',
+                   MULTIDB_QUERY_CACHE_TABLES=('multidb_config',))
+class QueryCacheTests(TransactionTestCase):
+    """Tests for caching the results of reads from slaves"""
+
+    def setUp(self):
+        wrappers.register(querycache.cache_reads)
+        self.cursor = connections['slave'].cursor()
+        self.cursor.execute('CREATE TABLE multidb_config '
+                            '(id integer, name varchar(10))')
+        self.cursor.execute("INSERT INTO multidb_config VALUES (1, 'a')")
+
+    def tearDown(self):
+        wrappers.unregister(querycache.cache_reads)
+        self.cursor.execute('DROP TABLE multidb_config')
+        querycache.get_results_cache().clear()
+        cache.clear()
+
+    def read(self, sql='SELECT name FROM multidb_config WHERE id = %s'):
+        cursor = connections['slave'].cursor()
+        cursor.execute(sql, [1])
+        return cursor.fetchall()
+
+    def rename(self, name):
+        self.cursor.execute('UPDATE multidb_config SET name = %s', [name])
+
+    def test_tables_of(self):
+        self.assertEquals(
+            querycache.tables_of('SELECT "a"."x" FROM "a" INNER JOIN "b" '
+                                 'ON ("a"."id" = "b"."a_id")'),
+            frozenset(['a', 'b']))
+
+    def test_cache(self):
+        self.assertEquals(self.read(), [('a',)])
+        self.rename('b')
+        self.assertEquals(self.read(), [('a',)])
+        querycache.invalidate('multidb_config')
+        self.assertEquals(self.read(), [('b',)])
+
+    def test_reuse_cursor(self):
+        self.read()
+        cursor = connections['slave'].cursor()
+        cursor.execute('SELECT name FROM multidb_config WHERE id = %s', [1])
+        self.assertEquals(cursor.fetchall(), [('a',)])
+        cursor.execute('SELECT 2')
+        self.assertEquals(cursor.fetchall(), [(2,)])
+
+    def write(self, sql):
+        """Run ``sql`` on master copies of the table and of another one."""
+        cursor = connections[DEFAULT_DB_ALIAS].cursor()
+        tables = ('multidb_config', 'multidb_config_other')
+        for table in tables:
+            cursor.execute('CREATE TABLE %s (id integer, name varchar(10))'
+                           % table)
+        try:
+            cursor.execute(sql)
+        finally:
+            for table in tables:
+                cursor.execute('DROP TABLE %s' % table)
+
+    def test_write_invalidates(self):
+        self.read()
+        self.rename('b')
+        MasterSlaveRouter().db_for_write(fake_model('multidb', 'Config'))
+        # Only the write itself invalidates, once it's done.
+        self.assertEquals(self.read(), [('a',)])
+        self.write("UPDATE multidb_config SET name = 'b'")
+        self.assertEquals(self.read(), [('b',)])
+
+    def test_write_in_transaction(self):
+        self.read()
+        self.rename('b')
+        with transaction.atomic(using=DEFAULT_DB_ALIAS):
+            self.write("UPDATE multidb_config SET name = 'b'")
+            if hasattr(transaction, 'on_commit'):  # Django 1.9+
+                self.assertEquals(self.read(), [('a',)])
+        self.assertEquals(self.read(), [('b',)])
+
+    def test_writes_of_other_tables(self):
+        self.read()
+        self.rename('b')
+        self.write('DELETE FROM multidb_config_other')
+        self.assertEquals(self.read(), [('a',)])
+        self.write('INSERT INTO "multidb_config" VALUES (2, \'c\')')
+        self.assertEquals(self.read(), [('b',)])
+
+    def test_read_your_writes(self):
+        self.read()
+        self.rename('b')
+        try:
+            # A slave that has replayed the thread's writes, while the
+            # cached rows may come from one that hadn't.
+            set_this_thread_write_position('1')
+            self.assertEquals(self.read(), [('b',)])
+            set_this_thread_write_position(None)
+            set_this_thread_pinned_tables(['multidb_config'])
+            self.assertEquals(self.read(), [('b',)])
+        finally:
+            set_this_thread_write_position(None)
+            set_this_thread_pinned_tables(())
+        self.assertEquals(self.read(), [('a',)])
+
+    def test_other_tables(self):
+        sql = ('SELECT multidb_config.name FROM multidb_config, '
+               'multidb_other WHERE multidb_config.id = %s')
+        self.cursor.execute('CREATE TABLE multidb_other (id integer)')
+        try:
+            self.cursor.execute('INSERT INTO multidb_other VALUES (1)')
+            self.assertEquals(self.read(sql), [('a',)])
+            self.rename('b')
+            self.assertEquals(self.read(sql), [('b',)])
+        finally:
+            self.cursor.execute('DROP TABLE multidb_other')
+
+    @override_settings(SLAVE_DATABASES=[], MULTIDB_SHARDS={
+        'eu': {'MASTER': DEFAULT_DB_ALIAS, 'SLAVES': ['slave']},
+        'us': {'MASTER': DEFAULT_DB_ALIAS, 'SLAVES': ['slave2']},
+    })
+    def test_shards(self):
+        cursor = connections['slave2'].cursor()
+        cursor.execute('CREATE TABLE multidb_config '
+                       '(id integer, name varchar(10))')
+        try:
+            cursor.execute("INSERT INTO multidb_config VALUES (1, 'us')")
+            self.assertEquals(self.read(), [('a',)])
+            cursor.execute('SELECT name FROM multidb_config WHERE id = %s',
+                           [1])
+            self.assertEquals(cursor.fetchall(), [('us',)])
+        finally:
+            cursor.execute('DROP TABLE multidb_config')
+
+    @override_settings(SLAVE_DATABASES=[])
+    def test_not_slave(self):
+        self.read()
+        self.rename('b')
+        self.assertEquals(self.read(), [('b',)])
+
+    @override_settings(MULTIDB_QUERY_CACHE_MAX_ROWS=1)
+    def test_max_rows(self):
+        self.cursor.execute("INSERT INTO multidb_config VALUES (1, 'b')")
+        self.assertEquals(len(self.read()), 2)
+        self.assertEquals(len(querycache.get_results_cache()), 0)
+
+    @override_settings(MULTIDB_PINNING_SECONDS=0)
+    def test_expiry(self):
+        self.read()
+        self.rename('b')
+        self.assertEquals(self.read(), [('b',)])
+
+
+@override_settings(SLAVE_DATABASES=['slave', 'slave-b', 'slave-c'],
+                   MULTIDB_ZONE='a',
+                   MULTIDB_SLAVE_ZONES={'slave': 'a', 'slave-b': 'b',
+                                        'slave-c': 'c'})
+class ZoneTests(TestCase):
+    """Tests for preferring the slaves in the zone of the process"""
+
+    def tearDown(self):
+        health.reset()
+
+    def test_local(self):
+        self.assertEquals(set(get_slave() for _ in range(6)), set(['slave']))
+
+    @override_settings(MULTIDB_ZONE=None)
+    def test_no_zone(self):
+        self.assertEquals(set(get_slave() for _ in range(6)),
+                          set(['slave', 'slave-b', 'slave-c']))
+
+    @override_settings(MULTIDB_HEALTH_CHECK_FAILURES=1)
+    def test_spill_unhealthy(self):
+        health.record_failure('slave')
+        self.assertEquals(set(get_slave() for _ in range(6)),
+                          set(['slave-b', 'slave-c']))
+
+    @override_settings(MULTIDB_ZONE_MAX_IN_FLIGHT=1)
+    def test_spill_saturated(self):
+        seen = []
+
+        def wrapper(execute, sql, params, many, context):
+            seen.append(zones.prefer_local(['slave', 'slave-b']))
+            return execute(sql, params, many, context)
+        wrappers.register(wrappers.count_in_flight)
+        wrappers.register(wrapper)
+        try:
+            connections['slave'].cursor().execute('SELECT 1')
+        finally:
+            wrappers.unregister(wrapper)
+        self.assertEquals(seen, [['slave-b']])
+        self.assertEquals(zones.prefer_local(['slave', 'slave-b']),
+                          ['slave'])
+
+    @override_settings(MULTIDB_SLAVE_ZONES={})
+    def test_unknown_zones(self):
+        self.assertEquals(zones.prefer_local(['slave', 'slave-b']),
+                          ['slave', 'slave-b'])
+
+
+@override_settings(SLAVE_DATABASES=['slave', 'slave2'],
+                   MULTIDB_HEDGE_DELAY=0.05, MULTIDB_HEDGE_BUDGET=1)
+class HedgingTests(TestCase):
+    """Tests for reading from a second slave when the first is slow"""
+
+    def tearDown(self):
+        hedging.reset()
+
+    def slow_slave(self, alias):
+        if alias == 'slave':
+            time.sleep(0.5)
+        return alias
+
+    def test_fast(self):
+        self.assertEquals(hedging.hedged_call(lambda alias: alias,
+                                              first='slave'), 'slave')
+
+    def test_hedge(self):
+        start = time.time()
+        self.assertEquals(hedging.hedged_call(self.slow_slave,
+                                              first='slave'), 'slave2')
+        self.assertTrue(time.time() - start < 0.4)
+
+    @override_settings(MULTIDB_HEDGE_BUDGET=0.5)
+    def test_budget(self):
+        self.assertEquals(hedging.hedged_call(self.slow_slave,
+                                              first='slave'), 'slave')
+        self.assertEquals(hedging.hedged_call(self.slow_slave,
+                                              first='slave'), 'slave2')
+
+    def test_error(self):
+        def fail(alias):
+            raise OperationalError(alias)
+        self.assertRaises(OperationalError, hedging.hedged_call, fail,
+                          first='slave')
+
+    @override_settings(MULTIDB_HEDGE_THREADS=0)
+    def test_no_workers(self):
+        self.assertEquals(hedging.hedged_call(self.slow_slave,
+                                              first='slave'), 'slave')
+
+    @override_settings(MULTIDB_HEDGE_PERCENTILE=50)
+    def test_delay(self):
+        for i in range(hedging.MIN_LATENCY_SAMPLES - 1):
+            hedging._record_latency(groups.DEFAULT_GROUP, (i + 1) / 100.0)
+        self.assertEquals(hedging.hedge_delay(), 0.05)
+        hedging._record_latency(groups.DEFAULT_GROUP, 0.1)
+        self.assertEquals(hedging.hedge_delay(), 0.06)
+
+    def test_cancel(self):
+        def count(alias):
+            if alias == 'slave2':
+                return alias
+            cursor = connections[alias].cursor()
+            cursor.execute('WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL '
+                           'SELECT x + 1 FROM c) SELECT count(*) FROM c')
+            return alias
+        self.assertEquals(hedging.hedged_call(count, first='slave'),
+                          'slave2')
+        for _ in range(100):
+            if not hedging._busy:
+                break
+            time.sleep(0.01)
+        self.assertEquals(hedging._busy, 0)
+
+    @override_settings(MULTIDB_SHARDS={
+        'eu': {'MASTER': 'eu', 'SLAVES': ['eu-slave']},
+    }, MULTIDB_HEDGE_THREADS=0)
+    def test_shard_hints(self):
+        class QuerySet(object):
+            """Routed like querysets with ``db_manager(hints=...)``."""
+            model = fake_model('library', 'Book')
+            _db = None
+            _hints = {'shard': 'eu'}
+
+            @property
+            def db(self):
+                return PinningMasterSlaveRouter().db_for_read(
+                    self.model, **self._hints)
+
+            def using(self, alias):
+                return [alias]
+
+        self.assertEquals(hedging.hedged(QuerySet()), ['eu-slave'])
+
+
+@override_settings(MULTIDB_COOKIELESS_CACHE='default',
+                   MULTIDB_PINNING_KEY_FUNCTIONS=(
+                       'multidb.identity.token_key',
+                       'multidb.identity.session_key'))
+class IdentityPinningTests(TestCase):
+    """Tests for pinning identified clients on the server"""
+
+    def setUp(self):
+        cache.clear()
+        self.middleware = PinningRouterMiddleware()
+
+    def tearDown(self):
+        unpin_this_thread()
+        unset_db_write_for_this_thread()
+
+    def request(self, method='GET', token='secret', **meta):
+        request = HttpRequest()
+        request.method = method
+        request.META.update(meta, REMOTE_ADDR='10.0.0.1')
+        if token:
+            request.META['HTTP_AUTHORIZATION'] = 'Bearer %s' % token
+        return request
+
+    def round_trip(self, request):
+        self.middleware.process_request(request)
+        self.middleware.process_response(request, HttpResponse())
+
+    def test_keys(self):
+        request = self.request()
+        self.assertEquals(identity.request_keys(request),
+                          [identity.KEY_PREFIX + identity.token_key(request)])
+        request.COOKIES[settings.SESSION_COOKIE_NAME] = 'abc'
+        self.assertEquals(len(identity.request_keys(request)), 2)
+        self.assertEquals(identity.token_key(self.request(token=None)), None)
+        self.assertEquals(
+            identity.token_key(self.request(token=None,
+                                            HTTP_AUTHORIZATION='Basic x')),
+            None)
+
+    def test_user_key(self):
+        request = self.request()
+        self.assertEquals(identity.user_key(request), None)
+
+        class User(object):
+            pk = 3
+            is_authenticated = True
+        request.user = User()
+        self.assertEquals(identity.user_key(request), 'u:3')
+
+    def test_pin(self):
+        received = []
+
+        def receiver(sender, reason, **kwargs):
+            received.append(reason)
+        self.round_trip(self.request('POST'))
+        pinned.connect(receiver)
+        try:
+            self.middleware.process_request(self.request())
+        finally:
+            pinned.disconnect(receiver)
+        self.assertTrue(this_thread_is_pinned())
+        self.assertEquals(received, ['identity'])
+
+    def test_precise(self):
+        self.round_trip(self.request('POST'))
+        # Another client behind the same address isn't pinned, though it
+        # has the same fingerprint.
+        self.middleware.process_request(self.request(token='other'))
+        self.assertFalse(this_thread_is_pinned())
+        # Clients without keys still fall back to their fingerprint.
+        self.middleware.process_request(self.request(token=None))
+        self.assertFalse(this_thread_is_pinned())
+
+    def test_all_keys(self):
+        request = self.request('POST')
+        request.COOKIES[settings.SESSION_COOKIE_NAME] = 'abc'
+        self.round_trip(request)
+        request = self.request(token='new')
+        request.COOKIES[settings.SESSION_COOKIE_NAME] = 'abc'
+        self.middleware.process_request(request)
+        self.assertTrue(this_thread_is_pinned())
+
+    @override_settings(MULTIDB_PINNING_SECONDS=0)
+    def test_expiry(self):
+        self.round_trip(self.request('POST'))
+        self.middleware.process_request(self.request())
+        self.assertFalse(this_thread_is_pinned())
+
+
+@override_settings(SLAVE_DATABASES=['slave', 'slave2'], MULTIDB_STATS=True,
+                   MULTIDB_MAX_IN_FLIGHT={'slave': 1, 'slave2': 2})
+class InFlightLimitTests(TestCase):
+    """Tests for limiting the queries run on each slave at once"""
+
+    def setUp(self):
+        stats.reset()
+
+    def tearDown(self):
+        wrappers._in_flight.clear()
+        stats.reset()
+
+    def test_under_limits(self):
+        self.assertEquals(set(get_slave() for _ in range(4)),
+                          set(['slave', 'slave2']))
+        self.assertEquals(stats.snapshot()['rejections'], {})
+
+    def test_other_slave(self):
+        wrappers._in_flight['slave'] = 1
+        self.assertEquals(set(get_slave() for _ in range(4)),
+                          set(['slave2']))
+        self.assertEquals(stats.snapshot()['rejections'], {'slave': 4})
+
+    def test_overflow_to_master(self):
+        wrappers._in_flight.update(slave=1, slave2=2)
+        self.assertEquals(MasterSlaveRouter().db_for_read(None),
+                          DEFAULT_DB_ALIAS)
+        self.assertEquals(stats.snapshot()['rejections'],
+                          {'slave': 1, 'slave2': 1})
+        self.assertTrue('multidb_rejections_total{alias="slave"} 1'
+                        in stats.prometheus_text())
+
+    @override_settings(MULTIDB_IN_FLIGHT_OVERFLOW='fail')
+    def test_fail_fast(self):
+        wrappers._in_flight.update(slave=1, slave2=2)
+        self.assertRaises(limits.SlavesOverloaded,
+                          MasterSlaveRouter().db_for_read, None)
+        self.assertTrue(isinstance(limits.SlavesOverloaded(), DatabaseError))
+
+    @override_settings(MULTIDB_IN_FLIGHT_OVERFLOW='fail',
+                       MULTIDB_HEALTH_CHECK_FAILURES=1)
+    def test_unhealthy_is_not_overflow(self):
+        wrappers._in_flight.update(slave=1)
+        health.record_failure('slave')
+        health.record_failure('slave2')
+        try:
+            self.assertEquals(get_slave(), DEFAULT_DB_ALIAS)
+        finally:
+            health.reset()
+
+    def test_signal(self):
+        seen = []
+
+        def rejected(sender, alias, group, **kwargs):
+            seen.append((alias, group))
+        wrappers._in_flight['slave'] = 1
+        read_rejected.connect(rejected)
+        try:
+            get_slave()
+        finally:
+            read_rejected.disconnect(rejected)
+        self.assertEquals(seen, [('slave', 'default')])
+
+    def test_sticky(self):
+        with use_sticky_slave:
+            first = get_slave()
+            wrappers._in_flight[first] = 2
+            self.assertNotEquals(get_slave(), first)
+
+    def test_counted(self):
+        seen = []
+
+        def wrapper(execute, sql, params, many, context):
+            seen.append(limits.is_full('slave'))
+            return execute(sql, params, many, context)
+        wrappers.register(wrappers.count_in_flight)
+        wrappers.register(wrapper)
+        try:
+            connections['slave'].cursor().execute('SELECT 1')
+        finally:
+            wrappers.unregister(wrapper)
+        self.assertEquals(seen, [True])
+        self.assertFalse(limits.is_full('slave'))
+
+
+@skipIf(django.VERSION < (3, 1), 'Async middleware needs Django 3.1+')
+class AsyncMiddlewareTests(TestCase):
+    """Tests for the pinning middleware in async middleware chains"""
+
+    def tearDown(self):
+        unpin_this_thread()
+        unset_db_write_for_this_thread()
+
+    def request(self, method='GET'):
+        request = HttpRequest()
+        request.method = method
+        return request
+
+    def test_cookie(self):
+        response, = async_views.run(self.request('POST'))
+        self.assertEquals(response.content, b'pinned')
+        self.assertEquals(
+            response.cookies[settings.MULTIDB_PINNING_COOKIE].value,
+            tokens.PINNED)
+
+    def test_concurrent(self):
+        pinned_get = self.request()
+        pinned_get.COOKIES[settings.MULTIDB_PINNING_COOKIE] = tokens.PINNED
+        responses = async_views.run(self.request(), self.request('POST'),
+                                    pinned_get, self.request())
+        self.assertEquals([response.content for response in responses],
+                          [b'not pinned', b'pinned', b'pinned',
+                           b'not pinned'])
+        self.assertEquals(
+            [settings.MULTIDB_PINNING_COOKIE in response.cookies
+             for response in responses], [False, True, False, False])
+        # Nothing leaks into the context that ran the event loop.
+        self.assertFalse(this_thread_is_pinned())
+
+    def test_sync_chain(self):
+        middleware = AsyncPinningRouterMiddleware(dummy_view)
+        response = middleware(self.request('POST'))
+        self.assertEquals(response.content, b'pinned')
+        self.assertTrue(settings.MULTIDB_PINNING_COOKIE in response.cookies)
+
+    @override_settings(
+        MULTIDB_WRITE_POSITIONS='multidb.tests.async_views.SyncOnlyPositions')
+    def test_write_position(self):
+        response, = async_views.run(self.request('POST'))
+        cookie = response.cookies[settings.MULTIDB_PINNING_COOKIE].value
+        self.assertEquals(tokens.loads(cookie), {'p': '0'})
+
+    @override_settings(
+        MULTIDB_PINNING_KEY_FUNCTIONS=('multidb.identity.user_key',))
+    def test_identity(self):
+        cache.clear()
+        request = self.request('POST')
+        request.user = async_views.lazy_user(3)
+        async_views.run(request)
+        request = self.request()
+        request.user = async_views.lazy_user(3)
+        response, = async_views.run(request)
+        self.assertEquals(response.content, b'pinned')
+        request = self.request()
+        request.user = async_views.lazy_user(4)
+        response, = async_views.run(request)
+        self.assertEquals(response.content, b'not pinned')
@@ -8,4 +8,5 @@ urlpatterns = patterns(
     (r'^dummy/$', 'multidb.tests.views.dummy_view'),
     (r'^cdummy/$', class_based_dummy_view.as_view()),
     (r'^odummy/$', object_dummy_view()),
+    (r'^ndummy/$', 'multidb.tests.views.dummy_view', {}, 'named-dummy'),
 )
@@ -0,0 +1,41 @@
+"""Encoding of the pinning state carried by the pinning cookie and the
+cookieless cache.
+
+The state is a dictionary. An empty state means "pinned to the master" and
+is encoded as ``'y'``, which is what the pinning cookie always contained.
+Other states are encoded as unpadded URL-safe base64 of compact JSON.
+"""
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+import json
+
+from django.utils.encoding import force_bytes
+
+
+__all__ = ['dumps', 'loads']
+
+
+PINNED = 'y'
+
+
+def dumps(state):
+    """Return ``state`` as a cookie-safe string."""
+    if not state:
+        return PINNED
+    data = json.dumps(state, separators=(',', ':'), sort_keys=True)
+    return urlsafe_b64encode(force_bytes(data)).decode('ascii').rstrip('=')
+
+
+def loads(value):
+    """Return the state encoded in ``value``.
+
+    Anything that can't be decoded, like ``'y'``, means a plain pin.
+    """
+    if not value or value == PINNED:
+        return {}
+    value = force_bytes(value)
+    try:
+        state = json.loads(urlsafe_b64decode(value + b'=' * (-len(value) % 4))
+                           .decode('utf-8'))
+    except (TypeError, ValueError):
+        return {}
+    return state if isinstance(state, dict) else {}
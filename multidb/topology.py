@@ -0,0 +1,205 @@
+"""Changing the slaves and shards of a running process.
+
+``update()`` replaces some of the settings that describe the topology
+(``TOPOLOGY_SETTINGS``) and rebuilds the slave groups and shards from them;
+the routers pick the new ones up with their next query. ``DATABASES``
+entries in the update add aliases; existing aliases are left alone.
+
+Slaves and shard masters that the update removes stop being routed to at
+once, but queries running on them finish. The slave groups and the shards
+are replaced together, so each query is routed by the old topology or the
+new one. Each thread closes its connections to them when it finishes a
+request, or when it calls ``close_retired()``.
+
+A process can also poll ``MULTIDB_TOPOLOGY_FILE`` (a JSON file) or the
+``MULTIDB_TOPOLOGY_CACHE_KEY`` key of ``MULTIDB_TOPOLOGY_CACHE`` (which
+``publish()`` sets) for updates, with ``start_topology_poller()``, or read
+them once with ``reload()``.
+"""
+import json
+import logging
+import threading
+
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import request_finished
+from django.db import DEFAULT_DB_ALIAS, connections
+
+from multidb import groups, shards
+from multidb.conf import settings
+from multidb.signals import topology_changed
+from multidb.utils import get_cache, slave_aliases
+
+
+__all__ = ['TOPOLOGY_SETTINGS', 'update', 'is_retired', 'close_retired',
+           'load', 'reload', 'publish', 'TopologyPoller',
+           'start_topology_poller', 'stop_topology_poller', 'reset']
+
+
+log = logging.getLogger('multidb')
+
+TOPOLOGY_SETTINGS = ('DATABASES', 'SLAVE_DATABASES', 'MULTIDB_SLAVE_GROUPS',
+                     'MULTIDB_SLAVE_ROUTES', 'MULTIDB_SLAVE_WEIGHTS',
+                     'MULTIDB_SHARDS')
+
+_lock = threading.Lock()
+# Aliases removed by an update. Replaced, never mutated, so that is_retired()
+# can read it without locking.
+_retired = frozenset()
+# The last topology applied by reload().
+_loaded = None
+_poller = None
+
+
+def _routed_aliases():
+    aliases = set(slave_aliases())
+    aliases.update(options.get('MASTER')
+                   for options in settings.MULTIDB_SHARDS.values())
+    aliases.discard(DEFAULT_DB_ALIAS)
+    return aliases
+
+
+def update(topology):
+    """Apply ``topology``, a dictionary of some of ``TOPOLOGY_SETTINGS``,
+    and send ``multidb.signals.topology_changed``."""
+    global _retired
+    unknown = set(topology) - set(TOPOLOGY_SETTINGS)
+    if unknown:
+        raise ImproperlyConfigured(
+            'Unknown topology settings: %s.' % ', '.join(sorted(unknown)))
+    with _lock:
+        before = _routed_aliases()
+        for alias, options in topology.get('DATABASES', {}).items():
+            settings.DATABASES.setdefault(alias, options)
+        saved = dict((name, getattr(settings, name)) for name in topology
+                     if name != 'DATABASES')
+        for name in saved:
+            setattr(settings, name, topology[name])
+        try:
+            unknown = _routed_aliases() - set(settings.DATABASES)
+            if unknown:
+                raise ImproperlyConfigured(
+                    'The topology routes to unknown databases: %s.'
+                    % ', '.join(sorted(unknown)))
+            groups.build()
+        except Exception:
+            for name, value in saved.items():
+                setattr(settings, name, value)
+            groups.build()
+            raise
+        after = _routed_aliases()
+        for alias in slave_aliases():
+            shard = shards.shard_of_alias(alias)
+            settings.DATABASES[alias]['TEST_MIRROR'] = (
+                DEFAULT_DB_ALIAS if shard is None else shard.master)
+        _retired = (_retired | (before - after)) - after
+    if before != after:
+        log.info('Database topology changed: added %s, removed %s.',
+                 sorted(after - before), sorted(before - after))
+    topology_changed.send(sender=None, added=after - before,
+                          removed=before - after)
+
+
+def is_retired(alias):
+    """Return whether an update removed ``alias``."""
+    return alias in _retired
+
+
+def close_retired(**kwargs):
+    """Close the current thread's connections to the aliases updates
+    removed."""
+    for alias in _retired:
+        connection = connections[alias]
+        if not getattr(connection, 'in_atomic_block', False):
+            connection.close()
+
+request_finished.connect(close_retired)
+
+
+def load():
+    """Return the topology in ``MULTIDB_TOPOLOGY_FILE`` or
+    ``MULTIDB_TOPOLOGY_CACHE``, or ``None``."""
+    if settings.MULTIDB_TOPOLOGY_FILE:
+        with open(settings.MULTIDB_TOPOLOGY_FILE) as topology:
+            return json.load(topology)
+    if settings.MULTIDB_TOPOLOGY_CACHE:
+        return _cache().get(settings.MULTIDB_TOPOLOGY_CACHE_KEY)
+    return None
+
+
+def reload():
+    """Apply the topology ``load()`` returns, if it changed since the last
+    call. Return whether it did."""
+    global _loaded
+    topology = load()
+    if topology is None or topology == _loaded:
+        return False
+    update(topology)
+    _loaded = topology
+    return True
+
+
+def publish(topology):
+    """Store ``topology`` in ``MULTIDB_TOPOLOGY_CACHE``, for the processes
+    that poll it."""
+    _cache().set(settings.MULTIDB_TOPOLOGY_CACHE_KEY, topology, None)
+
+
+def _cache():
+    return get_cache(settings.MULTIDB_TOPOLOGY_CACHE)
+
+
+class TopologyPoller(threading.Thread):
+    """A daemon thread that calls ``reload`` every ``interval`` seconds."""
+
+    def __init__(self, interval):
+        super(TopologyPoller, self).__init__(name='multidb-topology-poller')
+        self.daemon = True
+        self.interval = interval
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.is_set():
+            try:
+                reload()
+            except Exception:
+                log.exception('Could not reload the database topology.')
+            self._stopped.wait(self.interval)
+
+    def stop(self):
+        self._stopped.set()
+
+
+def start_topology_poller(interval=None):
+    """Start the topology poller unless it is already running.
+
+    ``interval`` defaults to ``MULTIDB_TOPOLOGY_POLL_INTERVAL``; if that is
+    not set, nothing is started. Call this after forking.
+    """
+    global _poller
+    if interval is None:
+        interval = settings.MULTIDB_TOPOLOGY_POLL_INTERVAL
+    if not interval:
+        return None
+    with _lock:
+        if _poller is None or not _poller.is_alive():
+            _poller = TopologyPoller(interval)
+            _poller.start()
+        return _poller
+
+
+def stop_topology_poller():
+    """Stop the topology poller, if it is running."""
+    global _poller
+    with _lock:
+        if _poller is not None:
+            _poller.stop()
+            _poller = None
+
+
+def reset():
+    """Forget the aliases updates removed and the last topology
+    loaded."""
+    global _retired, _loaded
+    with _lock:
+        _retired = frozenset()
+        _loaded = None
@@ -0,0 +1,48 @@
+from multidb.conf import settings
+
+try:
+    from importlib import import_module
+except ImportError:  # Python 2.6
+    from django.utils.importlib import import_module
+
+try:
+    from django.core.signals import setting_changed  # noqa
+except ImportError:  # Django < 1.8
+    from django.test.signals import setting_changed  # noqa
+
+try:
+    from django.core.cache import caches
+except ImportError:  # Django < 1.7
+    from django.core.cache import get_cache  # noqa
+else:
+    def get_cache(alias):
+        return caches[alias]
+
+try:
+    string_types = basestring
+except NameError:  # Python 3
+    string_types = str
+
+
+def import_object(path):
+    """Return the object at the dotted ``path``, or ``path`` itself if it
+    isn't a string."""
+    if not isinstance(path, string_types):
+        return path
+    module, name = path.rsplit('.', 1)
+    return getattr(import_module(module), name)
+
+
+def slave_aliases():
+    """Return the aliases of all slaves: ``SLAVE_DATABASES``, the members
+    of ``MULTIDB_SLAVE_GROUPS`` and the slaves of ``MULTIDB_SHARDS``."""
+    aliases = list(getattr(settings, 'SLAVE_DATABASES', None) or ())
+    members = [options.get('DATABASES', ())
+               for options in settings.MULTIDB_SLAVE_GROUPS.values()]
+    members += [options.get('SLAVES', ())
+                for options in settings.MULTIDB_SHARDS.values()]
+    for group in members:
+        for alias in group:
+            if alias not in aliases:
+                aliases.append(alias)
+    return aliases
@@ -0,0 +1,9 @@
+from django.http import HttpResponse
+
+from multidb.stats import prometheus_text
+
+
+def metrics(request):
+    """Serve the statistics of multidb.stats for Prometheus to scrape."""
+    return HttpResponse(prometheus_text(),
+                        content_type='text/plain; version=0.0.4')
@@ -0,0 +1,118 @@
+"""Opening the connections of a process before its first requests.
+
+Django connects to a database the first time a thread queries it, so right
+after a deploy the first requests of every worker pay for connecting to the
+master and to each slave, all at about the same time. ``warm_up()`` opens
+and validates those connections up front, in the calling thread (Django
+connections are per thread, so that's the thread that gets to use them):
+
+* it first sleeps a random time of up to ``MULTIDB_WARMUP_JITTER`` seconds,
+  so that workers started together don't all connect at once;
+* at most ``MULTIDB_WARMUP_CONCURRENCY`` threads of a process connect at the
+  same time, however many of them warm up (one call connects to one alias
+  after the other).
+
+Call it in each worker process, after it forks, from the thread that
+serves requests. Connections opened before forking would be shared by the
+workers. Aliases whose ``CONN_MAX_AGE`` is 0 are skipped: Django closes
+their connections at the start of the next request anyway.
+"""
+import logging
+import random
+import threading
+import time
+
+from django.db import connections
+
+from multidb import DEFAULT_DB_ALIAS, health, shards
+from multidb.conf import settings
+from multidb.utils import setting_changed, slave_aliases
+
+
+__all__ = ['database_aliases', 'warm_up']
+
+
+log = logging.getLogger('multidb')
+
+_lock = threading.Lock()
+# Limits the threads connecting at once; built on first use.
+_slots = None
+
+
+def database_aliases():
+    """Return the aliases of the masters (``default`` and those of
+    ``MULTIDB_SHARDS``), then those of all slaves."""
+    aliases = [DEFAULT_DB_ALIAS]
+    for name in sorted(settings.MULTIDB_SHARDS):
+        master = shards.get_shard(name).master
+        if master not in aliases:
+            aliases.append(master)
+    return aliases + [alias for alias in slave_aliases()
+                      if alias not in aliases]
+
+
+def _is_persistent(alias):
+    """Return whether Django keeps the connections to ``alias`` between
+    requests. Unknown aliases are tried, and fail."""
+    options = settings.DATABASES.get(alias)
+    return options is None or options.get('CONN_MAX_AGE', 0) != 0
+
+
+def _get_slots():
+    global _slots
+    with _lock:
+        if _slots is None:
+            _slots = threading.BoundedSemaphore(
+                max(1, settings.MULTIDB_WARMUP_CONCURRENCY))
+        return _slots
+
+
+def warm_up(aliases=None, jitter=None):
+    """Connect to each of ``aliases`` (default: ``database_aliases()``) and
+    run a trivial query on it, after sleeping up to ``jitter`` seconds
+    (default: ``MULTIDB_WARMUP_JITTER``).
+
+    Aliases whose connections don't outlive a request (``CONN_MAX_AGE``
+    0, Django's default) are skipped.
+
+    Return a dictionary mapping the aliases that failed to the exceptions
+    they raised. The failures of slaves count towards ejecting them (see
+    ``multidb.health``).
+    """
+    if aliases is None:
+        aliases = database_aliases()
+    aliases = [alias for alias in aliases if _is_persistent(alias)]
+    if not aliases:
+        return {}
+    if jitter is None:
+        jitter = settings.MULTIDB_WARMUP_JITTER
+    if jitter:
+        time.sleep(random.uniform(0, jitter))
+    failed = {}
+    slaves = set(slave_aliases())
+    slots = _get_slots()
+    for alias in aliases:
+        with slots:
+            try:
+                health.ping(alias)
+            except Exception as error:
+                failed[alias] = error
+                try:
+                    connections[alias].close()
+                except Exception:
+                    pass
+                if alias in slaves:
+                    health.record_failure(alias)
+    if failed:
+        log.warning('Could not warm up the connections to %s.',
+                    ', '.join(repr(alias) for alias in sorted(failed)))
+    return failed
+
+
+def _setting_changed(sender, setting, **kwargs):
+    global _slots
+    if setting == 'MULTIDB_WARMUP_CONCURRENCY':
+        with _lock:
+            _slots = None
+
+setting_changed.connect(_setting_changed)
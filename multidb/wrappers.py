@@ -0,0 +1,149 @@
+"""Process-wide query execution wrappers.
+
+A wrapper has the signature of Django's ``connection.execute_wrapper``
+callables: ``wrapper(execute, sql, params, many, context)``. Registered
+wrappers are installed on every database connection as it is created. On
+Django versions without ``execute_wrapper``, the connection's cursors are
+wrapped instead; there, the query that opens a connection isn't seen.
+"""
+from functools import partial
+import threading
+
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.db.backends.signals import connection_created
+
+from multidb.pinning import set_this_thread_has_written
+
+
+__all__ = ['register', 'unregister', 'install', 'count_in_flight',
+           'in_flight', 'is_write', 'note_writes']
+
+
+# Replaced, never mutated, so that _dispatch() can read it without locking.
+_wrappers = ()
+_lock = threading.Lock()
+_in_flight_lock = threading.Lock()
+_in_flight = {}
+
+# Statements that don't change the data; anything else counts as a write.
+READ_STATEMENTS = frozenset([
+    'SELECT', 'SHOW', 'EXPLAIN', 'DESCRIBE', 'SET', 'BEGIN', 'START',
+    'COMMIT', 'ROLLBACK', 'SAVEPOINT', 'RELEASE', 'DECLARE', 'FETCH', 'CLOSE',
+])
+
+
+def _dispatch(execute, sql, params, many, context):
+    for wrapper in reversed(_wrappers):
+        execute = partial(wrapper, execute)
+    return execute(sql, params, many, context)
+
+
+class _WrappedCursor(object):
+    """Calls the registered wrappers around ``execute`` and ``executemany``
+    of a cursor, for Django versions without ``execute_wrapper``."""
+
+    def __init__(self, cursor, connection):
+        self.cursor = cursor
+        self.db = connection
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        # Like Django's own cursors, which aren't context managers before
+        # Django 1.7.
+        try:
+            self.close()
+        except self.db.Database.Error:
+            pass
+
+    def _execute(self, sql, params, many, context):
+        if many:
+            return self.cursor.executemany(sql, params)
+        return self.cursor.execute(sql, params)
+
+    def execute(self, sql, params=None):
+        return _dispatch(self._execute, sql, params, False,
+                         {'connection': self.db, 'cursor': self})
+
+    def executemany(self, sql, param_list):
+        return _dispatch(self._execute, sql, param_list, True,
+                         {'connection': self.db, 'cursor': self})
+
+
+def install(connection):
+    """Make the registered wrappers see the queries run on ``connection``.
+    Installing more than once is harmless."""
+    if getattr(connection, '_multidb_wrapped', False):
+        return
+    connection._multidb_wrapped = True
+    if hasattr(connection, 'execute_wrappers'):
+        # First, so that an execute_wrapper() block that is active right now
+        # pops its own wrapper, not ours.
+        connection.execute_wrappers.insert(0, _dispatch)
+    else:
+        cursor = connection.cursor
+        connection.cursor = lambda: _WrappedCursor(cursor(), connection)
+
+
+def _connection_created(sender, connection, **kwargs):
+    install(connection)
+
+
+def register(wrapper):
+    """Call ``wrapper`` around every query from now on."""
+    global _wrappers
+    with _lock:
+        if wrapper in _wrappers:
+            return
+        _wrappers += (wrapper,)
+        connection_created.connect(_connection_created,
+                                   dispatch_uid='multidb.wrappers')
+    for connection in connections.all():
+        install(connection)
+
+
+def unregister(wrapper):
+    """Stop calling ``wrapper`` around queries."""
+    global _wrappers
+    with _lock:
+        _wrappers = tuple(w for w in _wrappers if w != wrapper)
+
+
+def count_in_flight(execute, sql, params, many, context):
+    """A wrapper that counts the queries each alias is running."""
+    alias = context['connection'].alias
+    with _in_flight_lock:
+        _in_flight[alias] = _in_flight.get(alias, 0) + 1
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        with _in_flight_lock:
+            _in_flight[alias] -= 1
+
+
+def in_flight(alias):
+    """Return how many queries this process is running on ``alias``, as
+    counted by ``count_in_flight``."""
+    return _in_flight.get(alias, 0)
+
+
+def is_write(sql):
+    """Return whether ``sql`` may change the data."""
+    words = sql.split(None, 1)
+    return bool(words) and \
+        words[0].lstrip('(').upper() not in READ_STATEMENTS
+
+
+def note_writes(execute, sql, params, many, context):
+    """A wrapper that notes which threads run writes on the master."""
+    result = execute(sql, params, many, context)
+    if context['connection'].alias == DEFAULT_DB_ALIAS and is_write(sql):
+        set_this_thread_has_written()
+    return result
@@ -0,0 +1,40 @@
+"""Preferring the slaves in the zone of the process.
+
+``MULTIDB_ZONE`` names the zone (availability zone, data center, rack...)
+this process runs in, and ``MULTIDB_SLAVE_ZONES`` maps slave aliases to the
+zones they run in. When both are set, ``multidb.get_slave`` chooses among
+the usable slaves of a group that are in the process's zone, and only
+spills over to the other zones when there's none, or when this process
+already runs ``MULTIDB_ZONE_MAX_IN_FLIGHT`` queries on each of them.
+"""
+from multidb import wrappers
+from multidb.conf import settings
+
+
+__all__ = ['zone_of', 'prefer_local']
+
+
+def zone_of(alias):
+    """Return the zone of ``alias``, or ``None`` if it has none."""
+    return settings.MULTIDB_SLAVE_ZONES.get(alias)
+
+
+def _is_saturated(alias):
+    limit = settings.MULTIDB_ZONE_MAX_IN_FLIGHT
+    return limit is not None and wrappers.in_flight(alias) >= limit
+
+
+def prefer_local(aliases):
+    """Return those of ``aliases`` that are in the zone of the process and
+    not saturated, or, if there are none, the others."""
+    zone = settings.MULTIDB_ZONE
+    if zone is None:
+        return aliases
+    local = []
+    remote = []
+    for alias in aliases:
+        if zone_of(alias) != zone:
+            remote.append(alias)
+        elif not _is_saturated(alias):
+            local.append(alias)
+    return local or remote or aliases
@@ -6,6 +6,8 @@ export DJANGO_SETTINGS_MODULE="test_settings"
 usage() {
     echo "USAGE: $0 [command]"
     echo "  test - run the tests"
+    echo "  bench - run the benchmarks"
+    echo "  simulate - run the replication lag simulator"
     echo "  shell - open the Django shell"
     echo "  check - run flake8"
     exit 1
@@ -15,6 +17,12 @@ case "$1" in
     "test" )
         shift;
         django-admin.py test "$@" ;;
+    "bench" )
+        shift;
+        python -m multidb.tests.bench "$@" ;;
+    "simulate" )
+        shift;
+        python -m multidb.tests.simulate "$@" ;;
     "shell" )
         django-admin.py shell ;;
     "check" )
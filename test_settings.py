@@ -16,6 +16,10 @@ DATABASES = {
         'NAME': 'slave',
         'ENGINE': 'django.db.backends.sqlite3',
     },
+    'slave2': {
+        'NAME': 'slave2',
+        'ENGINE': 'django.db.backends.sqlite3',
+    },
 }
 
 SLAVE_DATABASES = ['slave']